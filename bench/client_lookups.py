@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Measures how many lookups per second a single thread can make against a
+control server, using the blocking client and the asynchronous client.
+
+The server runs in a child process (so that it doesn't compete with the
+client for the interpreter lock), serving a table of synthetic hosts.
+
+    python3 bench/client_lookups.py [-n lookups] [-c concurrency] [-u]
+"""
+import asyncio
+import getopt
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lns import aio, control_proto, net_proto, reactor
+
+HOSTS = 1000
+
+def run_server(path, port_pipe):
+    "Runs a control server until a client tells it to quit."
+    my_reactor = reactor.Reactor()
+    net_handler = net_proto.ProtocolHandler(my_reactor, 'bench')
+    for i in range(HOSTS):
+        net_handler.peers.set_host('10.0.{}.{}'.format(i // 256, i % 256),
+            'host-{}'.format(i))
+
+    control_handler = control_proto.ProtocolHandler(net_handler, my_reactor,
+        port=0, path=path)
+    control_handler.open()
+    _, port = control_handler.server_sock.getsockname()
+    port_pipe.send(port)
+
+    while control_handler.is_running():
+        my_reactor.poll(None)
+    control_handler.close()
+
+def start_server(path):
+    """
+    Starts a control server in a child process, returning the port that it is
+    listening on and a function which stops it.
+    """
+    port_reader, port_writer = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=run_server,
+        args=(path, port_writer))
+    server.start()
+    port = port_reader.recv()
+
+    def stop():
+        with control_proto.ClientHandler(port) as client:
+            client.terminate()
+        server.join()
+    return port, stop
+
+def bench_blocking(port, path, lookups):
+    "Makes each lookup in turn with a ClientHandler."
+    with control_proto.ClientHandler(port, path) as client:
+        start = time.perf_counter()
+        for i in range(lookups):
+            client.get_ip('host-{}'.format(i % HOSTS))
+        return time.perf_counter() - start
+
+def bench_async(port, path, lookups, concurrency):
+    "Makes the lookups with an AsyncClientHandler, many at a time."
+    async def worker(client, count):
+        for i in range(count):
+            await client.get_ip('host-{}'.format(i % HOSTS))
+
+    async def run():
+        async with aio.AsyncClientHandler(port, path) as client:
+            start = time.perf_counter()
+            await asyncio.gather(*[worker(client, lookups // concurrency)
+                for _ in range(concurrency)])
+            return time.perf_counter() - start
+
+    return asyncio.run(run())
+
+def main():
+    lookups = 20000
+    concurrency = 64
+    use_unix = False
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'n:c:u')
+    for optname, optvalue in opts:
+        if optname == '-n':
+            lookups = int(optvalue)
+        elif optname == '-c':
+            concurrency = int(optvalue)
+        elif optname == '-u':
+            use_unix = True
+
+    with tempfile.TemporaryDirectory() as socket_dir:
+        path = os.path.join(socket_dir, 'lnsd.sock') if use_unix else None
+        port, stop = start_server(path)
+        try:
+            elapsed = bench_blocking(port, path, lookups)
+            print('blocking:  {:10.0f} lookups/s'.format(lookups / elapsed))
+
+            lookups -= lookups % concurrency
+            elapsed = bench_async(port, path, lookups, concurrency)
+            print('async x{:<3d} {:10.0f} lookups/s'.format(concurrency,
+                lookups / elapsed))
+        finally:
+            stop()
+
+if __name__ == '__main__':
+    main()
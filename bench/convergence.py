@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Measures how long a network of real lnsd processes takes to agree on the
+host-name mapping, as daemons join, die, are renamed and come back.
+
+Every daemon runs on this machine, bound to its own loopback address
+(127.0.0.2, 127.0.0.3...) on the same network port. Broadcasts don't reach
+across loopback addresses, so each daemon announces itself to every address
+in turn instead (see the broadcast_address option), itself included - the
+same as a broadcast would.
+
+The daemons go through these phases, and for each, this reports how long it
+took until every running daemon's GET-ALL matched the daemons that are
+running, and how many announces were sent and received in the meantime:
+
+- start: every daemon is started.
+- kill: some daemons are killed outright, so the others have to expire them.
+- rename: some other daemons are restarted under new names.
+- restart: the killed daemons are started again.
+
+    python3 bench/convergence.py [-n daemons] [-k affected] [-i interval]
+                                 [-t ttl] [-P net-port] [-C control-port]
+                                 [-o report]
+
+Options:
+
+    -n DAEMONS       How many daemons to run (default: 10).
+    -k AFFECTED      How many daemons are killed, and renamed (default: a
+                     fifth of them).
+    -i INTERVAL      The announce interval of the daemons, in seconds
+                     (default: 1).
+    -t TTL           How long the daemons wait before they expire a host, in
+                     seconds (default: three announce intervals).
+    -P NET_PORT      The network port the daemons share (default: 15151).
+    -C CONTROL_PORT  The control port of the first daemon - the others use the
+                     ports after it (default: 20771).
+    -o REPORT        Also writes the report as JSON to the given file.
+"""
+import getopt
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from lns import control_proto
+
+# How often the daemons are asked whether they agree, in seconds
+CHECK_INTERVAL = 0.05
+
+# How long a daemon has to start accepting control connections, in seconds
+START_TIMEOUT = 10
+
+def make_address(index):
+    "Gets the loopback address of the daemon with the given index."
+    return '127.0.{}.{}'.format(index // 250, index % 250 + 2)
+
+class Daemon:
+    """
+    One lnsd process, bound to its own loopback address.
+    """
+    def __init__(self, index, config_path, net_port, control_port):
+        self.index = index
+        self.address = make_address(index)
+        self.config_path = config_path
+        self.net_port = net_port
+        self.control_port = control_port
+        self.name = 'node-{}'.format(index)
+        self.process = None
+
+    def start(self):
+        """
+        Starts the daemon, without waiting for it to be ready.
+        """
+        self.process = subprocess.Popen([sys.executable, '-m', 'lns.lnsd',
+            '-c', self.config_path, '-n', self.name,
+            '-p', '{}:{}'.format(self.control_port, self.net_port)],
+            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self):
+        """
+        Waits until the daemon accepts control connections.
+        """
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('localhost', self.control_port),
+                    timeout=1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None:
+                    raise RuntimeError('{} exited with {}'.format(self.name,
+                        self.process.returncode))
+                if time.monotonic() > deadline:
+                    raise RuntimeError('{} did not start'.format(self.name))
+                time.sleep(CHECK_INTERVAL)
+
+    def is_running(self):
+        "Returns whether the daemon is running."
+        return self.process is not None and self.process.poll() is None
+
+    def get_mapping(self):
+        "Gets the daemon's host-name mapping."
+        with control_proto.ClientHandler(self.control_port) as client:
+            return client.get_host_ip_mapping()
+
+    def get_packets(self):
+        "Gets the number of announces the daemon has sent and received."
+        with control_proto.ClientHandler(self.control_port) as client:
+            counters = {counter['name']: counter['value']
+                for counter in client.get_stats().counters
+                if not counter['labels']}
+        return counters['announces_sent'], counters['packets_received']
+
+    def stop(self, sig=signal.SIGTERM):
+        "Stops the daemon with the given signal, and waits for it to exit."
+        self.process.send_signal(sig)
+        self.process.wait()
+        self.process = None
+
+class Cluster:
+    """
+    A group of daemons, which keeps count of the announces they exchange.
+    """
+    def __init__(self, daemons):
+        self.daemons = daemons
+
+        # The announces sent and received by daemons which have since stopped
+        self.retired_sent = 0
+        self.retired_received = 0
+
+    def get_running(self):
+        "Gets the daemons which are running."
+        return [daemon for daemon in self.daemons if daemon.is_running()]
+
+    def get_packets(self):
+        "Gets the announces sent and received by every daemon so far."
+        sent, received = self.retired_sent, self.retired_received
+        for daemon in self.get_running():
+            daemon_sent, daemon_received = daemon.get_packets()
+            sent += daemon_sent
+            received += daemon_received
+        return sent, received
+
+    def stop(self, daemon, sig=signal.SIGTERM):
+        "Stops a daemon, keeping its count of announces."
+        sent, received = daemon.get_packets()
+        self.retired_sent += sent
+        self.retired_received += received
+        daemon.stop(sig)
+
+    def start(self, daemons):
+        "Starts some daemons together, and waits until they are all ready."
+        for daemon in daemons:
+            daemon.start()
+        for daemon in daemons:
+            daemon.wait_ready()
+
+    def agrees(self):
+        """
+        Returns whether every running daemon knows exactly the running
+        daemons.
+        """
+        running = self.get_running()
+        expected = {daemon.name: [daemon.address] for daemon in running}
+        for daemon in running:
+            try:
+                if daemon.get_mapping() != expected:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def run_phase(self, name, action, timeout):
+        """
+        Runs the action which starts a phase, and waits until the daemons
+        agree again, returning a report of the phase.
+        """
+        sent, received = self.get_packets()
+        started = time.monotonic()
+        action()
+        ready = time.monotonic() - started
+
+        converged = None
+        while time.monotonic() - started < timeout:
+            if self.agrees():
+                converged = time.monotonic() - started
+                break
+            time.sleep(CHECK_INTERVAL)
+
+        now_sent, now_received = self.get_packets()
+        report = {'phase': name, 'ready': ready, 'converged': converged,
+            'daemons': len(self.get_running()),
+            'announces_sent': now_sent - sent,
+            'announces_received': now_received - received}
+
+        print('{:8s} {:>9s}  ({} daemons, {} announces sent, {} received)'
+            .format(name, 'timed out' if converged is None
+                else '{:.2f}s'.format(converged), report['daemons'],
+                report['announces_sent'], report['announces_received']),
+            flush=True)
+        return report
+
+def main():
+    count = 10
+    affected = None
+    interval = 1
+    ttl = None
+    net_port = 15151
+    control_port = 20771
+    report_path = None
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'n:k:i:t:P:C:o:')
+    for optname, optvalue in opts:
+        if optname == '-n':
+            count = int(optvalue)
+        elif optname == '-k':
+            affected = int(optvalue)
+        elif optname == '-i':
+            interval = float(optvalue)
+        elif optname == '-t':
+            ttl = float(optvalue)
+        elif optname == '-P':
+            net_port = int(optvalue)
+        elif optname == '-C':
+            control_port = int(optvalue)
+        elif optname == '-o':
+            report_path = optvalue
+
+    if affected is None:
+        affected = max(1, count // 5)
+    if ttl is None:
+        ttl = 3 * interval
+    if 2 * affected > count:
+        print('Only {} daemons can be affected out of {}'.format(count // 2,
+            count), file=sys.stderr)
+        return 1
+
+    # Nothing should take much longer than a daemon expiring, plus an
+    # interval for every daemon to announce itself again
+    timeout = ttl + 5 * interval + START_TIMEOUT
+
+    config_dir = tempfile.TemporaryDirectory()
+    daemons = []
+    for index in range(count):
+        config_path = os.path.join(config_dir.name, 'lnsd-{}.conf'.format(
+            index))
+        with open(config_path, 'w') as config:
+            config.write('[lnsd]\n')
+            config.write('net_address={}\n'.format(make_address(index)))
+            config.write('broadcast_address={}\n'.format(','.join(
+                make_address(peer) for peer in range(count))))
+            config.write('announce_interval={}\n'.format(interval))
+            config.write('announce_ttl={}\n'.format(ttl))
+        daemons.append(Daemon(index, config_path, net_port,
+            control_port + index))
+
+    cluster = Cluster(daemons)
+    killed = daemons[:affected]
+    renamed = daemons[affected:2 * affected]
+
+    def kill():
+        for daemon in killed:
+            cluster.stop(daemon, signal.SIGKILL)
+
+    def rename():
+        for daemon in renamed:
+            cluster.stop(daemon)
+            daemon.name += '-renamed'
+        cluster.start(renamed)
+
+    reports = []
+    try:
+        reports.append(cluster.run_phase('start',
+            lambda: cluster.start(daemons), timeout))
+        reports.append(cluster.run_phase('kill', kill, timeout))
+        reports.append(cluster.run_phase('rename', rename, timeout))
+        reports.append(cluster.run_phase('restart',
+            lambda: cluster.start(killed), timeout))
+    finally:
+        for daemon in cluster.get_running():
+            daemon.stop()
+        config_dir.cleanup()
+
+    if report_path is not None:
+        with open(report_path, 'w') as report_file:
+            json.dump({'daemons': count, 'affected': affected,
+                'interval': interval, 'ttl': ttl, 'phases': reports},
+                report_file, indent=4, sort_keys=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Puts a control server under load from many concurrent connections, and
+reports its throughput and latency percentiles.
+
+Each connection is either persistent, keeping a number of requests in flight
+at once (pipelining them), or makes a new connection for every request. The
+requests are a mix of HOST, IP and GET-ALL lookups, for hosts which are
+known to the server. The connections are spread over several processes, so
+that the load generator doesn't run out of CPU before the server does.
+
+By default, the server is started in a child process, on the chosen reactor
+backend (see lns.reactor), serving a table of synthetic hosts. Give -p or
+-u to load a running lnsd instead.
+
+    python3 bench/loadgen.py [-p port | -u path | -r backend [-U]] [-n hosts]
+                             [-c connections] [-w processes] [-P depth]
+                             [-C fraction] [-m mix] [-d seconds] [-o report]
+
+Options:
+
+    -p PORT, -u PATH  Loads a running lnsd at a TCP port, or a Unix socket.
+    -r BACKEND        The reactor that the child server runs on: default,
+                      asyncio, or a platform's own (epoll, poll or select).
+    -U                Connects to the child server through its Unix socket.
+    -n HOSTS          How many hosts the child server knows (default: 1000).
+                      When loading lnsd, lookups are for lnsd's own hosts.
+    -c CONNECTIONS    How many connections are open at once (default: 64).
+    -w PROCESSES      How many processes the connections are spread over
+                      (default: 4).
+    -P DEPTH          How many requests each persistent connection keeps in
+                      flight (default: 1).
+    -C FRACTION       The fraction of connections that connect for every
+                      request (default: 0).
+    -m MIX            The weight of each kind of request, as host=N,ip=N,all=N
+                      (default: host=10,ip=10,all=1).
+    -d SECONDS        How long to generate load for (default: 5).
+    -o REPORT         Also writes the report as JSON to the given file.
+"""
+from array import array
+from collections import deque
+import getopt
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lns import control_proto, net_proto, reactor
+
+BACKENDS = {'default': 'Reactor', 'asyncio': 'AsyncioReactor',
+    'epoll': 'LinuxReactor', 'poll': 'PollReactor', 'select': 'SelectReactor'}
+
+REQUEST_KINDS = ('host', 'ip', 'all')
+
+# GET-ALL replies can be split over several messages, and only the last one
+# finishes the request
+ALL_KIND = REQUEST_KINDS.index('all')
+
+def make_ip(i):
+    "Gets a distinct IPv4 address for each integer."
+    return '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256)
+
+def run_server(backend, hosts, path, port_pipe):
+    "Runs a control server until a client tells it to quit."
+    my_reactor = getattr(reactor, BACKENDS[backend])()
+    net_handler = net_proto.ProtocolHandler(my_reactor, 'loadgen')
+    for i in range(hosts):
+        net_handler.peers.set_host(make_ip(i), 'host-{}'.format(i))
+    net_handler.peers.publish_snapshot()
+
+    control_handler = control_proto.ProtocolHandler(net_handler, my_reactor,
+        port=0, path=path, max_clients=1 << 16)
+    control_handler.open()
+    _, port = control_handler.server_sock.getsockname()
+    port_pipe.send(port)
+
+    while control_handler.is_running():
+        my_reactor.poll(None)
+    control_handler.close()
+
+def start_server(backend, hosts, path):
+    """
+    Starts a control server in a child process, returning the port that it is
+    listening on and a function which stops it.
+    """
+    port_reader, port_writer = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=run_server,
+        args=(backend, hosts, path, port_writer))
+    server.start()
+    port = port_reader.recv()
+
+    def stop():
+        with control_proto.ClientHandler(port) as client:
+            client.terminate()
+        server.join()
+    return port, stop
+
+def build_requests(host_to_ips, mix, rng, count=1000):
+    """
+    Serializes a shuffled pool of requests in the given mix, each paired
+    with the index of its kind, so that sending them costs nothing.
+    """
+    hosts = sorted(host_to_ips)
+    kinds = [kind for kind in REQUEST_KINDS for _ in range(mix[kind])]
+
+    requests = []
+    for _ in range(count):
+        kind = rng.choice(kinds)
+        host = rng.choice(hosts)
+        if kind == 'host':
+            message = control_proto.Host(host)
+        elif kind == 'ip':
+            message = control_proto.IP([host_to_ips[host][0]])
+        else:
+            message = control_proto.GetAll()
+        requests.append((REQUEST_KINDS.index(kind), message.serialize()))
+    return requests
+
+class Connection:
+    """
+    A connection to the server, which sends requests and times their
+    replies.
+    """
+    def __init__(self, generator, persistent):
+        self.generator = generator
+        self.persistent = persistent
+        self.sock = None
+        self.buffer = b''
+
+        # The kind and send time of each request waiting for a reply, oldest
+        # first
+        self.in_flight = deque()
+
+    def connect(self):
+        """
+        Opens the connection, and sends as many requests as it keeps in
+        flight.
+        """
+        self.sock = self.generator.make_socket()
+        self.buffer = b''
+        self.generator.selector.register(self.sock, selectors.EVENT_READ,
+            self)
+        for _ in range(self.generator.depth if self.persistent else 1):
+            self.send_request()
+
+    def close(self):
+        """
+        Closes the connection.
+        """
+        self.generator.selector.unregister(self.sock)
+        self.sock.close()
+        self.in_flight.clear()
+
+    def send_request(self):
+        """
+        Sends the next request from the pool.
+        """
+        kind, data = self.generator.next_request()
+        self.in_flight.append((kind, time.perf_counter()))
+        self.sock.sendall(data)
+
+    def on_readable(self):
+        """
+        Reads replies, and sends a new request for each one.
+        """
+        try:
+            data = self.sock.recv(65536)
+        except OSError:
+            data = b''
+
+        if not data:
+            self.generator.errors += 1
+            self.close()
+            self.connect()
+            return
+
+        buffer = self.buffer + data
+        while len(buffer) >= 2:
+            length, = struct.unpack_from('H', buffer)
+            if len(buffer) < 2 + length:
+                break
+            frame = buffer[2:2 + length]
+            buffer = buffer[2 + length:]
+
+            if not self.in_flight:
+                # A reply to nothing that was asked - the server is confused,
+                # so start over rather than time the wrong requests
+                self.generator.errors += 1
+                self.close()
+                self.connect()
+                return
+
+            kind, started = self.in_flight[0]
+            if kind == ALL_KIND and json.loads(frame.decode('utf-8')).get(
+                    'more', False):
+                continue
+
+            self.in_flight.popleft()
+            self.generator.record(kind, time.perf_counter() - started)
+            if self.persistent:
+                self.send_request()
+            else:
+                self.close()
+                self.connect()
+                return
+        self.buffer = buffer
+
+class LoadGenerator:
+    """
+    Runs a number of connections against the server from one process.
+    """
+    def __init__(self, address, family, requests, connections, depth,
+            per_request):
+        self.address = address
+        self.family = family
+        self.requests = requests
+        self.next_index = 0
+        self.depth = depth
+        self.selector = selectors.DefaultSelector()
+        self.errors = 0
+
+        # The latencies of each kind of request, in seconds
+        self.latencies = [array('d') for _ in REQUEST_KINDS]
+        self.recording = False
+
+        self.connections = [Connection(self, index >= per_request)
+            for index in range(connections)]
+
+    def make_socket(self):
+        "Connects a new socket to the server."
+        sock = socket.socket(self.family)
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(self.address)
+        return sock
+
+    def next_request(self):
+        "Gets the next request in the pool."
+        request = self.requests[self.next_index]
+        self.next_index = (self.next_index + 1) % len(self.requests)
+        return request
+
+    def record(self, kind, latency):
+        "Records the latency of a request, once the warmup is over."
+        if self.recording:
+            self.latencies[kind].append(latency)
+
+    def run(self, duration, warmup):
+        """
+        Generates load for the given number of seconds, after a warmup whose
+        replies aren't counted, and returns the latencies.
+        """
+        for connection in self.connections:
+            connection.connect()
+
+        start = time.perf_counter()
+        end = start + warmup + duration
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            self.recording = now >= start + warmup
+
+            for key, _ in self.selector.select(0.1):
+                key.data.on_readable()
+
+        for connection in self.connections:
+            connection.close()
+        return self.latencies, self.errors
+
+def run_generator(args, results):
+    "Runs a LoadGenerator in a child process, sending back its results."
+    address, family, requests, connections, depth, per_request, duration, \
+        warmup = args
+    generator = LoadGenerator(address, family, requests, connections, depth,
+        per_request)
+    latencies, errors = generator.run(duration, warmup)
+    results.send(([latency.tobytes() for latency in latencies], errors))
+
+def percentile(ordered, fraction):
+    "Gets a percentile of a sorted list."
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def summarize(latencies, duration):
+    "Gets the throughput and latency percentiles (in microseconds) of a list."
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'requests': 0, 'throughput': 0}
+
+    return {'requests': len(latencies),
+        'throughput': len(latencies) / duration,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'p999_us': percentile(latencies, 0.999) * 1e6}
+
+def parse_mix(text):
+    "Parses a mix like host=10,ip=10,all=1 into a map of weights."
+    mix = dict.fromkeys(REQUEST_KINDS, 0)
+    for entry in text.split(','):
+        kind, _, weight = entry.partition('=')
+        if kind not in mix:
+            raise ValueError('Unknown request kind ' + kind)
+        mix[kind] = int(weight)
+    return mix
+
+def main():
+    port = None
+    path = None
+    backend = 'default'
+    use_unix = False
+    hosts = 1000
+    connections = 64
+    processes = 4
+    depth = 1
+    per_request_fraction = 0
+    mix = {'host': 10, 'ip': 10, 'all': 1}
+    duration = 5
+    warmup = 1
+    report_path = None
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'p:u:r:Un:c:w:P:C:m:d:o:')
+    for optname, optvalue in opts:
+        if optname == '-p':
+            port = int(optvalue)
+        elif optname == '-u':
+            path = optvalue
+        elif optname == '-r':
+            backend = optvalue
+        elif optname == '-U':
+            use_unix = True
+        elif optname == '-n':
+            hosts = int(optvalue)
+        elif optname == '-c':
+            connections = int(optvalue)
+        elif optname == '-w':
+            processes = int(optvalue)
+        elif optname == '-P':
+            depth = int(optvalue)
+        elif optname == '-C':
+            per_request_fraction = float(optvalue)
+        elif optname == '-m':
+            mix = parse_mix(optvalue)
+        elif optname == '-d':
+            duration = float(optvalue)
+        elif optname == '-o':
+            report_path = optvalue
+
+    if backend not in BACKENDS or not hasattr(reactor, BACKENDS[backend]):
+        print('Reactor backend', backend, 'is not available here',
+            file=sys.stderr)
+        return 1
+
+    stop = None
+    socket_dir = tempfile.TemporaryDirectory()
+    if port is None and path is None:
+        server_path = (os.path.join(socket_dir.name, 'lnsd.sock')
+            if use_unix else None)
+        port, stop = start_server(backend, hosts, server_path)
+        path = server_path
+        target = {'server': 'child', 'backend': backend}
+    else:
+        target = {'server': 'lnsd'}
+
+    try:
+        with control_proto.ClientHandler(port or control_proto.CONTROL_PORT,
+                path) as client:
+            host_to_ips = client.get_host_ip_mapping()
+        if not host_to_ips:
+            print('The server knows no hosts to look up', file=sys.stderr)
+            return 1
+
+        if path is not None:
+            address, family = path, socket.AF_UNIX
+        else:
+            address, family = ('localhost', port), socket.AF_INET
+        target['endpoint'] = 'unix' if path is not None else 'tcp'
+
+        # Spread the connections (and the connect-per-request ones among
+        # them) as evenly as possible over the processes
+        per_request = round(per_request_fraction * connections)
+        children = []
+        for index in range(processes):
+            share = connections // processes + (
+                index < connections % processes)
+            share_per_request = per_request // processes + (
+                index < per_request % processes)
+            requests = build_requests(host_to_ips, mix, random.Random(index))
+
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            child = multiprocessing.Process(target=run_generator, args=(
+                (address, family, requests, share, depth,
+                 min(share_per_request, share), duration, warmup),
+                writer))
+            child.start()
+            children.append((child, reader))
+
+        latencies = [array('d') for _ in REQUEST_KINDS]
+        errors = 0
+        for child, reader in children:
+            child_latencies, child_errors = reader.recv()
+            child.join()
+            for kind, data in enumerate(child_latencies):
+                latencies[kind].frombytes(data)
+            errors += child_errors
+    finally:
+        if stop is not None:
+            stop()
+        socket_dir.cleanup()
+
+    report = dict(target, encoding='json', connections=connections,
+        processes=processes, depth=depth, per_request=per_request,
+        mix=mix, duration=duration, errors=errors)
+    report['total'] = summarize([latency for kind in latencies
+        for latency in kind], duration)
+    for kind, kind_latencies in zip(REQUEST_KINDS, latencies):
+        report[kind] = summarize(kind_latencies, duration)
+
+    for kind in REQUEST_KINDS + ('total',):
+        summary = report[kind]
+        if not summary['requests']:
+            continue
+        print('{:6s} {:10.0f} req/s   p50 {:8.1f}us   p99 {:8.1f}us   '
+            'p999 {:8.1f}us'.format(kind, summary['throughput'],
+                summary['p50_us'], summary['p99_us'], summary['p999_us']))
+    if errors:
+        print('{} connections were dropped by the server'.format(errors))
+
+    if report_path is not None:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=4, sort_keys=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Times the functions that lnsd runs for every message, and compares them
+against a saved baseline, so that changes to them can be judged by numbers.
+
+Each benchmark is reported in nanoseconds per operation (the fastest of
+several runs, less the cost of calling an empty function), along with the
+bytes that one operation allocates at its peak, as seen by tracemalloc.
+Python doesn't count allocations themselves, so the bytes stand in for them.
+
+    python3 bench/microbench.py [-b baseline] [-t threshold] [-s] [-o results]
+                                [-k name,name,...]
+
+Options:
+
+    -b BASELINE   The saved results to compare against (default:
+                  microbench_baseline.json, next to this script).
+    -t THRESHOLD  How much slower than the baseline a benchmark can get
+                  before it counts as a regression, as a fraction (default:
+                  0.2). Any regression makes the script exit with status 1.
+    -s            Saves these results as the new baseline.
+    -o RESULTS    Also writes these results as JSON to the given file.
+    -k NAMES      Only runs the named benchmarks.
+
+Baselines are only comparable on the machine (and Python) they were saved
+on, so save one before starting work on these functions.
+"""
+import getopt
+import io
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lns import control_proto, net_proto, reactor, utils
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__),
+    'microbench_baseline.json')
+
+# How long each run of a benchmark should take, in seconds, and how many runs
+# the fastest is picked from
+RUN_TIME = 0.1
+RUNS = 3
+
+# How many times the whole suite is run. Each benchmark gets its fastest time
+# over every round, so that a stretch where the machine is busy with
+# something else doesn't count against whichever benchmark was running then.
+ROUNDS = 5
+
+# How many single operations are traced to find the bytes each allocates
+ALLOC_SAMPLES = 100
+
+# How many sockets are ready in each poll of the reactor dispatch benchmark
+DISPATCH_EVENTS = 16
+
+def bench_announce_serialize():
+    message = net_proto.Announce('host-1234.example')
+    return message.serialize, 1, None
+
+def bench_announce_unserialize():
+    packet = net_proto.Announce('host-1234.example').serialize()
+    return lambda: net_proto.Announce.unserialize(packet), 1, None
+
+def bench_verify_hostname():
+    hostname = b'host-1234.example'
+    return lambda: net_proto.verify_hostname(hostname), 1, None
+
+def bench_verify_ipv4_address():
+    return (lambda: control_proto.verify_ipv4_address('192.168.100.200'), 1,
+        None)
+
+def bench_length_encode_json():
+    data = {'type': 'ip', 'ip_addrs': ['192.168.100.200']}
+    return lambda: control_proto.length_encode_json(data), 1, None
+
+def bench_get_length_encoded_json():
+    encoded = control_proto.Host('host-1234.example').serialize()
+    return (lambda: control_proto.get_length_encoded_json(
+        io.BytesIO(encoded)), 1, None)
+
+def bench_get_message_class():
+    # The classes are tried in the order of a set, which changes from one
+    # process to the next, so every type is dispatched to even that out
+    messages = [{'type': message_class.TYPE}
+        for message_class in control_proto.MESSAGE_CLASSES]
+    def dispatch():
+        for data in messages:
+            control_proto.get_message_class(data)
+    return dispatch, len(messages), None
+
+def bench_transaction():
+    # The way handle_messages reads one packet out of a peer's buffer
+    buffer = net_proto.Announce('host-1234.example').serialize() * 2
+    def transaction():
+        stream = utils.TransactionalBytesIO(buffer)
+        with stream.get_transaction() as txn:
+            txn.get_stream().read(net_proto.PACKET_SIZE)
+            txn.commit()
+    return transaction, 1, None
+
+def bench_reactor_dispatch():
+    # Every socket stays readable, since nothing reads it, so each poll
+    # dispatches one callback per socket
+    my_reactor = reactor.Reactor()
+    pairs = [socket.socketpair() for _ in range(DISPATCH_EVENTS)]
+    for reader, writer in pairs:
+        writer.send(b'x')
+        my_reactor.bind(reader, reactor.READABLE, lambda event: None)
+
+    def cleanup():
+        for reader, writer in pairs:
+            my_reactor.unbind(reader)
+            reader.close()
+            writer.close()
+        my_reactor.close()
+    return lambda: my_reactor.poll(0), DISPATCH_EVENTS, cleanup
+
+BENCHMARKS = {
+    'announce_serialize': bench_announce_serialize,
+    'announce_unserialize': bench_announce_unserialize,
+    'verify_hostname': bench_verify_hostname,
+    'verify_ipv4_address': bench_verify_ipv4_address,
+    'length_encode_json': bench_length_encode_json,
+    'get_length_encoded_json': bench_get_length_encoded_json,
+    'get_message_class': bench_get_message_class,
+    'transaction': bench_transaction,
+    'reactor_dispatch': bench_reactor_dispatch,
+}
+
+def time_calls(func, calls):
+    "Gets the seconds taken to call a function the given number of times."
+    loop = range(calls)
+    started = time.perf_counter()
+    for _ in loop:
+        func()
+    return time.perf_counter() - started
+
+def measure_time(func):
+    "Gets the fastest time of a single call to a function, in seconds."
+    calls = 1
+    while time_calls(func, calls) < RUN_TIME / 10:
+        calls *= 2
+    calls = max(1, int(calls * RUN_TIME / 10 / time_calls(func, calls) * 10))
+
+    return min(time_calls(func, calls) for _ in range(RUNS)) / calls
+
+def measure_allocations(func):
+    "Gets the median number of bytes allocated at the peak of a single call."
+    func()
+    samples = []
+    tracemalloc.start()
+    for _ in range(ALLOC_SAMPLES):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        samples.append(peak - before)
+    tracemalloc.stop()
+
+    samples.sort()
+    return samples[len(samples) // 2]
+
+def run_benchmarks(names):
+    "Runs the named benchmarks, returning the results of each."
+    times = dict.fromkeys(names + ['overhead'], float('inf'))
+    allocations = {}
+    for _ in range(ROUNDS):
+        times['overhead'] = min(times['overhead'],
+            measure_time(lambda: None))
+
+        for name in names:
+            func, per_call, cleanup = BENCHMARKS[name]()
+            try:
+                times[name] = min(times[name], measure_time(func) / per_call)
+                if name not in allocations:
+                    allocations[name] = measure_allocations(func) / per_call
+            finally:
+                if cleanup is not None:
+                    cleanup()
+
+    return {name: {
+            'ns_per_op': max(times[name] - times['overhead'], 0) * 1e9,
+            'bytes_per_op': allocations[name]}
+        for name in names}
+
+def compare(results, baseline, threshold):
+    """
+    Prints each result next to its baseline, returning the names of the
+    benchmarks which have slowed down by more than the threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        line = '{:24s} {:10.1f} ns/op {:8.0f} B/op'.format(name,
+            result['ns_per_op'], result['bytes_per_op'])
+
+        base = baseline.get(name)
+        if base is not None and base['ns_per_op'] > 0:
+            change = result['ns_per_op'] / base['ns_per_op'] - 1
+            line += '   {:+6.1%} vs {:.1f} ns/op'.format(change,
+                base['ns_per_op'])
+            if change > threshold:
+                line += '   REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+def main():
+    baseline_path = BASELINE_PATH
+    threshold = 0.2
+    save = False
+    results_path = None
+    names = list(BENCHMARKS)
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'b:t:so:k:')
+    for optname, optvalue in opts:
+        if optname == '-b':
+            baseline_path = optvalue
+        elif optname == '-t':
+            threshold = float(optvalue)
+        elif optname == '-s':
+            save = True
+        elif optname == '-o':
+            results_path = optvalue
+        elif optname == '-k':
+            names = optvalue.split(',')
+
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        print('Unknown benchmarks:', ', '.join(sorted(unknown)),
+            file=sys.stderr)
+        return 1
+
+    baseline = {}
+    if not save and os.path.exists(baseline_path):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    results = run_benchmarks(names)
+    regressions = compare(results, baseline, threshold)
+
+    report = {'python': platform.python_version(),
+        'machine': platform.machine(), 'results': results}
+    if results_path is not None:
+        with open(results_path, 'w') as results_file:
+            json.dump(report, results_file, indent=4, sort_keys=True)
+    if save:
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=4, sort_keys=True)
+
+    if regressions:
+        print('Slower than the baseline by more than {:.0%}: {}'.format(
+            threshold, ', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
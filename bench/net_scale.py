@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Measures how the network protocol handler copes with more and more peers,
+by running it against a simulated network (see lns.sim) of each size.
+
+For each number of peers, this prints one line of JSON with the CPU time
+spent per received packet, the CPU time of each expiry pass, the memory used
+per peer, and the latency of host and address lookups once the simulation
+has finished.
+
+    python3 bench/net_scale.py [-n peers,peers,...] [-d seconds] [-c churn]
+                               [-r renames] [-l loss] [-u duplicates]
+                               [-s seed]
+"""
+import getopt
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lns import net_proto, sim
+
+LOOKUPS = 10000
+
+def percentile(ordered, fraction):
+    "Gets a percentile of a sorted list."
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def measure_memory(peers):
+    """
+    Gets the number of bytes that the handler allocates for each peer, once
+    every peer has announced itself.
+    """
+    clock = sim.VirtualClock()
+    sock = sim.SimSocket()
+    handler = net_proto.ProtocolHandler(None, 'sim', clock=clock)
+    handler.server_sock = sock
+    packets = [(sim.make_ip(i), net_proto.Announce(
+        'peer-{}'.format(i)).serialize()) for i in range(peers)]
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for ip, packet in packets:
+        sock.deliver(packet, ip)
+        handler.on_message(None)
+    handler.peers.publish_snapshot()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (after - before) / peers
+
+def measure_lookups(simulator):
+    """
+    Gets the median and 99th percentile latency of host and address lookups
+    against the handler, in nanoseconds.
+    """
+    handler = simulator.handler
+    rng = simulator.random
+    peers = [rng.choice(simulator.peers) for _ in range(LOOKUPS)]
+
+    results = {}
+    for kind, lookup, keys in (
+            ('host', handler.query_host, [peer.hostname for peer in peers]),
+            ('ip', handler.query_ip, [peer.ip for peer in peers])):
+        latencies = []
+        for key in keys:
+            started = time.perf_counter_ns()
+            lookup(key)
+            latencies.append(time.perf_counter_ns() - started)
+
+        latencies.sort()
+        results['lookup_{}_p50_ns'.format(kind)] = percentile(latencies, 0.5)
+        results['lookup_{}_p99_ns'.format(kind)] = percentile(latencies, 0.99)
+    return results
+
+def run(peers, duration, churn, renames, loss, duplicates, seed):
+    "Simulates the given number of peers, returning a report."
+    simulator = sim.NetworkSimulator(peers, churn=churn, renames=renames,
+        loss=loss, duplicates=duplicates, seed=seed)
+    stats = simulator.run(duration)
+
+    report = {'peers': peers, 'duration': duration, 'churn': churn,
+        'renames': renames, 'loss': loss, 'duplicates': duplicates,
+        'seed': seed, 'python': platform.python_version(),
+        'table_size': len(simulator.handler.peers.ip_to_host)}
+    report.update(stats.as_dict())
+    report.update(measure_lookups(simulator))
+    report['memory_per_peer'] = measure_memory(peers)
+    return report
+
+def main():
+    sizes = [100, 1000, 10000, 100000]
+    duration = 60
+    churn = 0.01
+    renames = 0.01
+    loss = 0.01
+    duplicates = 0.01
+    seed = 0
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'n:d:c:r:l:u:s:')
+    for optname, optvalue in opts:
+        if optname == '-n':
+            sizes = [int(size) for size in optvalue.split(',')]
+        elif optname == '-d':
+            duration = float(optvalue)
+        elif optname == '-c':
+            churn = float(optvalue)
+        elif optname == '-r':
+            renames = float(optvalue)
+        elif optname == '-l':
+            loss = float(optvalue)
+        elif optname == '-u':
+            duplicates = float(optvalue)
+        elif optname == '-s':
+            seed = int(optvalue)
+
+    for peers in sizes:
+        report = run(peers, duration, churn, renames, loss, duplicates, seed)
+        print(json.dumps(report, sort_keys=True), flush=True)
+
+if __name__ == '__main__':
+    main()
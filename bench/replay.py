@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Replays a packet trace recorded by lnsd (see the trace_file option) into a
+network protocol handler, to reproduce what lnsd saw, and to measure how fast
+the handler gets through real traffic.
+
+The handler runs on the trace's own time, so it ends up with the same
+host-name mapping however fast the trace is replayed. This reports how many
+datagrams per second were replayed, and the CPU time the handler spent on
+each, and can compare the mapping it ends up with against a saved one, or
+that of a running lnsd.
+
+    python3 bench/replay.py [-x speed] [-n name] [-o table] [-e table]
+                            [-p control-port] TRACE
+
+Options:
+
+    -x SPEED         Replays the datagrams this many times faster than they
+                     arrived (1 being the original speed). By default, they
+                     are replayed as fast as possible.
+    -n NAME          The name of the replaying handler, which shouldn't be the
+                     name of any host in the trace (default: replay).
+    -o TABLE         Writes the mapping the handler ends up with as JSON to
+                     the given file.
+    -e TABLE         Compares the mapping against one written by -o, and exits
+                     with status 1 if they differ.
+    -p CONTROL_PORT  Compares the mapping against that of the lnsd with the
+                     given control port, and exits with status 1 if they
+                     differ.
+"""
+import getopt
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lns import control_proto, trace
+
+def compare(mapping, expected, description):
+    """
+    Prints the hosts whose addresses differ between the mapping and the
+    expected one, returning whether there were any.
+    """
+    differences = 0
+    for host in sorted(set(mapping) | set(expected)):
+        ips = sorted(mapping.get(host, []))
+        expected_ips = sorted(expected.get(host, []))
+        if ips != expected_ips:
+            print('{}: {} (replayed) vs {} ({})'.format(host,
+                ', '.join(ips) or 'missing',
+                ', '.join(expected_ips) or 'missing', description))
+            differences += 1
+
+    if differences:
+        print('{} hosts differ from {}'.format(differences, description))
+    else:
+        print('The mapping matches {}'.format(description))
+    return differences > 0
+
+def main():
+    speed = None
+    hostname = 'replay'
+    table_path = None
+    expected_path = None
+    control_port = None
+
+    opts, args = getopt.getopt(sys.argv[1:], 'x:n:o:e:p:')
+    for optname, optvalue in opts:
+        if optname == '-x':
+            speed = float(optvalue)
+        elif optname == '-n':
+            hostname = optvalue
+        elif optname == '-o':
+            table_path = optvalue
+        elif optname == '-e':
+            expected_path = optvalue
+        elif optname == '-p':
+            control_port = int(optvalue)
+
+    if len(args) != 1:
+        print(__doc__, file=sys.stderr)
+        return 1
+
+    try:
+        replayer = trace.Replayer(trace.read_trace(args[0]), hostname,
+            speed=speed)
+        handler = replayer.run()
+    except (OSError, ValueError) as err:
+        print('Cannot replay {}: {}'.format(args[0], err), file=sys.stderr)
+        return 1
+
+    if handler is None:
+        print('{} has no datagrams in it'.format(args[0]), file=sys.stderr)
+        return 1
+
+    print('{} datagrams over {:.1f}s of trace, replayed in {:.2f}s '
+        '({:.0f} per second, {:.1f} us of CPU each)'.format(replayer.packets,
+            replayer.clock() - replayer.first_timestamp, replayer.elapsed,
+            replayer.packets / replayer.elapsed if replayer.elapsed else 0,
+            replayer.receive_time / replayer.packets * 1e6))
+
+    mapping = handler.get_host_ip_map()
+    print('{} hosts known at the end of the trace'.format(len(mapping)))
+    if table_path is not None:
+        with open(table_path, 'w') as table_file:
+            json.dump(mapping, table_file, indent=4, sort_keys=True)
+
+    differs = False
+    if expected_path is not None:
+        with open(expected_path) as expected_file:
+            differs |= compare(mapping, json.load(expected_file),
+                expected_path)
+    if control_port is not None:
+        with control_proto.ClientHandler(control_port) as client:
+            differs |= compare(mapping, client.get_host_ip_mapping(),
+                'lnsd on port {}'.format(control_port))
+
+    return 1 if differs else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Measures how many lookups per second reader threads can make against peer
+table snapshots, while another thread keeps changing the table and
+publishing new snapshots.
+
+    python3 bench/snapshot_reads.py [-t max-threads] [-d seconds] [-n hosts]
+"""
+import getopt
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lns import net_proto
+
+def make_ip(i):
+    "Gets a distinct IPv4 address for each integer."
+    return '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256)
+
+def writer(peers, hosts, done, published):
+    "Renames hosts in batches, publishing a snapshot after each batch."
+    i = 0
+    while not done.is_set():
+        for _ in range(10):
+            peers.set_host(make_ip(i % hosts), 'renamed-{}'.format(i))
+            i += 1
+        peers.publish_snapshot()
+        published[0] += 1
+        time.sleep(0.001)
+
+def reader(peers, hosts, done, counts, index):
+    "Looks up addresses in whatever snapshot is current, counting lookups."
+    lookups = 0
+    i = index
+    while not done.is_set():
+        snapshot = peers.snapshot
+        for _ in range(100):
+            snapshot.query_ip(make_ip(i % hosts))
+            i += 7
+        lookups += 100
+    counts[index] = lookups
+
+def run(threads, hosts, duration):
+    "Runs the given number of readers for a while, returning lookups/second."
+    peers = net_proto.PeerTable()
+    for i in range(hosts):
+        peers.set_host(make_ip(i), 'host-{}'.format(i))
+    peers.publish_snapshot()
+
+    done = threading.Event()
+    published = [0]
+    counts = [0] * threads
+    workers = [threading.Thread(target=writer,
+        args=(peers, hosts, done, published))]
+    workers += [threading.Thread(target=reader,
+        args=(peers, hosts, done, counts, index))
+        for index in range(threads)]
+
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    done.set()
+    for worker in workers:
+        worker.join()
+
+    return sum(counts) / duration, published[0] / duration
+
+def main():
+    max_threads = 8
+    duration = 2
+    hosts = 10000
+
+    opts, _ = getopt.getopt(sys.argv[1:], 't:d:n:')
+    for optname, optvalue in opts:
+        if optname == '-t':
+            max_threads = int(optvalue)
+        elif optname == '-d':
+            duration = float(optvalue)
+        elif optname == '-n':
+            hosts = int(optvalue)
+
+    threads = 1
+    while threads <= max_threads:
+        lookups, snapshots = run(threads, hosts, duration)
+        print('{:2d} readers: {:10.0f} lookups/s ({:.0f} snapshots/s)'.format(
+            threads, lookups, snapshots))
+        threads *= 2
+
+if __name__ == '__main__':
+    main()
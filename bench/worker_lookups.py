@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Measures how the lookups per second served on the control port scale with
+the number of worker processes.
+
+For each worker count, an owner process serves a table of synthetic hosts
+with that many workers (see lns/workers.py), and several client processes
+make blocking lookups against it as fast as they can.
+
+    python3 bench/worker_lookups.py [-w max-workers] [-c clients] [-d seconds]
+"""
+import getopt
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lns import control_proto, net_proto, reactor, shared_table, workers
+
+HOSTS = 1000
+BENCH_PORT = 4199
+
+def run_owner(worker_count, table_path, ready):
+    "Serves the control port with the given number of workers."
+    my_reactor = reactor.Reactor()
+    net_handler = net_proto.ProtocolHandler(my_reactor, 'bench')
+    for i in range(HOSTS):
+        net_handler.peers.set_host('10.0.{}.{}'.format(i // 256, i % 256),
+            'host-{}'.format(i))
+
+    publisher = shared_table.SharedTablePublisher(net_handler, my_reactor,
+        table_path)
+    control_handler = control_proto.ProtocolHandler(net_handler, my_reactor,
+        port=BENCH_PORT, reuse_port=True)
+    supervisor = workers.WorkerSupervisor(my_reactor, worker_count,
+        BENCH_PORT, table_path)
+
+    publisher.open()
+    control_handler.open()
+    supervisor.open()
+    signal.signal(signal.SIGTERM, lambda signum, frame:
+        my_reactor.call_soon_threadsafe(control_handler.stop))
+    ready.set()
+
+    while control_handler.is_running():
+        my_reactor.poll(None)
+
+    supervisor.close()
+    control_handler.close()
+    publisher.close()
+
+def run_client(deadline, counts, index):
+    "Makes lookups on a few connections until the deadline passes."
+    clients = [control_proto.ClientHandler(BENCH_PORT) for _ in range(4)]
+    for client in clients:
+        client.open()
+
+    lookups = 0
+    while time.time() < deadline:
+        for client in clients:
+            client.get_ip('host-{}'.format(lookups % HOSTS))
+            lookups += 1
+    counts[index] = lookups
+
+def measure(worker_count, client_count, duration):
+    "Gets the lookups per second served with the given number of workers."
+    with tempfile.TemporaryDirectory() as table_dir:
+        ready = multiprocessing.Event()
+        owner = multiprocessing.Process(target=run_owner,
+            args=(worker_count, os.path.join(table_dir, 'lnsd.table'), ready))
+        owner.start()
+        ready.wait()
+        # Give the workers a moment to bind the port
+        time.sleep(0.5)
+
+        counts = multiprocessing.Array('l', client_count)
+        deadline = time.time() + duration
+        clients = [multiprocessing.Process(target=run_client,
+            args=(deadline, counts, index)) for index in range(client_count)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+
+        with control_proto.ClientHandler(BENCH_PORT) as client:
+            client.terminate()
+        owner.join()
+        return sum(counts) / duration
+
+def main():
+    max_workers = os.cpu_count() or 1
+    client_count = max_workers
+    duration = 3
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'w:c:d:')
+    for optname, optvalue in opts:
+        if optname == '-w':
+            max_workers = int(optvalue)
+        elif optname == '-c':
+            client_count = int(optvalue)
+        elif optname == '-d':
+            duration = float(optvalue)
+
+    worker_count = 0
+    while worker_count <= max_workers:
+        lookups = measure(worker_count, client_count, duration)
+        print('{:3d} workers: {:10.0f} lookups/s'.format(worker_count,
+            lookups))
+        worker_count = worker_count * 2 if worker_count else 1
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,10 @@
 -- Wireshark's license.
 --
 -- Adam Marchetti <adamnew123456@gmail.com>
+--
+-- This also decodes the packet traces that lnsd records (see its trace_file
+-- option), which can be opened directly. The NUL padding at the end of each
+-- announce isn't in those traces, so Wireshark marks them as cut short.
 lns_protocol = Proto("lns", "LAN Naming System")
 
 local LNS_ANNOUNCE = 1
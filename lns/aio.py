@@ -0,0 +1,417 @@
+"""
+Asyncio Support
+---------------
+
+This provides a client for the control protocol which can be used from
+within an asyncio event loop, without blocking the loop or pushing lookups
+onto other threads.
+
+Since the server answers each client's requests in the order they were sent,
+several requests can be outstanding on one connection at once - each
+connection keeps a queue of the replies it is waiting for, and hands each
+reply to the request at the front of the queue. On top of that, the client
+keeps a small pool of connections, spreading requests between them and
+replacing any connection which is dropped.
+
+It also provides an :class:`EmbeddedServer`, which runs lnsd's protocol
+handlers inside an asyncio program so that the program can look up hosts
+in-process.
+"""
+import asyncio
+from collections import deque
+import io
+import logging
+import struct
+
+from lns import control_proto, net_proto, reactor
+
+LOGGER = logging.getLogger('lns.aio')
+
+# How many connections an asynchronous client opens at most
+ASYNC_POOL_SIZE = 4
+
+class AsyncConnection:
+    """
+    A single connection to the control server, which can have any number of
+    requests waiting for replies.
+    """
+    def __init__(self, port=control_proto.CONTROL_PORT, path=None):
+        self.port = port
+        self.path = path
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+
+        # Each request waiting on a reply, as (future, reply type) pairs in
+        # the order that the requests were sent
+        self.pending = deque()
+        self.closed = False
+
+        # The hosts from the parts of a split NameIPMapping reply which have
+        # arrived so far, or None if there is no reply in progress
+        self.partial_mapping = None
+
+    async def open(self):
+        """
+        Connects to the server, and starts reading replies.
+        """
+        if self.path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(
+                self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(
+                'localhost', self.port)
+
+        self.reader_task = asyncio.ensure_future(self.read_replies())
+
+    async def close(self):
+        """
+        Closes the connection, failing any requests still waiting on replies.
+        """
+        self.closed = True
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+        self.fail_pending(ConnectionError('Connection closed'))
+
+    def fail_pending(self, err):
+        """
+        Fails every request which is still waiting on a reply.
+        """
+        while self.pending:
+            future, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(err)
+
+    async def read_message(self):
+        """
+        Reads a JSON message of any type from the connection.
+        """
+        length_header = await self.reader.readexactly(2)
+        length = struct.unpack('H', length_header)[0]
+        recv_message_raw = await self.reader.readexactly(length)
+
+        json_data = control_proto.get_length_encoded_json(
+            io.BytesIO(length_header + recv_message_raw))
+        message_class = control_proto.get_message_class(json_data)
+        return message_class.unserialize(json_data)
+
+    async def read_replies(self):
+        """
+        Hands each reply from the server to the request waiting for it, until
+        the connection is closed.
+        """
+        try:
+            while True:
+                message = await self.read_message()
+                if type(message) is control_proto.NameIPMapping:
+                    message = self.join_mapping(message)
+                    if message is None:
+                        continue
+
+                if not self.pending:
+                    raise ValueError('Got a {} with no request waiting'.format(
+                        type(message)))
+
+                future, reply_type = self.pending.popleft()
+                if future.done():
+                    # The request was cancelled, but the server answered it
+                    # anyway
+                    continue
+
+                if type(message) is not reply_type:
+                    future.set_exception(ValueError(
+                        'Expected a {}, but got a {}'.format(reply_type,
+                            type(message))))
+                else:
+                    future.set_result(message)
+        except asyncio.CancelledError:
+            raise
+        except (OSError, ValueError, asyncio.IncompleteReadError) as err:
+            LOGGER.info('Lost connection to the server: %s', err)
+            self.closed = True
+            self.writer.close()
+            self.fail_pending(ConnectionError(str(err)))
+
+    def join_mapping(self, message):
+        """
+        Collects the parts of a :class:`lns.control_proto.NameIPMapping`
+        reply, producing the whole reply once the last part arrives, or
+        ``None`` until then.
+        """
+        if self.partial_mapping is None:
+            if not message.more:
+                return message
+            self.partial_mapping = {}
+
+        self.partial_mapping.update(message.host_to_ips)
+        if message.more:
+            return None
+
+        host_to_ips, self.partial_mapping = self.partial_mapping, None
+        return control_proto.NameIPMapping(host_to_ips)
+
+    async def send_and_await_reply(self, msg, reply_type):
+        """
+        Sends a message, and awaits a reply of a specific type.
+        """
+        if self.closed:
+            raise ConnectionError('Connection closed')
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((future, reply_type))
+        try:
+            self.writer.write(msg.serialize())
+            await self.writer.drain()
+        except OSError as err:
+            future.cancel()
+            raise ConnectionError(str(err))
+
+        return await future
+
+class AsyncClientHandler:
+    """
+    An asynchronous version of :class:`lns.control_proto.ClientHandler`,
+    which connects to the LNS control port (or the Unix control socket, if a
+    path is given) and can have many requests outstanding at once.
+
+    Up to ``pool_size`` connections are opened as they are needed, and any
+    connection which is dropped is replaced by a new one. Requests which
+    fail because their connection was dropped are retried once on another
+    connection.
+    """
+    def __init__(self, port=control_proto.CONTROL_PORT, path=None,
+            pool_size=ASYNC_POOL_SIZE):
+        self.port = port
+        self.path = path
+        self.pool_size = pool_size
+        self.connections = []
+
+        # Held while opening a connection, so that a burst of requests doesn't
+        # open more connections than the pool allows
+        self.connect_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        """
+        Opens the first connection to the server, so that an unreachable
+        server is reported right away.
+        """
+        await self.get_connection()
+
+    async def close(self):
+        """
+        Closes every connection.
+        """
+        connections, self.connections = self.connections, []
+        for connection in connections:
+            await connection.close()
+
+    async def open_connection(self):
+        """
+        Opens a new connection which is not part of the pool.
+        """
+        connection = AsyncConnection(self.port, self.path)
+        await connection.open()
+        return connection
+
+    async def get_connection(self):
+        """
+        Gets the pooled connection with the fewest outstanding requests,
+        opening a new one if every connection is busy and the pool isn't full.
+        """
+        self.connections = [connection for connection in self.connections
+            if not connection.closed]
+
+        async with self.connect_lock:
+            idle = [connection for connection in self.connections
+                if not connection.closed and not connection.pending]
+            if idle:
+                return idle[0]
+
+            if len(self.connections) < self.pool_size:
+                connection = await self.open_connection()
+                self.connections.append(connection)
+                return connection
+
+        return min(self.connections,
+            key=lambda connection: len(connection.pending))
+
+    async def send_and_await_reply(self, msg, reply_type):
+        """
+        Sends a message on one of the pooled connections, and awaits a reply
+        of a specific type.
+        """
+        connection = await self.get_connection()
+        try:
+            return await connection.send_and_await_reply(msg, reply_type)
+        except ConnectionError:
+            connection = await self.get_connection()
+            return await connection.send_and_await_reply(msg, reply_type)
+
+    async def get_ip(self, host):
+        """
+        Gets the IP addresses corresponding to a hostname.
+        """
+        message = control_proto.Host(host)
+        reply = await self.send_and_await_reply(message, control_proto.IP)
+        return reply.ip_addrs
+
+    async def get_host(self, ip):
+        """
+        Gets the host corresponding to an IP address. Note that the return
+        value may be ``None`` if no host corresponds to the given address.
+        """
+        message = control_proto.IP([ip])
+        reply = await self.send_and_await_reply(message, control_proto.Host)
+        return reply.hostname
+
+    async def get_host_ip_mapping(self):
+        """
+        Gets the entire host -> IP mapping, as a dictionary.
+        """
+        message = control_proto.GetAll()
+        reply = await self.send_and_await_reply(message,
+            control_proto.NameIPMapping)
+        return reply.host_to_ips
+
+    async def get_changes(self, since):
+        """
+        Gets the changes that have happened to the host -> IP mapping since the
+        given version, as a :class:`lns.control_proto.Changes` message.
+        """
+        message = control_proto.GetChanges(since)
+        return await self.send_and_await_reply(message, control_proto.Changes)
+
+    async def wait_for_host(self, host, timeout):
+        """
+        Waits up to the given number of seconds for a host to appear, and gets
+        its IP addresses, or an empty list if it doesn't appear in time.
+
+        The server doesn't answer anything else on a connection while it is
+        waiting, so this uses a connection of its own rather than holding up
+        one of the pooled connections.
+        """
+        connection = await self.open_connection()
+        try:
+            message = control_proto.WaitHost(host, timeout)
+            reply = await connection.send_and_await_reply(message,
+                control_proto.IP)
+            return reply.ip_addrs
+        finally:
+            await connection.close()
+
+class EmbeddedServer:
+    """
+    Runs the network protocol handler, and optionally the control protocol
+    handler, on the running asyncio event loop through an
+    :class:`lns.reactor.AsyncioReactor`.
+
+    The host-name mapping can be queried directly through :meth:`query_host`,
+    :meth:`query_ip` and :meth:`get_host_ip_map`, without going through the
+    control protocol at all. The control protocol is only served for other
+    processes if a ``control_port`` or ``control_path`` is given.
+    """
+    def __init__(self, hostname, net_port=net_proto.NET_PORT,
+            control_port=None, control_path=None, **control_options):
+        self.reactor = reactor.AsyncioReactor()
+        self.net_handler = net_proto.ProtocolHandler(self.reactor, hostname,
+            port=net_port)
+
+        self.control_handler = None
+        if control_port is not None or control_path is not None:
+            if control_port is None:
+                # The TCP listener is always opened, so let the kernel pick a
+                # port that nothing else will use
+                control_port = 0
+
+            self.control_handler = control_proto.ProtocolHandler(
+                self.net_handler, self.reactor, port=control_port,
+                path=control_path, **control_options)
+
+        self.done = False
+        self.task = None
+
+    def start(self):
+        """
+        Starts serving as a task on the running event loop, and returns the
+        task.
+        """
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        """
+        Stops serving, once the reactor has finished with its current events.
+        """
+        self.done = True
+        self.reactor.schedule_step()
+
+    def is_running(self):
+        """
+        Whether or not the server should keep serving.
+        """
+        if self.done:
+            return False
+        if self.control_handler is not None:
+            return self.control_handler.is_running()
+        return True
+
+    async def run(self):
+        """
+        Serves until :meth:`stop` is called (or a client sends a ``QUIT``
+        message to the control handler).
+        """
+        self.net_handler.open()
+        if self.control_handler is not None:
+            self.control_handler.open()
+
+        try:
+            while self.is_running():
+                await self.reactor.wait(
+                    self.net_handler.get_time_until_next_announce())
+        finally:
+            self.net_handler.close()
+            if self.control_handler is not None:
+                self.control_handler.close()
+            self.reactor.close()
+
+    def query_host(self, host):
+        """
+        Gets a list of IP addresses which have the given hostname.
+        """
+        return self.net_handler.query_host(host)
+
+    def query_ip(self, ip):
+        """
+        Gets a host for the given IP address, or None.
+        """
+        return self.net_handler.query_ip(ip)
+
+    def get_host_ip_map(self):
+        """
+        Gets the host to IP address map.
+        """
+        return self.net_handler.get_host_ip_map()
+
+    @property
+    def snapshot(self):
+        """
+        The most recently published :class:`lns.net_proto.Snapshot` of the
+        host-name mapping, which unlike the methods above can be used from
+        threads other than the event loop's.
+        """
+        return self.net_handler.peers.snapshot
@@ -3,8 +3,11 @@ Control Protocol
 ----------------
 
 This implements the inner-facing side of lnsd, which allows the local host to
-query the host-name mapping. There are four types of messages, which are
-``HOST``, ``IP``, ``GET-ALL``, ``NAME-IP-MAPPING`` and ``QUIT``.
+query the host-name mapping. There are several types of messages, which are
+``HOST``, ``IP``, ``GET-ALL``, ``NAME-IP-MAPPING``, ``GET-CHANGES``,
+``CHANGES``, ``SUBSCRIBE``, ``SUBSCRIBED``, ``JOINED``, ``LEFT``, ``RENAMED``,
+``WAIT-HOST``, ``GET-STATS``, ``STATS``, ``PROFILE``, ``PROFILING`` and
+``QUIT``.
 
 A ``HOST`` message references a hostname, and when sent to the server, it
 queries the host-name mapping for that hostname and produces an ``IP`` packet,
@@ -16,20 +19,89 @@ packet containing the hostname assigned to that IP address.
 
 A ``GET-ALL`` message is sent to the server to query the entire host-name
 mapping, to which the server replies with a ``NAME-IP-MAPPING`` message
-indicating all of the host-name mapping.
+indicating all of the host-name mapping. A mapping too large for a single
+message is split over several ``NAME-IP-MAPPING`` messages, each of which
+but the last is marked as having more to follow.
+
+A ``GET-CHANGES`` message carries a version of the host-name mapping that the
+client already knows about, and the server replies with a ``CHANGES`` message
+containing the current version and the hosts which have been added, removed
+and renamed since then. If the server no longer remembers that far back, the
+``CHANGES`` message asks the client to resync by fetching the whole mapping.
+
+A ``SUBSCRIBE`` message turns the connection into an event stream. The server
+replies with a ``SUBSCRIBED`` message carrying the current version of the
+host-name mapping, and then sends a ``JOINED``, ``LEFT`` or ``RENAMED`` message
+whenever a host matching the subscription's filters changes.
+
+A ``WAIT-HOST`` message references a hostname and a timeout. The server
+replies with an ``IP`` message as soon as that host is known, or with an empty
+``IP`` message if the timeout expires first.
+
+A ``GET-STATS`` message asks the server for the counters and histograms in
+its :mod:`lns.metrics` registry, which it sends back in a ``STATS`` message.
+
+A ``PROFILE`` message starts or stops a profile of the server (see
+:mod:`lns.profiler`), and the server replies with a ``PROFILING`` message
+giving the file that the profile will be written to, or why it couldn't be
+started or stopped.
 
 A ``QUIT`` message causes the server to terminate.
 """
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+import ipaddress
 import json
 import io
+import logging
+import math
+import os
+import select
 import socket
+import stat
 import struct
+import time
+
+from lns import metrics, net_proto, reactor, utils
 
-from lns import net_proto, reactor, utils
+LOGGER = logging.getLogger('lns.control_proto')
 
 CONTROL_PORT = 10771
 
+# How many pending connections the control sockets can hold, before the
+# kernel starts refusing new clients
+LISTEN_BACKLOG = 128
+
+# How many clients can be connected at once - any more than this are
+# disconnected as soon as they are accepted
+MAX_CLIENTS = 1024
+
+# How long a client can go without sending anything before it is
+# disconnected, in seconds
+CLIENT_IDLE_TIMEOUT = 60
+
+# The permissions given to the Unix control socket. Only users who can write
+# to the socket can connect to it, so this can be narrowed to restrict who can
+# query lnsd.
+CONTROL_SOCKET_MODE = 0o666
+
+# How many bytes of events can be waiting to be sent to a subscriber, before
+# the subscriber is considered too slow and is disconnected
+MAX_SUBSCRIBER_BACKLOG = 64 * 1024
+
+# How many hosts the mapping must have before GetAll replies are serialized on
+# a worker thread, instead of holding up the reactor while they are built
+OFFLOAD_REPLY_HOSTS = 1000
+
+# The longest JSON message that fits behind a length header, in bytes
+MAX_MESSAGE_SIZE = 65535
+
+# How many answers of each kind a caching client remembers
+CLIENT_CACHE_SIZE = 1024
+
+# How long a caching client waits for the server to accept its subscription,
+# before deciding that the server doesn't support subscriptions
+CLIENT_SUBSCRIBE_TIMEOUT = 1
+
 def get_length_encoded_json(stream):
     """
     Reads a JSON string from a bytestream, producing a dictionary.
@@ -53,6 +125,11 @@ def length_encode_json(data):
     Produces a length-encoded representation of JSON.
     """
     json_bytes = json.dumps(data).encode('utf-8')
+    if len(json_bytes) > MAX_MESSAGE_SIZE:
+        raise ValueError('{} message is {} bytes, more than the {} that fit '
+            'in a message'.format(data['type'], len(json_bytes),
+                MAX_MESSAGE_SIZE))
+
     length_header = struct.pack('H', len(json_bytes))
     return length_header + json_bytes
 
@@ -165,7 +242,8 @@ class GetAll(namedtuple('GetAll', [])):
         """
         return length_encode_json({'type': 'get-all'})
 
-class NameIPMapping(namedtuple('NameIPMapping', ['host_to_ips'])):
+class NameIPMapping(namedtuple('NameIPMapping', ['host_to_ips', 'more'],
+        defaults=(False,))):
     TYPE = 'nameipmapping'
 
     @staticmethod
@@ -192,17 +270,30 @@ class NameIPMapping(namedtuple('NameIPMapping', ['host_to_ips'])):
             for ip in ip_addrs:
                 verify_ipv4_address(ip)
 
-        return NameIPMapping(data['name_ips'])
+        return NameIPMapping(data['name_ips'], bool(data.get('more', False)))
 
     def serialize(self):
         """
-        Produces a bytestring from this message.
+        Produces a bytestring from this message. If the mapping doesn't fit
+        in one message, this produces several messages, each holding part of
+        the mapping, with every one but the last marked as having more.
         """
-        return length_encode_json({'type': 'nameipmapping',
-            'name_ips': self.host_to_ips})
-
-class Quit(namedtuple('Quit', [])):
-    TYPE = 'quit'
+        try:
+            return length_encode_json({'type': 'nameipmapping',
+                'name_ips': self.host_to_ips, 'more': self.more})
+        except ValueError:
+            if len(self.host_to_ips) < 2:
+                raise
+
+        # Splitting in half until every part fits wastes a little space, but
+        # it never has to guess how large each host's entry is
+        hosts = list(self.host_to_ips.items())
+        middle = len(hosts) // 2
+        return (NameIPMapping(dict(hosts[:middle]), True).serialize() +
+            NameIPMapping(dict(hosts[middle:]), self.more).serialize())
+
+class GetChanges(namedtuple('GetChanges', ['since'])):
+    TYPE = 'get-changes'
 
     @staticmethod
     def parses(data):
@@ -210,266 +301,1647 @@ class Quit(namedtuple('Quit', [])):
         Returns ``True`` if this class can parse the given dictionary, or
         ``False`` otherwise.
         """
-        return data['type'] == 'quit'
+        return data['type'] == 'get-changes'
 
     @staticmethod
     def unserialize(data):
         """
-        Produces a :class:`Quit` message from the contents of a dictionary.
-
-        :raises EOFError: If the stream is not long enough,
+        Produces a :class:`GetChanges` message from the contents of a
+        dictionary.
         """
-        if data['type'] != 'quit':
-            raise ValueError('Got type {}, expected quit'.format(data['type']))
+        if data['type'] != 'get-changes':
+            raise ValueError('Got type {}, expected get-changes'.format(
+                data['type']))
 
-        return Quit()
+        if not isinstance(data['since'], int):
+            raise ValueError('Version must be an integer')
+
+        return GetChanges(data['since'])
 
     def serialize(self):
         """
         Produces a bytestring from this message.
         """
-        return length_encode_json({'type': 'quit'})
-
-MESSAGE_CLASSES = {Host, IP, GetAll, NameIPMapping, Quit}
-def get_message_class(data):
-    """
-    Gets the message class capable of parsing the given dictionary.
+        return length_encode_json({'type': 'get-changes', 'since': self.since})
 
-    :raises ValueError: If the given message cannot be handled by any class.
-    """
-    for msg_class in MESSAGE_CLASSES:
-        if msg_class.parses(data):
-            return msg_class
-    raise ValueError('Could not parse the given dictionary')
+class Changes(namedtuple('Changes',
+        ['version', 'added', 'removed', 'renamed', 'resync'])):
+    TYPE = 'changes'
 
-class ClientHandler:
-    """
-    Connects to the LNS control port, and sends/retrieves JSON encoded messages
-    from the server.
-    """
-    def __init__(self, port=CONTROL_PORT):
-        self.port = port
-        self.command_sock = None
+    @staticmethod
+    def parses(data):
+        """
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
+        """
+        return data['type'] == 'changes'
 
-    def read_json_message(self, expected_message_type):
+    @staticmethod
+    def unserialize(data):
         """
-        Reads a JSON message from the socket.
+        Produces a :class:`Changes` message from the contents of a dictionary.
         """
-        length_header = self.command_sock.recv(2)
-        if len(length_header) != 2:
-            raise OSError('Connection dropped')
-        length = struct.unpack('H', length_header)[0]
+        if data['type'] != 'changes':
+            raise ValueError('Got type {}, expected changes'.format(
+                data['type']))
 
-        recv_message_raw = b''
-        while len(recv_message_raw) < length:
-            chunk = self.command_sock.recv(utils.BUFFER_SIZE)
-            if not chunk:
-                raise OSError('Connection dropped')
-            recv_message_raw += chunk
+        if not isinstance(data['version'], int):
+            raise ValueError('Version must be an integer')
 
-        json_data = get_length_encoded_json(
-            io.BytesIO(length_header + recv_message_raw))
-        message_class = get_message_class(json_data)
-        if message_class is not expected_message_type:
-            raise ValueError('Expected a {}, but got a {}'.format(
-                expected_message_type, message_class))
-        return message_class.unserialize(json_data)
+        for ip, name in (list(data['added'].items()) +
+                list(data['renamed'].items())):
+            verify_ipv4_address(ip)
+            net_proto.verify_hostname(name.encode('ascii'))
 
-    def __enter__(self):
-        self.open()
+        for ip in data['removed']:
+            verify_ipv4_address(ip)
 
-    def __exit__(self, *exc):
-        self.close()
+        return Changes(data['version'], data['added'], data['removed'],
+            data['renamed'], bool(data['resync']))
 
-    def open(self):
+    def serialize(self):
         """
-        Opens up the command socket for sending information.
+        Produces a bytestring from this message.
         """
-        self.command_sock = socket.socket()
-        self.command_sock.connect(('localhost', self.port))
+        return length_encode_json({'type': 'changes',
+            'version': self.version, 'added': self.added,
+            'removed': self.removed, 'renamed': self.renamed,
+            'resync': self.resync})
 
-    def close(self):
+class Subscribe(namedtuple('Subscribe', ['prefix', 'subnet'])):
+    TYPE = 'subscribe'
+
+    @staticmethod
+    def parses(data):
         """
-        Closes the command socket.
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
         """
-        self.command_sock.close()
+        return data['type'] == 'subscribe'
 
-    def send_and_await_reply(self, msg, reply_type):
+    @staticmethod
+    def unserialize(data):
         """
-        Sends a message, and awaits a reply of a specific type.
+        Produces a :class:`Subscribe` message from the contents of a
+        dictionary.
         """
-        self.command_sock.sendall(msg.serialize())
-        return self.read_json_message(reply_type)
+        if data['type'] != 'subscribe':
+            raise ValueError('Got type {}, expected subscribe'.format(
+                data['type']))
 
-    def get_ip(self, host):
+        if data['prefix'] is not None:
+            data['prefix'].encode('ascii')
+
+        if data['subnet'] is not None:
+            ipaddress.IPv4Network(data['subnet'], strict=False)
+
+        return Subscribe(data['prefix'], data['subnet'])
+
+    def serialize(self):
         """
-        Gets the IP address corresponding to a hostname. Note that the return
-        value may be ``None`` if no address corresponds to the given host.
+        Produces a bytestring from this message.
         """
-        message = Host(host)
-        reply = self.send_and_await_reply(message, IP)
-        return reply.ip_addrs
+        return length_encode_json({'type': 'subscribe',
+            'prefix': self.prefix, 'subnet': self.subnet})
 
-    def get_host(self, ip):
+class Subscribed(namedtuple('Subscribed', ['version'])):
+    TYPE = 'subscribed'
+
+    @staticmethod
+    def parses(data):
         """
-        Gets the host corresponding to an IP address. Note that the return
-        value may be ``None`` if no host corresponds to the given address.
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
         """
-        message = IP([ip])
-        reply = self.send_and_await_reply(message, Host)
-        return reply.hostname
+        return data['type'] == 'subscribed'
 
-    def get_host_ip_mapping(self):
+    @staticmethod
+    def unserialize(data):
         """
-        Gets the entire host -> IP mapping, as a dictionary.
+        Produces a :class:`Subscribed` message from the contents of a
+        dictionary.
         """
-        message = GetAll()
-        reply = self.send_and_await_reply(message, NameIPMapping)
-        return reply.host_to_ips
+        if data['type'] != 'subscribed':
+            raise ValueError('Got type {}, expected subscribed'.format(
+                data['type']))
 
-    def terminate(self):
+        if not isinstance(data['version'], int):
+            raise ValueError('Version must be an integer')
+
+        return Subscribed(data['version'])
+
+    def serialize(self):
         """
-        Terminates the server.
+        Produces a bytestring from this message.
         """
-        message = Quit()
-        self.command_sock.send(message.serialize())
+        return length_encode_json({'type': 'subscribed',
+            'version': self.version})
 
-class ProtocolHandler:
-    """
-    Handles clients on the local machine, which connect to query the host-ip
-    mapping in different ways.
-    """
-    def __init__(self, network_handler, a_reactor, port=CONTROL_PORT):
-        self.reactor = a_reactor
-        self.port = port
-        self.server_sock = None
-        self.clients = {}
-        self.client_buffers = {}
-        self.done = False
-
-        self.network_handler = network_handler
+class Joined(namedtuple('Joined', ['ip', 'hostname'])):
+    TYPE = 'joined'
 
-    def is_running(self):
+    @staticmethod
+    def parses(data):
         """
-        Returns whether or not this control server is still active.
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
         """
-        return not self.done
+        return data['type'] == 'joined'
 
-    def open(self):
+    @staticmethod
+    def unserialize(data):
         """
-        Opens up the command socket for processing clients.
+        Produces a :class:`Joined` message from the contents of a dictionary.
         """
-        self.server_sock = socket.socket()
-        self.server_sock.bind(('localhost', self.port))
-        self.server_sock.listen(5)
-        self.server_sock.setblocking(False)
-        self.reactor.bind(self.server_sock, reactor.READABLE, self.on_connect)
+        if data['type'] != 'joined':
+            raise ValueError('Got type {}, expected joined'.format(
+                data['type']))
 
-    def close(self):
+        verify_ipv4_address(data['ip'])
+        net_proto.verify_hostname(data['hostname'].encode('ascii'))
+        return Joined(data['ip'], data['hostname'])
+
+    def serialize(self):
         """
-        Closes the server, as well as any active clients.
+        Produces a bytestring from this message.
         """
-        to_close = [sock for sock in self.clients.values()]
-        for sock in to_close:
-            self.close_client(sock)
+        return length_encode_json({'type': 'joined', 'ip': self.ip,
+            'hostname': self.hostname})
 
-        self.reactor.unbind(self.server_sock)
-        self.server_sock.close()
+class Left(namedtuple('Left', ['ip', 'hostname'])):
+    TYPE = 'left'
 
-    def on_connect(self, event):
+    @staticmethod
+    def parses(data):
         """
-        Handle a connection on the server.
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
         """
-        client, _ = self.server_sock.accept()
-        self.clients[client.fileno()] = client
-        self.client_buffers[client.fileno()] = b''
-        self.reactor.bind(client, reactor.READABLE, self.on_message_recv)
+        return data['type'] == 'left'
 
-    def close_client(self, client_sock):
+    @staticmethod
+    def unserialize(data):
         """
-        Closes the client with the given file descriptor, and destroys its
-        buffer.
+        Produces a :class:`Left` message from the contents of a dictionary.
         """
-        client_fd = client_sock.fileno()
-        if client_fd == -1:
-            return
+        if data['type'] != 'left':
+            raise ValueError('Got type {}, expected left'.format(data['type']))
 
-        self.reactor.unbind(client_sock)
-        client_sock.close()
+        verify_ipv4_address(data['ip'])
+        net_proto.verify_hostname(data['hostname'].encode('ascii'))
+        return Left(data['ip'], data['hostname'])
 
-        del self.clients[client_fd]
-        del self.client_buffers[client_fd]
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        return length_encode_json({'type': 'left', 'ip': self.ip,
+            'hostname': self.hostname})
 
-    def pull_messages(self, client_fd, client_sock):
+class Renamed(namedtuple('Renamed', ['ip', 'old_hostname', 'hostname'])):
+    TYPE = 'renamed'
+
+    @staticmethod
+    def parses(data):
         """
-        Pulls out messages from the client's buffer, until there aren't any
-        full messages to remove.
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
         """
-        client_buffer_stream = utils.TransactionalBytesIO(
-            self.client_buffers[client_fd])
-        while True:
-            json_message = None
-            with client_buffer_stream.get_transaction() as txn:
-                txn_stream = txn.get_stream()
-                try:
-                    # Note that we don't want to affect the read position if
-                    # no message is there, so use the transaction to save
-                    # the position and only update it when we're sure we
-                    # have a message.
-                    json_message = get_length_encoded_json(txn_stream)
-                    txn.commit()
-                except EOFError:
-                    txn.abort()
-                    break
-                except ValueError:
-                    pass
+        return data['type'] == 'renamed'
 
-            # This indicates an invalid message, because we read the whole
-            if json_message is None:
-                continue
+    @staticmethod
+    def unserialize(data):
+        """
+        Produces a :class:`Renamed` message from the contents of a dictionary.
+        """
+        if data['type'] != 'renamed':
+            raise ValueError('Got type {}, expected renamed'.format(
+                data['type']))
 
-            message_class = get_message_class(json_message)
-            message = message_class.unserialize(json_message)
-            self.handle_message(client_sock, message)
+        verify_ipv4_address(data['ip'])
+        net_proto.verify_hostname(data['old_hostname'].encode('ascii'))
+        net_proto.verify_hostname(data['hostname'].encode('ascii'))
+        return Renamed(data['ip'], data['old_hostname'], data['hostname'])
 
-        self.client_buffers[client_fd] = client_buffer_stream.read()
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        return length_encode_json({'type': 'renamed', 'ip': self.ip,
+            'old_hostname': self.old_hostname, 'hostname': self.hostname})
 
-    def on_message_recv(self, event):
+class WaitHost(namedtuple('WaitHost', ['hostname', 'timeout'])):
+    TYPE = 'wait-host'
+
+    @staticmethod
+    def parses(data):
         """
-        Handles a message sent by a client.
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
         """
-        client_fd, _ = event
-        client_sock = self.clients[client_fd]
-        try:
-            chunk = client_sock.recv(utils.BUFFER_SIZE)
-            if not chunk:
-                self.close_client(client_sock)
-                return
-            self.client_buffers[client_fd] += chunk
-            self.pull_messages(client_fd, client_sock)
-        except OSError:
-            # This happened occasionally during testing, causing the tests to
-            # crash
-            if client_sock.fileno() != -1:
-                self.close_client(client_sock)
+        return data['type'] == 'wait-host'
 
-    def handle_message(self, client, message):
+    @staticmethod
+    def unserialize(data):
         """
-        Processes the given message which was received from the given client.
+        Produces a :class:`WaitHost` message from the contents of a
+        dictionary.
         """
+        if data['type'] != 'wait-host':
+            raise ValueError('Got type {}, expected wait-host'.format(
+                data['type']))
+
+        net_proto.verify_hostname(data['hostname'].encode('ascii'))
+        # JSON's NaN and Infinity would never expire as timers, and bools are
+        # ints as far as isinstance is concerned
+        if (not isinstance(data['timeout'], (int, float))
+                or isinstance(data['timeout'], bool)
+                or not math.isfinite(data['timeout'])
+                or data['timeout'] < 0):
+            raise ValueError('Timeout must be a finite, non-negative number')
+
+        return WaitHost(data['hostname'], data['timeout'])
+
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        net_proto.verify_hostname(self.hostname.encode('ascii'))
+        return length_encode_json({'type': 'wait-host',
+            'hostname': self.hostname, 'timeout': self.timeout})
+
+def make_change_event(ip, old_hostname, new_hostname):
+    """
+    Converts a change to the peer table into a :class:`Joined`, :class:`Left`
+    or :class:`Renamed` message.
+    """
+    if old_hostname is None:
+        return Joined(ip, new_hostname)
+    elif new_hostname is None:
+        return Left(ip, old_hostname)
+    else:
+        return Renamed(ip, old_hostname, new_hostname)
+
+class GetStats(namedtuple('GetStats', [])):
+    TYPE = 'get-stats'
+
+    @staticmethod
+    def parses(data):
+        """
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
+        """
+        return data['type'] == 'get-stats'
+
+    @staticmethod
+    def unserialize(data):
+        """
+        Produces a :class:`GetStats` message from the contents of a
+        dictionary.
+        """
+        if data['type'] != 'get-stats':
+            raise ValueError('Got type {}, expected get-stats'.format(
+                data['type']))
+
+        return GetStats()
+
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        return length_encode_json({'type': 'get-stats'})
+
+class Stats(namedtuple('Stats', ['counters', 'histograms', 'error'],
+        defaults=(None,))):
+    TYPE = 'stats'
+
+    @staticmethod
+    def parses(data):
+        """
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
+        """
+        return data['type'] == 'stats'
+
+    @staticmethod
+    def unserialize(data):
+        """
+        Produces a :class:`Stats` message from the contents of a dictionary.
+        The counters and histograms are in the form produced by
+        :meth:`lns.metrics.Registry.collect`.
+        """
+        if data['type'] != 'stats':
+            raise ValueError('Got type {}, expected stats'.format(
+                data['type']))
+
+        for metric in data['counters'] + data['histograms']:
+            if not isinstance(metric['name'], str):
+                raise ValueError('Metric names must be strings')
+            if not isinstance(metric['labels'], dict):
+                raise ValueError('Metric labels must be a dictionary')
+
+        for counter in data['counters']:
+            if not isinstance(counter['value'], int):
+                raise ValueError('Counter values must be integers')
+
+        for histogram in data['histograms']:
+            if len(histogram['counts']) != len(histogram['bounds']) + 1:
+                raise ValueError('Histograms need one more count than bound')
+
+        error = data.get('error')
+        if error is not None and not isinstance(error, str):
+            raise ValueError('error must be a string')
+
+        return Stats(data['counters'], data['histograms'], error)
+
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        return length_encode_json({'type': 'stats',
+            'counters': self.counters, 'histograms': self.histograms,
+            'error': self.error})
+
+class Profile(namedtuple('Profile', ['action', 'mode'])):
+    TYPE = 'profile'
+
+    @staticmethod
+    def parses(data):
+        """
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
+        """
+        return data['type'] == 'profile'
+
+    @staticmethod
+    def unserialize(data):
+        """
+        Produces a :class:`Profile` message from the contents of a
+        dictionary.
+        """
+        if data['type'] != 'profile':
+            raise ValueError('Got type {}, expected profile'.format(
+                data['type']))
+
+        if data['action'] not in ('start', 'stop'):
+            raise ValueError('Action must be start or stop')
+
+        if data['mode'] is not None and not isinstance(data['mode'], str):
+            raise ValueError('Mode must be a string')
+
+        return Profile(data['action'], data['mode'])
+
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        return length_encode_json({'type': 'profile',
+            'action': self.action, 'mode': self.mode})
+
+class Profiling(namedtuple('Profiling', ['mode', 'path', 'error'])):
+    TYPE = 'profiling'
+
+    @staticmethod
+    def parses(data):
+        """
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
+        """
+        return data['type'] == 'profiling'
+
+    @staticmethod
+    def unserialize(data):
+        """
+        Produces a :class:`Profiling` message from the contents of a
+        dictionary.
+        """
+        if data['type'] != 'profiling':
+            raise ValueError('Got type {}, expected profiling'.format(
+                data['type']))
+
+        for field in ('mode', 'path', 'error'):
+            if data[field] is not None and not isinstance(data[field], str):
+                raise ValueError('{} must be a string'.format(field))
+
+        return Profiling(data['mode'], data['path'], data['error'])
+
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        return length_encode_json({'type': 'profiling',
+            'mode': self.mode, 'path': self.path, 'error': self.error})
+
+class Quit(namedtuple('Quit', [])):
+    TYPE = 'quit'
+
+    @staticmethod
+    def parses(data):
+        """
+        Returns ``True`` if this class can parse the given dictionary, or
+        ``False`` otherwise.
+        """
+        return data['type'] == 'quit'
+
+    @staticmethod
+    def unserialize(data):
+        """
+        Produces a :class:`Quit` message from the contents of a dictionary.
+
+        :raises EOFError: If the stream is not long enough,
+        """
+        if data['type'] != 'quit':
+            raise ValueError('Got type {}, expected quit'.format(data['type']))
+
+        return Quit()
+
+    def serialize(self):
+        """
+        Produces a bytestring from this message.
+        """
+        return length_encode_json({'type': 'quit'})
+
+MESSAGE_CLASSES = {Host, IP, GetAll, NameIPMapping, GetChanges, Changes,
+    Subscribe, Subscribed, Joined, Left, Renamed, WaitHost, GetStats, Stats,
+    Profile, Profiling, Quit}
+EVENT_CLASSES = (Joined, Left, Renamed)
+def get_message_class(data):
+    """
+    Gets the message class capable of parsing the given dictionary.
+
+    :raises ValueError: If the given message cannot be handled by any class.
+    """
+    for msg_class in MESSAGE_CLASSES:
+        if msg_class.parses(data):
+            return msg_class
+    raise ValueError('Could not parse the given dictionary')
+
+class TableMirror:
+    """
+    A local copy of the server's host-IP mapping, which is kept up to date by
+    applying the changes that the server reports through
+    :meth:`ClientHandler.update_mirror`.
+    """
+    def __init__(self):
+        self.version = None
+        self.ip_to_host = {}
+
+    def reset(self, host_to_ips, version):
+        """
+        Replaces the contents of the mirror with an entire host-IP mapping.
+        """
+        self.version = version
+        self.ip_to_host = {ip: host
+            for host, ips in host_to_ips.items()
+            for ip in ips}
+
+    def apply(self, changes):
+        """
+        Applies a :class:`Changes` message to the mirror.
+        """
+        for ip, hostname in changes.added.items():
+            self.ip_to_host[ip] = hostname
+        for ip, hostname in changes.renamed.items():
+            self.ip_to_host[ip] = hostname
+        for ip in changes.removed:
+            self.ip_to_host.pop(ip, None)
+
+        self.version = changes.version
+
+    def query_host(self, host):
+        """
+        Gets a list of IP addresses which have the given hostname.
+        """
+        return [ip for ip, ip_host in self.ip_to_host.items()
+            if ip_host == host]
+
+    def query_ip(self, ip):
+        """
+        Gets a host for the given IP address, or None.
+        """
+        return self.ip_to_host.get(ip, None)
+
+    def get_host_ip_map(self):
+        """
+        Gets the host to IP address map.
+        """
+        host_to_ips = {}
+        for ip, host in self.ip_to_host.items():
+            host_to_ips.setdefault(host, []).append(ip)
+        return host_to_ips
+
+class LRUCache:
+    """
+    A bounded mapping which forgets its least recently used entries once it
+    is full, as well as entries which are older than its TTL.
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now, expires=True):
+        """
+        Gets a ``(found, value)`` pair for the given key. Entries older than
+        the TTL are treated as missing, unless ``expires`` is false.
+        """
+        try:
+            value, stored_at = self.entries[key]
+        except KeyError:
+            return False, None
+
+        if expires and self.ttl is not None and now - stored_at >= self.ttl:
+            del self.entries[key]
+            return False, None
+
+        self.entries.move_to_end(key)
+        return True, value
+
+    def put(self, key, value, now):
+        """
+        Stores a value, evicting the least recently used entry if necessary.
+        """
+        self.entries[key] = (value, now)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        """
+        Removes the given key, returning whether it was present.
+        """
+        return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        self.entries.clear()
+
+CacheStats = namedtuple('CacheStats',
+    ['hits', 'negative_hits', 'misses', 'invalidations'])
+
+class ClientHandler:
+    """
+    Connects to the LNS control port (or the Unix control socket, if a path is
+    given), and sends/retrieves JSON encoded messages from the server.
+    """
+    def __init__(self, port=CONTROL_PORT, path=None):
+        self.port = port
+        self.path = path
+        self.command_sock = None
+
+    def recv_exactly(self, length):
+        """
+        Reads exactly the given number of bytes from the socket.
+        """
+        data = b''
+        while len(data) < length:
+            chunk = self.command_sock.recv(
+                min(length - len(data), utils.BUFFER_SIZE))
+            if not chunk:
+                raise OSError('Connection dropped')
+            data += chunk
+        return data
+
+    def read_message(self):
+        """
+        Reads a JSON message of any type from the socket.
+        """
+        length_header = self.recv_exactly(2)
+        length = struct.unpack('H', length_header)[0]
+        recv_message_raw = self.recv_exactly(length)
+
+        json_data = get_length_encoded_json(
+            io.BytesIO(length_header + recv_message_raw))
+        message_class = get_message_class(json_data)
+        return message_class.unserialize(json_data)
+
+    def read_json_message(self, expected_message_type):
+        """
+        Reads a JSON message from the socket.
+        """
+        message = self.read_message()
+        message_class = type(message)
+        if message_class is not expected_message_type:
+            raise ValueError('Expected a {}, but got a {}'.format(
+                expected_message_type, message_class))
+        return message
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        """
+        Opens up the command socket for sending information.
+        """
+        if self.path is not None:
+            self.command_sock = socket.socket(socket.AF_UNIX)
+            self.command_sock.connect(self.path)
+        else:
+            self.command_sock = socket.socket()
+            self.command_sock.connect(('localhost', self.port))
+
+    def close(self):
+        """
+        Closes the command socket.
+        """
+        self.command_sock.close()
+
+    def send_and_await_reply(self, msg, reply_type):
+        """
+        Sends a message, and awaits a reply of a specific type.
+        """
+        self.command_sock.sendall(msg.serialize())
+        return self.read_json_message(reply_type)
+
+    def get_ip(self, host):
+        """
+        Gets the IP address corresponding to a hostname. Note that the return
+        value may be ``None`` if no address corresponds to the given host.
+        """
+        message = Host(host)
+        reply = self.send_and_await_reply(message, IP)
+        return reply.ip_addrs
+
+    def get_host(self, ip):
+        """
+        Gets the host corresponding to an IP address. Note that the return
+        value may be ``None`` if no host corresponds to the given address.
+        """
+        message = IP([ip])
+        reply = self.send_and_await_reply(message, Host)
+        return reply.hostname
+
+    def get_host_ip_mapping(self):
+        """
+        Gets the entire host -> IP mapping, as a dictionary.
+        """
+        message = GetAll()
+        reply = self.send_and_await_reply(message, NameIPMapping)
+        host_to_ips = dict(reply.host_to_ips)
+        while reply.more:
+            reply = self.read_json_message(NameIPMapping)
+            host_to_ips.update(reply.host_to_ips)
+        return host_to_ips
+
+    def get_changes(self, since):
+        """
+        Gets the changes that have happened to the host -> IP mapping since the
+        given version, as a :class:`Changes` message.
+        """
+        message = GetChanges(since)
+        return self.send_and_await_reply(message, Changes)
+
+    def update_mirror(self, mirror):
+        """
+        Brings a :class:`TableMirror` up to date with the server, by applying
+        any changes since the mirror was last updated. A full copy of the
+        mapping is only fetched when the mirror is empty, or when the server
+        has forgotten the changes that the mirror would need.
+        """
+        since = mirror.version if mirror.version is not None else -1
+        changes = self.get_changes(since)
+        if not changes.resync:
+            mirror.apply(changes)
+            return
+
+        mirror.reset(self.get_host_ip_mapping(), changes.version)
+
+        # The mapping may have changed between the two requests - since
+        # changes are idempotent, replaying any of them that are already in the
+        # mapping is harmless
+        changes = self.get_changes(changes.version)
+        if not changes.resync:
+            mirror.apply(changes)
+
+    def wait_for_host(self, host, timeout):
+        """
+        Waits up to the given number of seconds for a host to appear, and gets
+        its IP addresses. If the host doesn't appear in time, then this
+        returns an empty list.
+        """
+        message = WaitHost(host, timeout)
+        reply = self.send_and_await_reply(message, IP)
+        return reply.ip_addrs
+
+    def subscribe(self, prefix=None, subnet=None):
+        """
+        Turns this connection into a stream of :class:`Joined`, :class:`Left`
+        and :class:`Renamed` events, optionally only for hosts whose names
+        start with a prefix, or whose addresses are in a subnet like
+        ``'192.168.1.0/24'``.
+
+        Returns the version of the host -> IP mapping that the events start
+        from. Once subscribed, this connection can't be used for queries.
+        """
+        message = Subscribe(prefix, subnet)
+        reply = self.send_and_await_reply(message, Subscribed)
+        return reply.version
+
+    def read_event(self):
+        """
+        Waits for the next event on a subscribed connection.
+        """
+        message = self.read_message()
+        if not isinstance(message, EVENT_CLASSES):
+            raise ValueError('Expected an event, but got a {}'.format(
+                type(message)))
+        return message
+
+    def iter_events(self):
+        """
+        Produces every event on a subscribed connection, until the connection
+        is closed.
+        """
+        while True:
+            yield self.read_event()
+
+    def get_stats(self):
+        """
+        Gets the server's counters and histograms, as a :class:`Stats`
+        message.
+        """
+        return self.send_and_await_reply(GetStats(), Stats)
+
+    def start_profile(self, mode):
+        """
+        Starts a profile of the server (``'cprofile'`` or ``'sampling'``).
+        Returns a :class:`Profiling` message, with the file that the profile
+        will be written to, or an error if it couldn't be started.
+        """
+        return self.send_and_await_reply(Profile('start', mode), Profiling)
+
+    def stop_profile(self):
+        """
+        Stops the server's profile. Returns a :class:`Profiling` message, with
+        the file that the profile is being written to, or an error if no
+        profile was running.
+        """
+        return self.send_and_await_reply(Profile('stop', None), Profiling)
+
+    def terminate(self):
+        """
+        Terminates the server.
+        """
+        message = Quit()
+        self.command_sock.send(message.serialize())
+
+class CachingClientHandler(ClientHandler):
+    """
+    A :class:`ClientHandler` which remembers the answers to :meth:`get_ip` and
+    :meth:`get_host`, so that repeated lookups don't have to go through the
+    server.
+
+    Answers naming a host are kept for ``ttl`` seconds (by default, as long as
+    the server itself remembers a host which has stopped announcing), while
+    answers saying that nothing was found are kept for ``negative_ttl``
+    seconds (by default, as long as a new host takes to announce itself). At
+    most ``cache_size`` answers of each kind are kept.
+
+    If ``use_events`` is true, and the server supports subscriptions, then a
+    second connection is subscribed to every change of the mapping when the
+    first lookup is made, and answers are forgotten as soon as a change
+    affects them rather than after their TTL.
+
+    Since lookups can be far apart, the server may drop the command
+    connection for being idle in between. A request whose connection turns
+    out to have been dropped is sent again, once, over a new connection.
+    """
+    def __init__(self, port=CONTROL_PORT, path=None,
+            cache_size=CLIENT_CACHE_SIZE, ttl=net_proto.ANNOUNCE_TTL,
+            negative_ttl=net_proto.ANNOUNCE_ALARM, use_events=True):
+        super().__init__(port, path)
+        self.host_cache = LRUCache(cache_size, ttl)
+        self.missing_hosts = LRUCache(cache_size, negative_ttl)
+        self.ip_cache = LRUCache(cache_size, ttl)
+        self.missing_ips = LRUCache(cache_size, negative_ttl)
+
+        self.use_events = use_events
+        self.event_client = None
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def close(self):
+        """
+        Closes the command socket and the event socket.
+        """
+        super().close()
+        self.close_events()
+
+    def send_and_await_reply(self, msg, reply_type):
+        """
+        Sends a message, and awaits a reply of a specific type, reconnecting
+        and trying again if the server has dropped the connection.
+        """
+        try:
+            return super().send_and_await_reply(msg, reply_type)
+        except OSError as err:
+            LOGGER.info('Reconnecting after losing the connection: %s', err)
+
+        super().close()
+        self.open()
+        return super().send_and_await_reply(msg, reply_type)
+
+    def open_events(self):
+        """
+        Subscribes a second connection to every change of the mapping. If the
+        server doesn't accept the subscription, then events aren't used again
+        and answers expire by their TTLs instead.
+        """
+        event_client = ClientHandler(self.port, self.path)
+        try:
+            event_client.open()
+            event_client.command_sock.settimeout(CLIENT_SUBSCRIBE_TIMEOUT)
+            event_client.subscribe()
+            event_client.command_sock.settimeout(None)
+        except (OSError, ValueError) as err:
+            LOGGER.info('Not using events to invalidate the cache: %s', err)
+            event_client.close()
+            self.use_events = False
+            return
+
+        # Anything cached before the subscription started could have changed
+        # without an event saying so
+        self.clear_cache()
+        self.event_client = event_client
+
+    def close_events(self):
+        """
+        Closes the event socket, if it is open.
+        """
+        if self.event_client is not None:
+            self.event_client.close()
+            self.event_client = None
+
+    def process_events(self):
+        """
+        Forgets every answer that has been changed by an event which has
+        arrived since the last lookup, without waiting for any new events.
+        """
+        if self.event_client is None:
+            if not self.use_events:
+                return
+
+            # This is either the first lookup, or the server has dropped us
+            # for falling too far behind - either way, the cache is empty and
+            # can be filled again once we're subscribed
+            self.open_events()
+            if self.event_client is None:
+                return
+
+        event_sock = self.event_client.command_sock
+        while select.select([event_sock], [], [], 0)[0]:
+            try:
+                event = self.event_client.read_event()
+            except (OSError, ValueError) as err:
+                LOGGER.info('Lost the event connection: %s', err)
+                self.close_events()
+                self.clear_cache()
+                return
+
+            self.invalidate(event)
+
+    def invalidate(self, event):
+        """
+        Forgets every answer that a :class:`Joined`, :class:`Left` or
+        :class:`Renamed` event affects.
+        """
+        hostnames = [event.hostname]
+        if isinstance(event, Renamed):
+            hostnames.append(event.old_hostname)
+
+        forgotten = False
+        for hostname in hostnames:
+            forgotten |= self.host_cache.discard(hostname)
+            forgotten |= self.missing_hosts.discard(hostname)
+        forgotten |= self.ip_cache.discard(event.ip)
+        forgotten |= self.missing_ips.discard(event.ip)
+
+        if forgotten:
+            self.invalidations += 1
+
+    def lookup(self, key, cache, missing_cache, fetch):
+        """
+        Gets an answer from one of the caches, or from the server if neither
+        cache has it.
+        """
+        self.process_events()
+
+        now = time.monotonic()
+        expires = self.event_client is None
+
+        found, value = cache.get(key, now, expires)
+        if found:
+            self.hits += 1
+            return value
+
+        found, value = missing_cache.get(key, now, expires)
+        if found:
+            self.negative_hits += 1
+            return value
+
+        self.misses += 1
+        value = fetch(key)
+        if value:
+            cache.put(key, value, now)
+        else:
+            missing_cache.put(key, value, now)
+        return value
+
+    def get_ip(self, host):
+        """
+        Gets the IP addresses corresponding to a hostname, from the cache if
+        possible.
+        """
+        ip_addrs = self.lookup(host, self.host_cache, self.missing_hosts,
+            super().get_ip)
+        return list(ip_addrs)
+
+    def get_host(self, ip):
+        """
+        Gets the host corresponding to an IP address, from the cache if
+        possible.
+        """
+        return self.lookup(ip, self.ip_cache, self.missing_ips,
+            super().get_host)
+
+    def clear_cache(self):
+        """
+        Forgets every cached answer.
+        """
+        for cache in (self.host_cache, self.missing_hosts, self.ip_cache,
+                self.missing_ips):
+            cache.clear()
+
+    def get_cache_stats(self):
+        """
+        Gets the number of lookups answered from the cache (split into those
+        that found something and those that didn't), the number that went to
+        the server, and the number of events that forgot cached answers.
+        """
+        return CacheStats(self.hits, self.negative_hits, self.misses,
+            self.invalidations)
+
+class ProtocolHandler:
+    """
+    Handles clients on the local machine, which connect to query the host-ip
+    mapping in different ways.
+
+    Clients are accepted on a TCP port bound to localhost, and optionally on
+    a Unix socket at the given path, whose access is controlled by its file
+    permissions.
+
+    At most ``max_clients`` clients are served at once, and clients which
+    don't send anything for ``idle_timeout`` seconds are disconnected (unless
+    they are subscribed, or waiting on a host). An ``idle_timeout`` of
+    ``None`` lets clients stay idle forever.
+
+    If ``reuse_port`` is true, then the TCP port is bound with
+    ``SO_REUSEPORT``, so that several processes can serve it at once and the
+    kernel spreads new clients between them.
+
+    ``PROFILE`` requests are handled by the given
+    :class:`lns.profiler.Profiler`, or refused if there isn't one.
+    ``GET-STATS`` requests are refused unless ``serve_stats`` is true, since
+    a worker process only has metrics for the part of lnsd that it runs.
+    """
+    def __init__(self, network_handler, a_reactor, port=CONTROL_PORT,
+            path=None, path_mode=CONTROL_SOCKET_MODE, backlog=LISTEN_BACKLOG,
+            max_clients=MAX_CLIENTS, idle_timeout=CLIENT_IDLE_TIMEOUT,
+            reuse_port=False, profiler=None, serve_stats=True):
+        self.reactor = a_reactor
+        self.profiler = profiler
+        self.serve_stats = serve_stats
+        self.port = port
+        self.reuse_port = reuse_port
+        self.path = path
+        self.path_mode = path_mode
+        self.backlog = backlog
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.server_sock = None
+        self.unix_server_sock = None
+        self.clients = {}
+        self.client_buffers = {}
+        self.client_out_buffers = {}
+        self.done = False
+
+        # Maps the file descriptor of each client to the last time it sent
+        # anything, and the timer which checks whether it has gone idle
+        self.client_last_active = {}
+        self.client_idle_timers = {}
+
+        # Maps the file descriptor of each subscribed client to the prefix
+        # and subnet that it filters events by
+        self.subscribers = {}
+
+        # Maps the file descriptor of each client with a parked WaitHost
+        # request to the hostname it is waiting for and the timer which
+        # expires the request, as well as mapping each hostname to the file
+        # descriptors of the clients waiting for it
+        self.client_waits = {}
+        self.host_waiters = {}
+
+        self.network_handler = network_handler
+
+        # The serialized GetAll reply, along with the generation of the peer
+        # table that it was built from
+        self.get_all_cache = (None, None)
+
+        # GetAll replies for mappings with at least this many hosts are built
+        # on a worker thread. While that happens, the generations being built
+        # are kept here, and each client waiting on a reply is mapped to the
+        # generation that it will get.
+        self.offload_hosts = OFFLOAD_REPLY_HOSTS
+        self.get_all_builds = set()
+        self.get_all_waiters = {}
+
+        registry = metrics.REGISTRY
+        self.connections_accepted = registry.counter('control_connections',
+            result='accepted')
+        self.connections_refused = registry.counter('control_connections',
+            result='refused')
+        self.invalid_requests = registry.counter('control_requests_invalid')
+        self.bytes_in = registry.counter('bytes_in', socket='control')
+        self.bytes_out = registry.counter('bytes_out', socket='control')
+
+        # Maps each type of message that clients have sent to its request
+        # counter and handling latency histogram
+        self.request_metrics = {}
+
+    def is_running(self):
+        """
+        Returns whether or not this control server is still active.
+        """
+        return not self.done
+
+    def stop(self):
+        """
+        Makes the server stop running, as if a client had sent a ``QUIT``.
+        """
+        self.done = True
+
+    def open(self):
+        """
+        Opens up the command socket for processing clients.
+        """
+        self.server_sock = socket.socket()
+        # Since the server disconnects idle clients, it can leave connections
+        # in TIME_WAIT which would otherwise prevent it from restarting
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_sock.setsockopt(socket.SOL_SOCKET,
+                socket.SO_REUSEPORT, 1)
+        self.server_sock.bind(('localhost', self.port))
+        self.server_sock.listen(self.backlog)
+        self.server_sock.setblocking(False)
+        self.reactor.bind(self.server_sock, reactor.READABLE, self.on_connect)
+
+        if self.path is not None:
+            self.open_unix_socket()
+
+        self.network_handler.add_change_listener(self.on_peer_change)
+
+    def open_unix_socket(self):
+        """
+        Opens up the Unix command socket, replacing any socket left behind by
+        an earlier server which didn't shut down cleanly.
+        """
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        self.unix_server_sock = socket.socket(socket.AF_UNIX)
+        self.unix_server_sock.bind(self.path)
+        os.chmod(self.path, self.path_mode)
+        self.unix_server_sock.listen(self.backlog)
+        self.unix_server_sock.setblocking(False)
+        self.reactor.bind(self.unix_server_sock, reactor.READABLE,
+            self.on_connect)
+
+    def close(self):
+        """
+        Closes the server, as well as any active clients.
+        """
+        to_close = [sock for sock in self.clients.values()]
+        for sock in to_close:
+            self.close_client(sock)
+
+        self.network_handler.remove_change_listener(self.on_peer_change)
+        self.reactor.unbind(self.server_sock)
+        self.server_sock.close()
+
+        if self.unix_server_sock is not None:
+            self.reactor.unbind(self.unix_server_sock)
+            self.unix_server_sock.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def on_connect(self, event):
+        """
+        Handle connections on either of the server sockets, accepting every
+        client that is waiting rather than just the first one.
+        """
+        server_fd, _ = event
+        if server_fd == self.server_sock.fileno():
+            server_sock = self.server_sock
+        else:
+            server_sock = self.unix_server_sock
+
+        while True:
+            try:
+                client, _ = server_sock.accept()
+            except BlockingIOError:
+                break
+            except OSError as err:
+                # Most likely, we're out of file descriptors - the remaining
+                # clients will have to wait until some are freed
+                LOGGER.debug('Could not accept client: %s', err)
+                break
+
+            if len(self.clients) >= self.max_clients:
+                LOGGER.debug('Too many clients, dropping new connection')
+                self.connections_refused.inc()
+                client.close()
+                continue
+
+            self.connections_accepted.inc()
+            self.add_client(client)
+
+    def add_client(self, client):
+        """
+        Starts serving a newly accepted client.
+        """
+        client_fd = client.fileno()
+        client.setblocking(False)
+        self.clients[client_fd] = client
+        self.client_buffers[client_fd] = b''
+        self.client_out_buffers[client_fd] = b''
+        self.reactor.bind(client, reactor.READABLE, self.on_message_recv)
+
+        if self.idle_timeout is not None:
+            self.client_last_active[client_fd] = time.monotonic()
+            self.schedule_idle_check(client, self.idle_timeout)
+
+    def schedule_idle_check(self, client, delay):
+        """
+        Checks whether the client has gone idle after the given delay.
+        """
+        client_fd = client.fileno()
+        self.client_idle_timers[client_fd] = self.reactor.call_later(delay,
+            lambda: self.on_idle_check(client))
+
+    def on_idle_check(self, client):
+        """
+        Disconnects a client if it hasn't sent anything in too long, or
+        otherwise checks again when it could next become idle.
+        """
+        client_fd = client.fileno()
+        if client_fd == -1:
+            return
+
+        busy = (client_fd in self.subscribers or
+                self.is_parked(client_fd) or
+                self.client_out_buffers[client_fd])
+
+        idle_time = time.monotonic() - self.client_last_active[client_fd]
+        if busy or idle_time < self.idle_timeout:
+            if busy:
+                self.client_last_active[client_fd] = time.monotonic()
+                idle_time = 0
+            self.schedule_idle_check(client, self.idle_timeout - idle_time)
+        else:
+            LOGGER.debug('Dropping idle client %d', client_fd)
+            self.close_client(client)
+
+    def close_client(self, client_sock):
+        """
+        Closes the client with the given file descriptor, and destroys its
+        buffer.
+        """
+        client_fd = client_sock.fileno()
+        if client_fd == -1:
+            return
+
+        self.reactor.unbind(client_sock)
+        client_sock.close()
+
+        del self.clients[client_fd]
+        del self.client_buffers[client_fd]
+        del self.client_out_buffers[client_fd]
+        self.subscribers.pop(client_fd, None)
+
+        self.client_last_active.pop(client_fd, None)
+        idle_timer = self.client_idle_timers.pop(client_fd, None)
+        if idle_timer is not None:
+            idle_timer.cancel()
+
+        if client_fd in self.client_waits:
+            hostname, timer = self.client_waits[client_fd]
+            timer.cancel()
+            self.forget_wait(client_fd, hostname)
+
+        self.get_all_waiters.pop(client_fd, None)
+
+    def is_parked(self, client_fd):
+        """
+        Whether a client is waiting on a reply which isn't ready yet, in which
+        case any later messages from it aren't handled until that reply has
+        been sent.
+        """
+        return (client_fd in self.client_waits or
+                client_fd in self.get_all_waiters)
+
+    def send_to_client(self, client_sock, data):
+        """
+        Sends data to a client without blocking. Anything which can't be sent
+        right away is buffered, and sent once the client is writable again.
+        """
+        client_fd = client_sock.fileno()
+        out_buffer = self.client_out_buffers[client_fd]
+        if not out_buffer:
+            try:
+                sent = client_sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.close_client(client_sock)
+                return
+
+            self.bytes_out.inc(sent)
+            data = data[sent:]
+            if data:
+                self.reactor.bind(client_sock, reactor.WRITABLE,
+                    self.on_client_writable)
+
+        self.client_out_buffers[client_fd] = out_buffer + data
+
+    def on_client_writable(self, event):
+        """
+        Sends as much of a client's buffered output as it will take.
+        """
+        client_fd, _ = event
+        client_sock = self.clients[client_fd]
+        out_buffer = self.client_out_buffers[client_fd]
+        try:
+            sent = client_sock.send(out_buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_client(client_sock)
+            return
+
+        self.bytes_out.inc(sent)
+        out_buffer = out_buffer[sent:]
+        self.client_out_buffers[client_fd] = out_buffer
+        if not out_buffer:
+            self.reactor.unbind(client_sock, reactor.WRITABLE)
+
+    def pull_messages(self, client_fd, client_sock):
+        """
+        Pulls out messages from the client's buffer, until there aren't any
+        full messages to remove.
+        """
+        client_buffer_stream = utils.TransactionalBytesIO(
+            self.client_buffers[client_fd])
+        while not self.is_parked(client_fd):
+            json_message = None
+            with client_buffer_stream.get_transaction() as txn:
+                txn_stream = txn.get_stream()
+                try:
+                    # Note that we don't want to affect the read position if
+                    # no message is there, so use the transaction to save
+                    # the position and only update it when we're sure we
+                    # have a message.
+                    json_message = get_length_encoded_json(txn_stream)
+                    txn.commit()
+                except EOFError:
+                    txn.abort()
+                    break
+                except ValueError:
+                    pass
+
+            # This indicates an invalid message, because we read the whole
+            if json_message is None:
+                continue
+
+            try:
+                message_class = get_message_class(json_message)
+                message = message_class.unserialize(json_message)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # Messages we don't understand (possibly from a newer client)
+                # are ignored, rather than taking down the server
+                LOGGER.debug('Ignoring invalid message: %s', json_message)
+                self.invalid_requests.inc()
+                continue
+
+            if message_class not in self.request_metrics:
+                self.request_metrics[message_class] = (
+                    metrics.REGISTRY.counter('control_requests',
+                        type=message_class.TYPE),
+                    metrics.REGISTRY.histogram('control_request_latency',
+                        type=message_class.TYPE))
+
+            requests, latency = self.request_metrics[message_class]
+            requests.inc()
+            started_at = time.monotonic()
+            self.handle_message(client_sock, message)
+            latency.observe(time.monotonic() - started_at)
+            if client_sock.fileno() == -1:
+                # Handling the message may have dropped the client
+                return
+
+        self.client_buffers[client_fd] = client_buffer_stream.read()
+
+    def on_message_recv(self, event):
+        """
+        Handles a message sent by a client.
+        """
+        client_fd, _ = event
+        client_sock = self.clients[client_fd]
+        try:
+            chunk = client_sock.recv(utils.BUFFER_SIZE)
+            if not chunk:
+                self.close_client(client_sock)
+                return
+
+            self.bytes_in.inc(len(chunk))
+            if self.idle_timeout is not None:
+                self.client_last_active[client_fd] = time.monotonic()
+
+            self.client_buffers[client_fd] += chunk
+            self.pull_messages(client_fd, client_sock)
+        except BlockingIOError:
+            pass
+        except OSError:
+            # This happened occasionally during testing, causing the tests to
+            # crash
+            if client_sock.fileno() != -1:
+                self.close_client(client_sock)
+
+    def on_peer_change(self, ip, old_hostname, new_hostname):
+        """
+        Answers any clients waiting for a host that just appeared, and sends
+        an event describing the change to each of the subscribers interested
+        in it, dropping any subscribers which have fallen too far behind.
+        """
+        if new_hostname in self.host_waiters:
+            self.wake_waiters(new_hostname)
+
+        if not self.subscribers:
+            return
+
+        event = None
+        hostnames = [hostname for hostname in (old_hostname, new_hostname)
+            if hostname is not None]
+        for client_fd, (prefix, subnet) in list(self.subscribers.items()):
+            if prefix is not None:
+                if not any(hostname.startswith(prefix)
+                        for hostname in hostnames):
+                    continue
+
+            if subnet is not None and ipaddress.IPv4Address(ip) not in subnet:
+                continue
+
+            if event is None:
+                event = make_change_event(ip, old_hostname,
+                    new_hostname).serialize()
+
+            client_sock = self.clients[client_fd]
+            self.send_to_client(client_sock, event)
+            if client_fd not in self.subscribers:
+                # The send failed, and has already closed the client
+                continue
+
+            backlog = len(self.client_out_buffers[client_fd])
+            if backlog > MAX_SUBSCRIBER_BACKLOG:
+                LOGGER.debug('Dropping slow subscriber %d', client_fd)
+                self.close_client(client_sock)
+
+    def get_all_reply(self, client):
+        """
+        Gets the serialized :class:`NameIPMapping` reply for a :class:`GetAll`
+        request. The reply is only rebuilt when the peer table has changed
+        since the last time it was serialized.
+
+        Large replies are built on a worker thread, in which case the client
+        is parked until its reply is ready and this returns ``None``.
+        """
+        generation = self.network_handler.generation
+        cached_generation, cached_reply = self.get_all_cache
+        if cached_generation == generation:
+            return cached_reply
+
+        client_fd = client.fileno()
+        if generation in self.get_all_builds:
+            self.get_all_waiters[client_fd] = generation
+            return None
+
+        snapshot = self.network_handler.get_snapshot()
+        if len(snapshot.host_to_ips) < self.offload_hosts:
+            cached_reply = NameIPMapping(
+                snapshot.get_host_ip_map()).serialize()
+            self.get_all_cache = (generation, cached_reply)
+            return cached_reply
+
+        # The snapshot never changes, so the worker can read it while the
+        # reactor keeps changing the peer table
+        self.get_all_builds.add(generation)
+        self.get_all_waiters[client_fd] = generation
+        self.reactor.run_in_worker(
+            lambda: NameIPMapping(snapshot.get_host_ip_map()).serialize(),
+            lambda future: self.on_get_all_built(generation, future))
+        return None
+
+    def on_get_all_built(self, generation, future):
+        """
+        Sends a :class:`NameIPMapping` reply which was built on a worker
+        thread to every client waiting for it.
+        """
+        self.get_all_builds.discard(generation)
+        waiters = [client_fd
+            for client_fd, waiter_generation in self.get_all_waiters.items()
+            if waiter_generation == generation]
+
+        try:
+            reply = future.result()
+        except Exception as err:
+            LOGGER.error('Could not build a NameIPMapping reply: %s', err)
+            for client_fd in waiters:
+                self.close_client(self.clients[client_fd])
+            return
+
+        cached_generation, _ = self.get_all_cache
+        if cached_generation is None or cached_generation < generation:
+            self.get_all_cache = (generation, reply)
+
+        for client_fd in waiters:
+            del self.get_all_waiters[client_fd]
+            client_sock = self.clients[client_fd]
+            self.send_to_client(client_sock, reply)
+            if client_sock.fileno() != -1:
+                self.pull_messages(client_fd, client_sock)
+
+    def get_changes_reply(self, since):
+        """
+        Gets the serialized :class:`Changes` reply for a :class:`GetChanges`
+        request.
+        """
+        generation = self.network_handler.generation
+        changes = self.network_handler.get_changes_since(since)
+        if changes is None:
+            return Changes(generation, {}, [], {}, True).serialize()
+
+        added, removed, renamed = changes
+        try:
+            return Changes(generation, added, removed, renamed,
+                False).serialize()
+        except ValueError:
+            # Too many changes to fit in a message - the client can fetch the
+            # whole mapping instead, which can be split up
+            return Changes(generation, {}, [], {}, True).serialize()
+
+    def stats_reply(self):
+        """
+        Builds the :class:`Stats` reply to a :class:`GetStats` request.
+        """
+        if not self.serve_stats:
+            return Stats([], [], 'Stats are only kept by the main lnsd '
+                'process - connect through its Unix control socket')
+
+        return Stats(*metrics.REGISTRY.collect())
+
+    def profile_reply(self, message):
+        """
+        Starts or stops a profile for a :class:`Profile` request, and builds
+        the :class:`Profiling` reply.
+        """
+        if self.profiler is None:
+            return Profiling(None, None, 'Profiling is not available here')
+
+        try:
+            if message.action == 'start':
+                path = self.profiler.start(message.mode)
+            else:
+                path = self.profiler.stop()
+        except ValueError as err:
+            return Profiling(self.profiler.mode, self.profiler.path, str(err))
+
+        return Profiling(self.profiler.mode, path, None)
+
+    def subscribe(self, client, message):
+        """
+        Turns the given client into a subscriber, and acknowledges the
+        subscription.
+        """
+        subnet = None
+        if message.subnet is not None:
+            subnet = ipaddress.IPv4Network(message.subnet, strict=False)
+
+        self.subscribers[client.fileno()] = (message.prefix, subnet)
+        return Subscribed(self.network_handler.generation).serialize()
+
+    def wait_for_host(self, client, message):
+        """
+        Answers a :class:`WaitHost` request right away if the host is already
+        known, or otherwise parks the request until the host appears or the
+        request times out.
+        """
+        ip_addrs = self.network_handler.query_host(message.hostname)
+        if ip_addrs or message.timeout == 0:
+            return IP(ip_addrs).serialize()
+
+        client_fd = client.fileno()
+        timer = self.reactor.call_later(message.timeout,
+            lambda: self.on_wait_timeout(client_fd, message.hostname))
+        self.client_waits[client_fd] = (message.hostname, timer)
+        self.host_waiters.setdefault(message.hostname, set()).add(client_fd)
+        return None
+
+    def forget_wait(self, client_fd, hostname):
+        """
+        Removes a client's parked :class:`WaitHost` request.
+        """
+        del self.client_waits[client_fd]
+        waiters = self.host_waiters[hostname]
+        waiters.remove(client_fd)
+        if not waiters:
+            del self.host_waiters[hostname]
+
+    def finish_wait(self, client_fd, hostname, reply):
+        """
+        Sends the reply to a parked :class:`WaitHost` request, and then
+        handles any messages that the client sent while it was waiting.
+        """
+        self.forget_wait(client_fd, hostname)
+
+        client_sock = self.clients[client_fd]
+        self.send_to_client(client_sock, reply)
+        if client_sock.fileno() != -1:
+            self.pull_messages(client_fd, client_sock)
+
+    def wake_waiters(self, hostname):
+        """
+        Answers all the parked :class:`WaitHost` requests for a host.
+        """
+        reply = IP(self.network_handler.query_host(hostname)).serialize()
+        for client_fd in list(self.host_waiters[hostname]):
+            _, timer = self.client_waits[client_fd]
+            timer.cancel()
+            self.finish_wait(client_fd, hostname, reply)
+
+    def on_wait_timeout(self, client_fd, hostname):
+        """
+        Answers a parked :class:`WaitHost` request whose timeout has expired.
+        """
+        self.finish_wait(client_fd, hostname, IP([]).serialize())
+
+    def handle_message(self, client, message):
+        """
+        Processes the given message which was received from the given client.
+        """
+        if client.fileno() in self.subscribers:
+            # Subscribed clients only receive events, so there's no way for
+            # them to tell replies apart from events
+            return
+
         reply = None
         if isinstance(message, Host):
             ip_addrs = self.network_handler.query_host(message.hostname)
-            reply = IP(ip_addrs)
+            reply = IP(ip_addrs).serialize()
         elif isinstance(message, IP):
             if len(message.ip_addrs) == 1:
                 hostname = self.network_handler.query_ip(message.ip_addrs[0])
-                reply = Host(hostname)
+                reply = Host(hostname).serialize()
         elif isinstance(message, GetAll):
-            host_ip_mapping = self.network_handler.get_host_ip_map()
-            reply = NameIPMapping(host_ip_mapping)
+            reply = self.get_all_reply(client)
+        elif isinstance(message, GetChanges):
+            reply = self.get_changes_reply(message.since)
+        elif isinstance(message, Subscribe):
+            reply = self.subscribe(client, message)
+        elif isinstance(message, WaitHost):
+            reply = self.wait_for_host(client, message)
+        elif isinstance(message, GetStats):
+            reply = self.stats_reply().serialize()
+        elif isinstance(message, Profile):
+            reply = self.profile_reply(message).serialize()
         elif isinstance(message, Quit):
             self.done = True
 
         if reply is not None:
-            client.sendall(reply.serialize())
+            self.send_to_client(client, reply)
@@ -0,0 +1,427 @@
+"""
+DNS Protocol
+------------
+
+This implements a small DNS responder on top of the host-name mapping, so
+that programs which only know how to use DNS (including the libc resolver)
+can look up LNS hosts.
+
+Only a single pseudo-domain is served. ``A`` queries for names within it are
+answered with the addresses of the LNS host of the same name (``foo.lan`` is
+the host ``foo``, when the domain is ``lan``), and ``PTR`` queries under
+``in-addr.arpa`` are answered with the name of the LNS host at that address.
+Names within the domain that aren't known get ``NXDOMAIN``, and anything else
+gets ``REFUSED``, so that a forwarding resolver can ask somewhere else. DNS
+names don't care about case, but LNS hostnames do - hosts whose names differ
+only by case are all the same DNS name, which is answered with the addresses
+of every one of them.
+
+Queries are accepted over both UDP and TCP. Since the same names tend to be
+asked for over and over, each answer is built once and cached by the exact
+question it answers, until the peer table changes.
+"""
+import logging
+import socket
+import struct
+
+from lns import net_proto, reactor, utils
+
+LOGGER = logging.getLogger('lns.dns_proto')
+
+DNS_PORT = 53
+DNS_ADDRESS = '127.0.0.1'
+DNS_DOMAIN = 'lan'
+
+# How long resolvers may cache our answers, in seconds. Hosts re-announce
+# themselves this often, so anything longer risks handing out stale addresses.
+DNS_TTL = net_proto.ANNOUNCE_ALARM
+
+# The largest response that can be sent over UDP without EDNS - anything
+# larger is truncated, so that the client retries over TCP
+MAX_UDP_SIZE = 512
+
+# How long a TCP client can stay connected, in seconds
+TCP_TIMEOUT = 10
+
+# How many distinct questions have their answers cached. Since anybody can ask
+# about any name, the cache is emptied when it gets this big, so that it
+# can't be used to eat up memory.
+MAX_CACHED_ANSWERS = 4096
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION_TAIL = struct.Struct('!HH')
+RECORD_TAIL = struct.Struct('!HHIH')
+TCP_LENGTH = struct.Struct('!H')
+
+TYPE_A = 1
+TYPE_PTR = 12
+CLASS_IN = 1
+
+FLAG_RESPONSE = 0x8000
+FLAG_AUTHORITATIVE = 0x0400
+FLAG_TRUNCATED = 0x0200
+FLAG_RECURSION_DESIRED = 0x0100
+OPCODE_MASK = 0x7800
+
+RCODE_OK = 0
+RCODE_FORMAT_ERROR = 1
+RCODE_NXDOMAIN = 3
+RCODE_NOT_IMPLEMENTED = 4
+RCODE_REFUSED = 5
+
+# A compression pointer to the name in the question, which always starts
+# right after the header
+QUESTION_NAME_POINTER = struct.pack('!H', 0xC000 | HEADER.size)
+
+REVERSE_SUFFIX = ('in-addr', 'arpa')
+
+def parse_question(packet):
+    """
+    Pulls the question out of a query, producing the raw bytes of the
+    question, its name as a list of labels, its type and its class.
+
+    :raises ValueError: If the query is malformed.
+    """
+    offset = HEADER.size
+    labels = []
+    while True:
+        if offset >= len(packet):
+            raise ValueError('Question name runs past the end of the packet')
+
+        length = packet[offset]
+        offset += 1
+        if length == 0:
+            break
+        elif length > 63:
+            # Compression pointers aren't allowed in queries' questions
+            raise ValueError('Invalid label length {}'.format(length))
+
+        label = packet[offset:offset + length]
+        if len(label) != length:
+            raise ValueError('Label runs past the end of the packet')
+
+        labels.append(label.decode('ascii', errors='replace'))
+        offset += length
+
+    if offset + QUESTION_TAIL.size > len(packet):
+        raise ValueError('Question runs past the end of the packet')
+
+    qtype, qclass = QUESTION_TAIL.unpack_from(packet, offset)
+    offset += QUESTION_TAIL.size
+    return packet[HEADER.size:offset], labels, qtype, qclass
+
+def encode_name(labels):
+    """
+    Encodes a list of labels into a DNS name.
+
+    :raises ValueError: If any label can't be represented in DNS.
+    """
+    encoded = b''
+    for label in labels:
+        raw_label = label.encode('ascii')
+        if not raw_label or len(raw_label) > 63:
+            raise ValueError('Label {!r} cannot be encoded'.format(label))
+        encoded += bytes([len(raw_label)]) + raw_label
+    return encoded + b'\x00'
+
+class ProtocolHandler:
+    """
+    Answers DNS queries for the hosts known by the network handler, over UDP
+    and TCP.
+    """
+    def __init__(self, network_handler, a_reactor, domain=DNS_DOMAIN,
+            port=DNS_PORT, address=DNS_ADDRESS):
+        self.network_handler = network_handler
+        self.reactor = a_reactor
+        self.domain = [label.lower() for label in domain.split('.') if label]
+        self.port = port
+        self.address = address
+
+        self.udp_sock = None
+        self.tcp_sock = None
+        self.tcp_clients = {}
+        self.tcp_buffers = {}
+        self.tcp_out_buffers = {}
+        self.tcp_timers = {}
+
+        # Maps the raw bytes of each question we've answered to the response
+        # code, answer count and answer section of the reply. These are only
+        # valid for the generation of the peer table they came from.
+        self.answer_cache = {}
+        self.cache_generation = None
+        self.lowercase_hosts = {}
+
+    def open(self):
+        """
+        Opens up the UDP and TCP sockets for answering queries.
+        """
+        LOGGER.debug('Serving DNS for %s on %s:%d',
+            '.'.join(self.domain), self.address, self.port)
+
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind((self.address, self.port))
+        self.udp_sock.setblocking(False)
+        self.reactor.bind(self.udp_sock, reactor.READABLE, self.on_datagram)
+
+        self.tcp_sock = socket.socket()
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_sock.bind((self.address, self.port))
+        self.tcp_sock.listen(16)
+        self.tcp_sock.setblocking(False)
+        self.reactor.bind(self.tcp_sock, reactor.READABLE, self.on_connect)
+
+    def close(self):
+        """
+        Closes the DNS sockets, and any TCP clients.
+        """
+        for client in list(self.tcp_clients.values()):
+            self.close_client(client)
+
+        self.reactor.unbind(self.udp_sock)
+        self.udp_sock.close()
+        self.reactor.unbind(self.tcp_sock)
+        self.tcp_sock.close()
+
+    def refresh_cache(self):
+        """
+        Throws away the cached answers if the peer table has changed since
+        they were built.
+        """
+        generation = self.network_handler.generation
+        if generation != self.cache_generation:
+            self.answer_cache = {}
+            self.lowercase_hosts = {}
+            for host, ips in self.network_handler.get_host_ip_map().items():
+                lower_host = host.lower()
+                if lower_host in self.lowercase_hosts:
+                    LOGGER.debug('Answering %s.%s with the addresses of '
+                        'several hosts', lower_host, '.'.join(self.domain))
+                    self.lowercase_hosts[lower_host] += ips
+                else:
+                    self.lowercase_hosts[lower_host] = list(ips)
+            self.cache_generation = generation
+
+    def answer_question(self, labels, qtype, qclass):
+        """
+        Looks up the answer to a question, producing the response code and a
+        list of encoded resource records (which are all relative to the name
+        in the question).
+        """
+        lower_labels = [label.lower() for label in labels]
+        domain_length = len(self.domain)
+        if (len(lower_labels) > domain_length and
+                lower_labels[-domain_length:] == self.domain):
+            hostname = '.'.join(lower_labels[:-domain_length])
+            ips = self.lowercase_hosts.get(hostname)
+            if ips is None:
+                return RCODE_NXDOMAIN, []
+
+            if qtype != TYPE_A or qclass != CLASS_IN:
+                # The name exists, it just doesn't have any records of the
+                # requested type
+                return RCODE_OK, []
+
+            records = []
+            for ip in sorted(ips):
+                rdata = socket.inet_aton(ip)
+                records.append(QUESTION_NAME_POINTER +
+                    RECORD_TAIL.pack(TYPE_A, CLASS_IN, DNS_TTL, len(rdata)) +
+                    rdata)
+            return RCODE_OK, records
+
+        if (len(lower_labels) == 6 and
+                tuple(lower_labels[4:]) == REVERSE_SUFFIX and
+                qtype == TYPE_PTR and qclass == CLASS_IN):
+            ip = '.'.join(reversed(lower_labels[:4]))
+            hostname = self.network_handler.query_ip(ip)
+            if hostname is None:
+                return RCODE_REFUSED, []
+
+            try:
+                rdata = encode_name(hostname.split('.') + self.domain)
+            except ValueError:
+                return RCODE_REFUSED, []
+
+            return RCODE_OK, [QUESTION_NAME_POINTER +
+                RECORD_TAIL.pack(TYPE_PTR, CLASS_IN, DNS_TTL, len(rdata)) +
+                rdata]
+
+        return RCODE_REFUSED, []
+
+    def build_response(self, packet, max_size=None):
+        """
+        Builds the response to a query, or returns ``None`` if the query is
+        too mangled to respond to at all.
+        """
+        if len(packet) < HEADER.size:
+            return None
+
+        query_id, query_flags, qdcount, _, _, _ = HEADER.unpack_from(packet)
+        if query_flags & FLAG_RESPONSE:
+            return None
+
+        flags = (FLAG_RESPONSE | FLAG_AUTHORITATIVE |
+            (query_flags & (OPCODE_MASK | FLAG_RECURSION_DESIRED)))
+
+        if query_flags & OPCODE_MASK:
+            return HEADER.pack(query_id, flags | RCODE_NOT_IMPLEMENTED,
+                0, 0, 0, 0)
+
+        try:
+            if qdcount != 1:
+                raise ValueError('Expected exactly one question')
+            question, labels, qtype, qclass = parse_question(packet)
+        except ValueError:
+            return HEADER.pack(query_id, flags | RCODE_FORMAT_ERROR,
+                0, 0, 0, 0)
+
+        self.refresh_cache()
+        cached = self.answer_cache.get(question)
+        if cached is None:
+            rcode, records = self.answer_question(labels, qtype, qclass)
+            cached = (rcode, len(records), b''.join(records))
+            if len(self.answer_cache) >= MAX_CACHED_ANSWERS:
+                self.answer_cache = {}
+            self.answer_cache[question] = cached
+
+        rcode, answer_count, answers = cached
+        response = (HEADER.pack(query_id, flags | rcode, 1, answer_count, 0, 0)
+            + question + answers)
+
+        if max_size is not None and len(response) > max_size:
+            response = (HEADER.pack(query_id, flags | rcode | FLAG_TRUNCATED,
+                1, 0, 0, 0) + question)
+
+        return response
+
+    def on_datagram(self, _):
+        """
+        Answers a query sent over UDP.
+        """
+        try:
+            packet, addr = self.udp_sock.recvfrom(MAX_UDP_SIZE)
+        except BlockingIOError:
+            return
+
+        response = self.build_response(packet, MAX_UDP_SIZE)
+        if response is not None:
+            try:
+                self.udp_sock.sendto(response, addr)
+            except OSError as err:
+                LOGGER.debug('Could not answer %s: %s', addr, err)
+
+    def on_connect(self, _):
+        """
+        Accepts any clients waiting to send queries over TCP.
+        """
+        while True:
+            try:
+                client, _ = self.tcp_sock.accept()
+            except BlockingIOError:
+                break
+            except OSError as err:
+                LOGGER.debug('Could not accept DNS client: %s', err)
+                break
+
+            client_fd = client.fileno()
+            client.setblocking(False)
+            self.tcp_clients[client_fd] = client
+            self.tcp_buffers[client_fd] = b''
+            self.tcp_out_buffers[client_fd] = b''
+            self.tcp_timers[client_fd] = self.reactor.call_later(TCP_TIMEOUT,
+                lambda client=client: self.close_client(client))
+            self.reactor.bind(client, reactor.READABLE, self.on_tcp_recv)
+
+    def close_client(self, client):
+        """
+        Disconnects a TCP client.
+        """
+        client_fd = client.fileno()
+        if client_fd == -1:
+            return
+
+        self.reactor.unbind(client)
+        client.close()
+
+        del self.tcp_clients[client_fd]
+        del self.tcp_buffers[client_fd]
+        del self.tcp_out_buffers[client_fd]
+        self.tcp_timers.pop(client_fd).cancel()
+
+    def on_tcp_recv(self, event):
+        """
+        Answers any complete queries sent by a TCP client.
+        """
+        client_fd, _ = event
+        client = self.tcp_clients[client_fd]
+        try:
+            chunk = client.recv(utils.BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_client(client)
+            return
+
+        if not chunk:
+            self.close_client(client)
+            return
+
+        buffer = self.tcp_buffers[client_fd] + chunk
+        responses = b''
+        while len(buffer) >= TCP_LENGTH.size:
+            length, = TCP_LENGTH.unpack_from(buffer)
+            if len(buffer) < TCP_LENGTH.size + length:
+                break
+
+            packet = buffer[TCP_LENGTH.size:TCP_LENGTH.size + length]
+            buffer = buffer[TCP_LENGTH.size + length:]
+
+            response = self.build_response(packet)
+            if response is not None:
+                responses += TCP_LENGTH.pack(len(response)) + response
+
+        self.tcp_buffers[client_fd] = buffer
+        if responses:
+            self.send_to_client(client, responses)
+
+    def send_to_client(self, client, data):
+        """
+        Sends responses to a TCP client without blocking, buffering anything
+        that it won't take right away.
+        """
+        client_fd = client.fileno()
+        out_buffer = self.tcp_out_buffers[client_fd]
+        if not out_buffer:
+            try:
+                sent = client.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.close_client(client)
+                return
+
+            data = data[sent:]
+            if data:
+                self.reactor.bind(client, reactor.WRITABLE,
+                    self.on_tcp_writable)
+
+        self.tcp_out_buffers[client_fd] = out_buffer + data
+
+    def on_tcp_writable(self, event):
+        """
+        Sends as much of a TCP client's buffered responses as it will take.
+        """
+        client_fd, _ = event
+        client = self.tcp_clients[client_fd]
+        try:
+            sent = client.send(self.tcp_out_buffers[client_fd])
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_client(client)
+            return
+
+        out_buffer = self.tcp_out_buffers[client_fd][sent:]
+        self.tcp_out_buffers[client_fd] = out_buffer
+        if not out_buffer:
+            self.reactor.unbind(client, reactor.WRITABLE)
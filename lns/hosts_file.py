@@ -0,0 +1,148 @@
+"""
+Hosts File
+----------
+
+This keeps a file in the format of ``/etc/hosts`` up to date with the
+host-name mapping, so that the libc resolver can find LNS hosts without any
+help from lnsd.
+
+The file is only rewritten when the peer table changes, and not more often
+than once every few seconds, so that a burst of hosts joining the network
+produces a single rewrite. The rewrite itself happens on a background thread,
+so that writing out a large table doesn't hold up the reactor, and it
+replaces the file atomically so that readers never see half of it.
+"""
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger('lns.hosts_file')
+
+# How long to wait after the peer table changes before rewriting the file, so
+# that any other changes happening around the same time are written together
+HOSTS_FILE_DELAY = 2
+
+HEADER = '# Generated by lnsd - any changes will be overwritten\n'
+
+def render_hosts(host_to_ips):
+    """
+    Produces the contents of a hosts file from a host to IP address mapping.
+    Hosts whose names can't appear in a hosts file are left out.
+    """
+    lines = [HEADER]
+    entries = sorted((ip, host)
+        for host, ips in host_to_ips.items()
+        for ip in ips
+        if host.isprintable() and not any(char.isspace() or char == '#'
+            for char in host))
+
+    for ip, host in entries:
+        lines.append('{}\t{}\n'.format(ip, host))
+    return ''.join(lines)
+
+def write_atomically(path, contents):
+    """
+    Replaces the contents of a file, by writing a temporary file alongside it
+    and then renaming it over the original.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(contents)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+
+class HostsFileExporter:
+    """
+    Writes the network handler's peer table out to a hosts file whenever it
+    changes.
+    """
+    def __init__(self, network_handler, a_reactor, path,
+            delay=HOSTS_FILE_DELAY):
+        self.network_handler = network_handler
+        self.reactor = a_reactor
+        self.path = path
+        self.delay = delay
+
+        self.seen_generation = None
+        self.write_timer = None
+
+        # The most recent mapping that hasn't been written yet (or None), and
+        # whether the writer thread should exit - both are protected by the
+        # condition
+        self.pending = None
+        self.done = False
+        self.condition = threading.Condition()
+        self.writer_thread = None
+
+    def open(self):
+        """
+        Writes out the current table, and starts rewriting it on changes.
+        """
+        self.writer_thread = threading.Thread(target=self.run_writer,
+            name='lnsd hosts file writer')
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+        self.on_write_timer()
+        self.reactor.add_step_callback(self.on_step)
+
+    def close(self):
+        """
+        Stops rewriting the table, after finishing any pending write.
+        """
+        if self.write_timer is not None:
+            self.write_timer.cancel()
+
+        with self.condition:
+            self.done = True
+            self.condition.notify()
+
+        self.writer_thread.join()
+
+    def on_step(self):
+        """
+        Schedules a rewrite if the table has changed, unless one is already
+        scheduled.
+        """
+        if (self.network_handler.generation != self.seen_generation and
+                self.write_timer is None):
+            self.write_timer = self.reactor.call_later(self.delay,
+                self.on_write_timer)
+
+    def on_write_timer(self):
+        """
+        Hands the current table to the writer thread.
+        """
+        self.write_timer = None
+        self.seen_generation = self.network_handler.generation
+        host_to_ips = self.network_handler.get_host_ip_map()
+
+        with self.condition:
+            self.pending = host_to_ips
+            self.condition.notify()
+
+    def run_writer(self):
+        """
+        Writes out each table handed over by the reactor thread. If several
+        tables are handed over while a write is in progress, only the last of
+        them is written.
+        """
+        while True:
+            with self.condition:
+                while self.pending is None and not self.done:
+                    self.condition.wait()
+
+                host_to_ips = self.pending
+                self.pending = None
+                if host_to_ips is None:
+                    return
+
+            try:
+                write_atomically(self.path, render_hosts(host_to_ips))
+                LOGGER.debug('Wrote %d hosts to %s', len(host_to_ips),
+                    self.path)
+            except OSError as err:
+                LOGGER.error('Could not write %s: %s', self.path, err)
@@ -0,0 +1,442 @@
+"""
+HTTP Metrics
+------------
+
+This serves the counters and histograms in the :mod:`lns.metrics` registry
+over HTTP, in the Prometheus text format, so that monitoring systems which
+scrape Prometheus endpoints can watch lnsd without speaking the control
+protocol.
+
+Only ``GET`` (and ``HEAD``) requests for ``/metrics`` are answered. Every
+metric is prefixed with ``lnsd_``, counters get the ``_total`` suffix, and
+histograms are reported with cumulative buckets. The number of known peers and
+the generation of the peer table are reported as gauges.
+
+The listener runs on the reactor, alongside everything else. Connections are
+kept alive between requests (unless the client asks otherwise), responses are
+sent without blocking, and the rendered page is reused for
+:const:`METRICS_CACHE_TIME` seconds, so that a scraper polling very often
+can't make lnsd spend its time rendering metrics.
+
+While it is open, the server also runs a heartbeat timer every
+:const:`HEARTBEAT_INTERVAL` seconds, and records how late it fires in the
+``reactor_loop_lag`` histogram. The reactor's other timers only say how busy
+the loop was when something was due, so without the heartbeat an idle (or a
+completely stuck) loop wouldn't be reported at all.
+"""
+import logging
+import math
+import socket
+import time
+
+from lns import metrics, reactor, utils
+
+LOGGER = logging.getLogger('lns.http_metrics')
+
+METRICS_PORT = 9771
+METRICS_ADDRESS = '127.0.0.1'
+
+# How long a rendered page is served before the metrics are rendered again,
+# in seconds
+METRICS_CACHE_TIME = 1
+
+# How long a connection can go without sending a request, in seconds
+METRICS_CLIENT_TIMEOUT = 30
+
+# How many scrapers can be connected at once - anybody else is disconnected
+METRICS_MAX_CLIENTS = 64
+
+# The largest request header that is accepted, in bytes
+MAX_REQUEST_SIZE = 8192
+
+# How often the heartbeat which measures the reactor's loop lag fires, in
+# seconds
+HEARTBEAT_INTERVAL = 1
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 431: 'Request Header Fields Too Large'}
+
+def escape_label_value(value):
+    """
+    Escapes a label value, as the Prometheus text format requires.
+
+        >>> escape_label_value('a"b')
+        'a\\\\"b'
+    """
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
+
+def format_value(value):
+    """
+    Formats a sample value (or a bucket bound).
+
+        >>> format_value(3)
+        '3'
+        >>> format_value(0.25)
+        '0.25'
+        >>> format_value(math.inf)
+        '+Inf'
+    """
+    if math.isinf(value):
+        return '+Inf'
+    return repr(value)
+
+def format_sample(name, labels, value):
+    """
+    Formats a single sample line.
+
+        >>> format_sample('lnsd_peers', {}, 3)
+        'lnsd_peers 3'
+        >>> format_sample('lnsd_bytes_in_total', {'socket': 'net'}, 512)
+        'lnsd_bytes_in_total{socket="net"} 512'
+    """
+    value = format_value(value)
+    if not labels:
+        return '{} {}'.format(name, value)
+
+    return '{}{{{}}} {}'.format(name, ','.join(
+        '{}="{}"'.format(label, escape_label_value(label_value))
+        for label, label_value in sorted(labels.items())), value)
+
+def render_metrics(registry, snapshot):
+    """
+    Renders the metrics in a registry, along with gauges describing a
+    :class:`lns.net_proto.Snapshot` of the peer table, in the Prometheus text
+    format.
+    """
+    lines = [
+        '# TYPE lnsd_peers gauge',
+        format_sample('lnsd_peers', {}, len(snapshot.ip_to_host)),
+        '# TYPE lnsd_table_generation gauge',
+        format_sample('lnsd_table_generation', {}, snapshot.generation),
+    ]
+
+    counters, histograms = registry.collect()
+
+    last_name = None
+    for counter in counters:
+        name = 'lnsd_{}_total'.format(counter['name'])
+        if name != last_name:
+            lines.append('# TYPE {} counter'.format(name))
+            last_name = name
+        lines.append(format_sample(name, counter['labels'], counter['value']))
+
+    last_name = None
+    for histogram in histograms:
+        name = 'lnsd_{}_seconds'.format(histogram['name'])
+        if name != last_name:
+            lines.append('# TYPE {} histogram'.format(name))
+            last_name = name
+
+        labels = histogram['labels']
+        seen = 0
+        for bound, count in zip(histogram['bounds'] + [math.inf],
+                histogram['counts']):
+            seen += count
+            lines.append(format_sample(name + '_bucket',
+                dict(labels, le=format_value(bound)), seen))
+        lines.append(format_sample(name + '_sum', labels, histogram['sum']))
+        lines.append(format_sample(name + '_count', labels, seen))
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def parse_request(header):
+    """
+    Parses the header of an HTTP request, returning the method, the path
+    (without any query string), and whether the connection should be kept
+    open afterwards.
+
+    :raises ValueError: If the request line is malformed.
+    """
+    lines = header.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/1.'):
+        raise ValueError('Unsupported HTTP version ' + version)
+
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+    if headers.get('content-length', '0') != '0':
+        raise ValueError('Requests with bodies are not supported')
+
+    if version == 'HTTP/1.0':
+        keep_alive = headers.get('connection') == 'keep-alive'
+    else:
+        keep_alive = headers.get('connection') != 'close'
+
+    return method, target.split('?', 1)[0], keep_alive
+
+class MetricsServer:
+    """
+    Serves the metrics registry in the Prometheus text format, to HTTP
+    clients on the given address and port.
+    """
+    def __init__(self, network_handler, a_reactor, port=METRICS_PORT,
+            address=METRICS_ADDRESS, cache_time=METRICS_CACHE_TIME,
+            registry=metrics.REGISTRY):
+        self.network_handler = network_handler
+        self.reactor = a_reactor
+        self.port = port
+        self.address = address
+        self.cache_time = cache_time
+        self.registry = registry
+
+        self.server_sock = None
+        self.clients = {}
+        self.buffers = {}
+        self.out_buffers = {}
+        self.timers = {}
+
+        # The clients which are closed once their responses have been sent
+        self.closing = set()
+
+        # The last rendered page, and when it was rendered
+        self.page = None
+        self.page_time = None
+
+        # When the heartbeat should fire next, which it is late by however
+        # long the reactor was kept from getting to it
+        self.heartbeat_timer = None
+        self.heartbeat_deadline = None
+        self.loop_lag = self.registry.histogram('reactor_loop_lag')
+
+    def open(self):
+        """
+        Opens up the listening socket.
+        """
+        LOGGER.debug('Serving metrics on %s:%d', self.address, self.port)
+
+        self.server_sock = socket.socket()
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_sock.bind((self.address, self.port))
+        self.server_sock.listen(16)
+        self.server_sock.setblocking(False)
+        self.reactor.bind(self.server_sock, reactor.READABLE, self.on_connect)
+        self.schedule_heartbeat()
+
+    def close(self):
+        """
+        Closes the listening socket, and any clients.
+        """
+        self.heartbeat_timer.cancel()
+        for client in list(self.clients.values()):
+            self.close_client(client)
+
+        self.reactor.unbind(self.server_sock)
+        self.server_sock.close()
+
+    def schedule_heartbeat(self):
+        """
+        Starts the timer for the next heartbeat.
+        """
+        self.heartbeat_deadline = time.monotonic() + HEARTBEAT_INTERVAL
+        self.heartbeat_timer = self.reactor.call_later(HEARTBEAT_INTERVAL,
+            self.on_heartbeat)
+
+    def on_heartbeat(self):
+        """
+        Records how late the heartbeat fired, and schedules the next one.
+        """
+        lag = time.monotonic() - self.heartbeat_deadline
+        self.loop_lag.observe(max(0, lag))
+        self.schedule_heartbeat()
+
+    def get_page(self):
+        """
+        Gets the rendered metrics, rendering them again if the last page is
+        too old.
+        """
+        now = time.monotonic()
+        if self.page is None or now - self.page_time >= self.cache_time:
+            self.page = render_metrics(self.registry,
+                self.network_handler.get_snapshot())
+            self.page_time = now
+        return self.page
+
+    def on_connect(self, _):
+        """
+        Accepts any clients waiting to connect.
+        """
+        while True:
+            try:
+                client, _ = self.server_sock.accept()
+            except BlockingIOError:
+                break
+            except OSError as err:
+                LOGGER.debug('Could not accept metrics client: %s', err)
+                break
+
+            if len(self.clients) >= METRICS_MAX_CLIENTS:
+                LOGGER.debug('Too many metrics clients, dropping new one')
+                client.close()
+                continue
+
+            client_fd = client.fileno()
+            client.setblocking(False)
+            self.clients[client_fd] = client
+            self.buffers[client_fd] = b''
+            self.out_buffers[client_fd] = b''
+            self.reset_timer(client)
+            self.reactor.bind(client, reactor.READABLE, self.on_recv)
+
+    def reset_timer(self, client):
+        """
+        Restarts the timer which disconnects a client that has gone quiet.
+        """
+        client_fd = client.fileno()
+        if client_fd in self.timers:
+            self.timers[client_fd].cancel()
+
+        self.timers[client_fd] = self.reactor.call_later(
+            METRICS_CLIENT_TIMEOUT, lambda: self.close_client(client))
+
+    def close_client(self, client):
+        """
+        Disconnects a client.
+        """
+        client_fd = client.fileno()
+        if client_fd == -1:
+            return
+
+        self.reactor.unbind(client)
+        client.close()
+
+        del self.clients[client_fd]
+        del self.buffers[client_fd]
+        del self.out_buffers[client_fd]
+        self.closing.discard(client_fd)
+        self.timers.pop(client_fd).cancel()
+
+    def build_response(self, status, body, keep_alive, include_body=True):
+        """
+        Builds an HTTP response with the given status and body.
+        """
+        header = ('HTTP/1.1 {} {}\r\n'
+                  'Content-Type: {}\r\n'
+                  'Content-Length: {}\r\n'
+                  'Connection: {}\r\n'
+                  '\r\n').format(status, REASONS[status],
+            CONTENT_TYPE if status == 200 else 'text/plain',
+            len(body), 'keep-alive' if keep_alive else 'close')
+        return header.encode('ascii') + (body if include_body else b'')
+
+    def answer_request(self, header):
+        """
+        Builds the response to a request, returning it along with whether the
+        connection should be kept open.
+        """
+        try:
+            method, path, keep_alive = parse_request(header)
+        except ValueError:
+            return self.build_response(400, b'Bad request\n', False), False
+
+        if method not in ('GET', 'HEAD'):
+            return (self.build_response(405, b'Only GET is allowed\n',
+                keep_alive), keep_alive)
+
+        if path != '/metrics':
+            return (self.build_response(404, b'Try /metrics\n', keep_alive),
+                keep_alive)
+
+        return (self.build_response(200, self.get_page(), keep_alive,
+            include_body=method == 'GET'), keep_alive)
+
+    def on_recv(self, event):
+        """
+        Answers any complete requests sent by a client.
+        """
+        client_fd, _ = event
+        client = self.clients[client_fd]
+        try:
+            chunk = client.recv(utils.BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_client(client)
+            return
+
+        if not chunk:
+            self.close_client(client)
+            return
+
+        if client_fd in self.closing:
+            # Anything sent after a request which closes the connection is
+            # ignored
+            return
+
+        buffer = self.buffers[client_fd] + chunk
+        responses = b''
+        keep_alive = True
+        while keep_alive:
+            end = buffer.find(b'\r\n\r\n')
+            if end == -1:
+                if len(buffer) > MAX_REQUEST_SIZE:
+                    responses += self.build_response(431,
+                        b'Request too large\n', False)
+                    keep_alive = False
+                break
+
+            header, buffer = buffer[:end], buffer[end + 4:]
+            response, keep_alive = self.answer_request(header)
+            responses += response
+
+        self.buffers[client_fd] = buffer
+        if responses:
+            self.reset_timer(client)
+        if not keep_alive:
+            self.closing.add(client_fd)
+        self.send_to_client(client, responses)
+
+    def send_to_client(self, client, data):
+        """
+        Sends responses to a client without blocking, buffering anything that
+        it won't take right away. Clients which asked to be disconnected are
+        disconnected once everything has been sent.
+        """
+        client_fd = client.fileno()
+        out_buffer = self.out_buffers[client_fd]
+        if not out_buffer and data:
+            try:
+                sent = client.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.close_client(client)
+                return
+
+            data = data[sent:]
+            if data:
+                self.reactor.bind(client, reactor.WRITABLE, self.on_writable)
+
+        out_buffer += data
+        self.out_buffers[client_fd] = out_buffer
+        if not out_buffer and client_fd in self.closing:
+            self.close_client(client)
+
+    def on_writable(self, event):
+        """
+        Sends as much of a client's buffered responses as it will take.
+        """
+        client_fd, _ = event
+        client = self.clients[client_fd]
+        out_buffer = self.out_buffers[client_fd]
+        try:
+            sent = client.send(out_buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_client(client)
+            return
+
+        out_buffer = out_buffer[sent:]
+        self.out_buffers[client_fd] = out_buffer
+        if not out_buffer:
+            if client_fd in self.closing:
+                self.close_client(client)
+            else:
+                self.reactor.unbind(client, reactor.WRITABLE)
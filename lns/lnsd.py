@@ -5,32 +5,162 @@ as command line options.
 """
 import configparser
 import getopt
-import logging
+import os
+import shutil
+import signal
 import socket
 import sys
+import tempfile
 
-from lns import daemon, control_proto, net_proto, reactor, utils
+from lns import (daemon, control_proto, dns_proto, hosts_file, http_metrics,
+    log_queue, net_proto, profiler, reactor, shared_table, trace, utils,
+    watchdog, workers)
 
 class LNSDaemon(daemon.Daemon):
-    def run(self, hostname, control_port, network_port):
+    def run(self, config):
+        # The log writer is a thread, so it has to be started after lnsd has
+        # become a daemon
+        log_options = None
+        log_pipeline = None
+        if config.get_verbose():
+            log_options = {'levels': config.get_log_levels(),
+                'packet_sample': config.get_packet_log_sample(),
+                'queue_size': config.get_log_queue_size()}
+            log_pipeline = log_queue.LogPipeline(sys.stderr, **log_options)
+            log_pipeline.open()
+
         my_reactor = reactor.Reactor()
-        net_handler = net_proto.ProtocolHandler(my_reactor, hostname,
-            port=network_port)
+        if config.get_slow_callback_threshold() is not None:
+            my_reactor.enable_monitoring(config.get_slow_callback_threshold(),
+                config.get_stall_deadline())
+
+        packet_trace = None
+        if config.get_trace_path() is not None:
+            packet_trace = trace.TraceWriter(my_reactor,
+                config.get_trace_path(), port=config.get_network_port(),
+                max_size=config.get_trace_max_size())
+
+        net_handler = net_proto.ProtocolHandler(my_reactor, config.get_name(),
+            port=config.get_network_port(),
+            address=config.get_network_address(),
+            broadcast_addresses=config.get_broadcast_addresses(),
+            announce_interval=config.get_announce_interval(),
+            announce_ttl=config.get_announce_ttl(),
+            trace=packet_trace)
+        my_profiler = profiler.Profiler(my_reactor, config.get_profile_dir())
         control_handler = control_proto.ProtocolHandler(net_handler,
-            my_reactor, port=control_port)
-
+            my_reactor, port=config.get_control_port(),
+            path=config.get_control_path(),
+            path_mode=config.get_control_path_mode(),
+            backlog=config.get_backlog(),
+            max_clients=config.get_max_clients(),
+            idle_timeout=config.get_client_idle_timeout(),
+            reuse_port=config.get_workers() > 0,
+            profiler=my_profiler)
+
+        # Workers read the peer table from the shared table, so it has to be
+        # published somewhere even if nobody else wants it
+        table_path = config.get_table_path()
+        table_dir = None
+        if table_path is None and config.get_workers() > 0:
+            table_dir = tempfile.mkdtemp(prefix='lnsd-')
+            table_path = os.path.join(table_dir, 'lnsd.table')
+
+        table_publisher = None
+        if table_path is not None:
+            table_publisher = shared_table.SharedTablePublisher(net_handler,
+                my_reactor, table_path)
+
+        supervisor = None
+        if config.get_workers() > 0:
+            supervisor = workers.WorkerSupervisor(my_reactor,
+                config.get_workers(), config.get_control_port(), table_path,
+                log_options=log_options,
+                backlog=config.get_backlog(),
+                max_clients=config.get_max_clients(),
+                idle_timeout=config.get_client_idle_timeout())
+
+        dns_handler = None
+        if config.get_dns_domain() is not None:
+            dns_handler = dns_proto.ProtocolHandler(net_handler, my_reactor,
+                domain=config.get_dns_domain(), port=config.get_dns_port(),
+                address=config.get_dns_address())
+
+        hosts_exporter = None
+        if config.get_hosts_path() is not None:
+            hosts_exporter = hosts_file.HostsFileExporter(net_handler,
+                my_reactor, config.get_hosts_path(),
+                delay=config.get_hosts_delay())
+
+        metrics_server = None
+        if config.get_metrics_port() is not None:
+            metrics_server = http_metrics.MetricsServer(net_handler,
+                my_reactor, port=config.get_metrics_port(),
+                address=config.get_metrics_address(),
+                cache_time=config.get_metrics_cache_time())
+
+        if packet_trace is not None:
+            packet_trace.open()
         net_handler.open()
         control_handler.open()
+        if table_publisher is not None:
+            table_publisher.open()
+        if dns_handler is not None:
+            dns_handler.open()
+        if hosts_exporter is not None:
+            hosts_exporter.open()
+        if supervisor is not None:
+            supervisor.open()
+        if metrics_server is not None:
+            metrics_server.open()
+
+        # The signal handlers wake the reactor up through its wakeup pipe,
+        # which a poll that's already waiting wouldn't notice being opened
+        my_reactor.open_wakeup_pipe()
+
+        # Shut down cleanly when asked to, which workers also do when they get
+        # a Quit message
+        signal.signal(signal.SIGTERM, lambda signum, frame:
+            my_reactor.call_soon_threadsafe(control_handler.stop))
+
+        # Signals can arrive in the middle of a callback, so profiles are only
+        # started and stopped once the reactor gets around to it
+        signal.signal(signal.SIGUSR1, lambda signum, frame:
+            my_reactor.call_soon_threadsafe(
+                lambda: my_profiler.toggle('cprofile')))
+        signal.signal(signal.SIGUSR2, lambda signum, frame:
+            my_reactor.call_soon_threadsafe(
+                lambda: my_profiler.toggle('sampling')))
+
         while control_handler.is_running():
             my_reactor.poll(net_handler.get_time_until_next_announce())
 
         net_handler.close()
+        if packet_trace is not None:
+            packet_trace.close()
         control_handler.close()
+        if table_publisher is not None:
+            table_publisher.close()
+        if dns_handler is not None:
+            dns_handler.close()
+        if hosts_exporter is not None:
+            hosts_exporter.close()
+        if supervisor is not None:
+            supervisor.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if table_dir is not None:
+            shutil.rmtree(table_dir, ignore_errors=True)
+        my_profiler.close()
+        my_reactor.close()
+        if log_pipeline is not None:
+            log_pipeline.close()
 
 HELP = """lnsd - An implementation of the LAN Naming Service protocol.
 Usage:
 
-    lnsd [-c config] [-p [control-port]:[network-port]] [-n name] [-v]
+    lnsd [-c config] [-p [control-port]:[network-port]] [-u path] [-m path]
+         [-d domain] [-H path] [-w workers] [-M port] [-n name] [-v]
 
 Options:
 
@@ -46,6 +176,44 @@ Options:
         messages from remote machines, while the internal port is used for
         control messages to the server.
 
+    -u PATH
+        Also accepts control messages on a Unix socket at the given path.
+        Local clients connecting through this socket avoid the overhead of
+        the TCP loopback stack. By default, no Unix socket is opened.
+
+    -m PATH
+        Publishes the host-name mapping into a memory-mapped file at the given
+        path, which local programs can read with lns.shared_table to look up
+        names without contacting lnsd at all. By default, no file is written.
+
+    -d DOMAIN
+        Answers DNS queries for names under DOMAIN (e.g. foo.lan for the host
+        foo, if DOMAIN is lan), as well as reverse lookups for known
+        addresses. The listener is on 127.0.0.1:53 by default - see the
+        dns_address and dns_port configuration options. By default, no DNS
+        queries are answered.
+
+    -H PATH
+        Keeps a file in the format of /etc/hosts at the given path up to date
+        with the host-name mapping, so that programs can resolve names through
+        the system resolver without contacting lnsd. The whole file is
+        replaced whenever the mapping changes, so it should not be shared with
+        any other entries. By default, no file is written.
+
+    -w WORKERS
+        Starts the given number of worker processes, which share the control
+        port with lnsd (using SO_REUSEPORT) and answer control clients from
+        the table that lnsd publishes (see -m), so that lookups can use more
+        than one core. Workers that die are restarted. By default, no workers
+        are started.
+
+    -M PORT
+        Serves lnsd's counters and latency histograms (see lns-query -s) in
+        the Prometheus text format, at http://127.0.0.1:PORT/metrics. See the
+        metrics_address and metrics_cache_time configuration options. Only
+        lnsd's own process is reported, not its workers. By default, no
+        metrics are served.
+
     -n NAME
         The name that lnsd will try to assign to this machine. The default is
         the system's hostname.
@@ -55,13 +223,31 @@ Options:
         the foreground.
 
     -v
-        Print out logging messages.
+        Print out logging messages. These are written by a background thread,
+        and dropped rather than slowing lnsd down if they can't be written
+        quickly enough. See the log_levels, packet_log_sample and
+        log_queue_size configuration options.
 
     -h
         Print out this help message.
+
+Signals:
+
+    SIGTERM
+        Shuts lnsd down cleanly.
+
+    SIGUSR1
+        Starts a cProfile profile of lnsd, or stops the running profile and
+        writes it to the profile_dir configuration option (by default, the
+        system's temporary directory). See lns-query -R.
+
+    SIGUSR2
+        The same as SIGUSR1, but with a sampling profile, which slows lnsd down
+        much less.
 """
 
-USAGE = 'lnsd [-c config] [-p [control-port]:[network-port]] [-n name] [-v]'
+USAGE = ('lnsd [-c config] [-p [control-port]:[network-port]] [-u path] '
+    '[-m path] [-d domain] [-H path] [-w workers] [-M port] [-n name] [-v]')
 
 MAX_PORT = 65535
 def check_port_or_die(argvalue):
@@ -96,6 +282,97 @@ def check_name_or_die(argvalue):
         print('Invalid hostname: ' + str(err), file=sys.stderr)
         sys.exit(1)
 
+def check_positive_or_die(argvalue):
+    """
+    Ensures that the argument value is a positive integer, or dies.
+    """
+    try:
+        value = int(argvalue)
+        if value < 1:
+            raise ValueError
+
+        return value
+    except ValueError:
+        print('Invalid positive integer:', argvalue, file=sys.stderr)
+        sys.exit(1)
+
+def check_timeout_or_die(argvalue):
+    """
+    Ensures that the argument value is a non-negative number of seconds, or
+    dies. A timeout of zero means that there is no timeout, so it becomes
+    ``None``.
+    """
+    try:
+        timeout = float(argvalue)
+        if timeout < 0:
+            raise ValueError
+
+        return timeout if timeout > 0 else None
+    except ValueError:
+        print('Invalid timeout:', argvalue, file=sys.stderr)
+        sys.exit(1)
+
+def check_addresses_or_die(argvalue):
+    """
+    Ensures that the argument value is a comma-separated list of IPv4
+    addresses, or dies.
+    """
+    addresses = tuple(address.strip() for address in argvalue.split(','))
+    try:
+        for address in addresses:
+            control_proto.verify_ipv4_address(address)
+    except ValueError:
+        print('Invalid list of addresses:', argvalue, file=sys.stderr)
+        sys.exit(1)
+
+    return addresses
+
+def check_log_levels_or_die(argvalue):
+    """
+    Ensures that the argument value is a valid list of subsystem log levels,
+    like net_proto=info,reactor=warning, or dies.
+    """
+    try:
+        return log_queue.parse_log_levels(argvalue)
+    except ValueError as err:
+        print('Invalid log levels:', err, file=sys.stderr)
+        sys.exit(1)
+
+def check_mode_or_die(argvalue):
+    """
+    Ensures that the argument value is a valid octal file mode, like 0660, or
+    dies.
+    """
+    try:
+        mode = int(argvalue, 8)
+        if mode < 0 or mode > 0o777:
+            raise ValueError
+
+        return mode
+    except ValueError:
+        print('Invalid file mode:', argvalue, file=sys.stderr)
+        sys.exit(1)
+
+def check_workers_or_die(argvalue):
+    """
+    Ensures that the argument value is a valid number of worker processes,
+    and that this system can share a port between them, or dies.
+    """
+    try:
+        count = int(argvalue)
+        if count < 0:
+            raise ValueError
+    except ValueError:
+        print('Invalid number of workers:', argvalue, file=sys.stderr)
+        sys.exit(1)
+
+    if count > 0 and not hasattr(socket, 'SO_REUSEPORT'):
+        print('Workers need SO_REUSEPORT, which this system lacks',
+            file=sys.stderr)
+        sys.exit(1)
+
+    return count
+
 def check_boolean_or_die(argvalue):
     """
     Ensures that the argument value is a valid boolean, which means that
@@ -117,7 +394,38 @@ class ConfigHandler:
 
     def __init__(self):
         self.net_port = (self.PRI_DEFAULT, net_proto.NET_PORT)
+        self.net_address = (self.PRI_DEFAULT, net_proto.NET_ADDRESS)
+        self.broadcast_addresses = (self.PRI_DEFAULT,
+            net_proto.BROADCAST_ADDRESSES)
+        self.announce_interval = (self.PRI_DEFAULT, net_proto.ANNOUNCE_ALARM)
+        self.announce_ttl = (self.PRI_DEFAULT, net_proto.ANNOUNCE_TTL)
         self.control_port = (self.PRI_DEFAULT, control_proto.CONTROL_PORT)
+        self.control_path = (self.PRI_DEFAULT, None)
+        self.control_path_mode = (self.PRI_DEFAULT,
+            control_proto.CONTROL_SOCKET_MODE)
+        self.backlog = (self.PRI_DEFAULT, control_proto.LISTEN_BACKLOG)
+        self.max_clients = (self.PRI_DEFAULT, control_proto.MAX_CLIENTS)
+        self.client_idle_timeout = (self.PRI_DEFAULT,
+            control_proto.CLIENT_IDLE_TIMEOUT)
+        self.table_path = (self.PRI_DEFAULT, None)
+        self.dns_domain = (self.PRI_DEFAULT, None)
+        self.dns_port = (self.PRI_DEFAULT, dns_proto.DNS_PORT)
+        self.dns_address = (self.PRI_DEFAULT, dns_proto.DNS_ADDRESS)
+        self.hosts_path = (self.PRI_DEFAULT, None)
+        self.hosts_delay = (self.PRI_DEFAULT, hosts_file.HOSTS_FILE_DELAY)
+        self.workers = (self.PRI_DEFAULT, 0)
+        self.metrics_port = (self.PRI_DEFAULT, None)
+        self.metrics_address = (self.PRI_DEFAULT, http_metrics.METRICS_ADDRESS)
+        self.metrics_cache_time = (self.PRI_DEFAULT,
+            http_metrics.METRICS_CACHE_TIME)
+        self.slow_callback_threshold = (self.PRI_DEFAULT, None)
+        self.stall_deadline = (self.PRI_DEFAULT, watchdog.STALL_DEADLINE)
+        self.profile_dir = (self.PRI_DEFAULT, None)
+        self.trace_path = (self.PRI_DEFAULT, None)
+        self.trace_max_size = (self.PRI_DEFAULT, trace.TRACE_MAX_SIZE)
+        self.log_levels = (self.PRI_DEFAULT, {})
+        self.packet_log_sample = (self.PRI_DEFAULT, 1)
+        self.log_queue_size = (self.PRI_DEFAULT, log_queue.LOG_QUEUE_SIZE)
         self.name = (self.PRI_DEFAULT, socket.gethostname())
         self.daemonize = (self.PRI_DEFAULT, False)
         self.verbose = (self.PRI_DEFAULT, False)
@@ -125,9 +433,90 @@ class ConfigHandler:
     def get_network_port(self):
         return self.net_port[1]
 
+    def get_network_address(self):
+        return self.net_address[1]
+
+    def get_broadcast_addresses(self):
+        return self.broadcast_addresses[1]
+
+    def get_announce_interval(self):
+        return self.announce_interval[1]
+
+    def get_announce_ttl(self):
+        return self.announce_ttl[1]
+
     def get_control_port(self):
         return self.control_port[1]
 
+    def get_control_path(self):
+        return self.control_path[1]
+
+    def get_control_path_mode(self):
+        return self.control_path_mode[1]
+
+    def get_backlog(self):
+        return self.backlog[1]
+
+    def get_max_clients(self):
+        return self.max_clients[1]
+
+    def get_client_idle_timeout(self):
+        return self.client_idle_timeout[1]
+
+    def get_table_path(self):
+        return self.table_path[1]
+
+    def get_dns_domain(self):
+        return self.dns_domain[1]
+
+    def get_dns_port(self):
+        return self.dns_port[1]
+
+    def get_dns_address(self):
+        return self.dns_address[1]
+
+    def get_hosts_path(self):
+        return self.hosts_path[1]
+
+    def get_hosts_delay(self):
+        return self.hosts_delay[1]
+
+    def get_workers(self):
+        return self.workers[1]
+
+    def get_metrics_port(self):
+        return self.metrics_port[1]
+
+    def get_metrics_address(self):
+        return self.metrics_address[1]
+
+    def get_metrics_cache_time(self):
+        return self.metrics_cache_time[1]
+
+    def get_slow_callback_threshold(self):
+        return self.slow_callback_threshold[1]
+
+    def get_stall_deadline(self):
+        return self.stall_deadline[1]
+
+    def get_profile_dir(self):
+        return self.profile_dir[1]
+
+    def get_trace_path(self):
+        return self.trace_path[1]
+
+    def get_trace_max_size(self):
+        return self.trace_max_size[1]
+
+    def get_log_levels(self):
+        return self.log_levels[1]
+
+    def get_packet_log_sample(self):
+        return self.packet_log_sample[1]
+
+    def get_log_queue_size(self):
+        return self.log_queue_size[1]
+
     def get_name(self):
         return self.name[1]
 
@@ -153,7 +542,7 @@ class ConfigHandler:
         Processes command line arguments, and stores the options specified by
         those arguments.
         """
-        opts, rest = getopt.getopt(argv, 'c:p:n:Dv')
+        opts, rest = getopt.getopt(argv, 'c:p:u:m:d:H:w:M:n:Dv')
         if rest:
             # We have to hijack getopt's exception value since that's what the
             # caller should already be watching
@@ -175,6 +564,20 @@ class ConfigHandler:
                 if net_port:
                     port = check_port_or_die(net_port)
                     self.assign('net_port', self.PRI_CMDLINE, port)
+            elif optname == '-u':
+                self.assign('control_path', self.PRI_CMDLINE, optvalue)
+            elif optname == '-m':
+                self.assign('table_path', self.PRI_CMDLINE, optvalue)
+            elif optname == '-d':
+                self.assign('dns_domain', self.PRI_CMDLINE, optvalue)
+            elif optname == '-H':
+                self.assign('hosts_path', self.PRI_CMDLINE, optvalue)
+            elif optname == '-w':
+                count = check_workers_or_die(optvalue)
+                self.assign('workers', self.PRI_CMDLINE, count)
+            elif optname == '-M':
+                port = check_port_or_die(optvalue)
+                self.assign('metrics_port', self.PRI_CMDLINE, port)
             elif optname == '-n':
                 hostname = check_name_or_die(optvalue)
                 self.assign('name', self.PRI_CONFIG, hostname)
@@ -195,16 +598,108 @@ class ConfigHandler:
             if 'net_port' in lnsd_config:
                 port = check_port_or_die(lnsd_config['net_port'])
                 self.assign('net_port', self.PRI_CONFIG, port)
-            elif 'control_port' in lnsd_config:
+            if 'net_address' in lnsd_config:
+                self.assign('net_address', self.PRI_CONFIG,
+                    lnsd_config['net_address'])
+            if 'broadcast_address' in lnsd_config:
+                addresses = check_addresses_or_die(
+                    lnsd_config['broadcast_address'])
+                self.assign('broadcast_addresses', self.PRI_CONFIG, addresses)
+            if 'announce_interval' in lnsd_config:
+                interval = check_timeout_or_die(
+                    lnsd_config['announce_interval'])
+                self.assign('announce_interval', self.PRI_CONFIG,
+                    interval or net_proto.ANNOUNCE_ALARM)
+            if 'announce_ttl' in lnsd_config:
+                ttl = check_timeout_or_die(lnsd_config['announce_ttl'])
+                self.assign('announce_ttl', self.PRI_CONFIG,
+                    ttl or net_proto.ANNOUNCE_TTL)
+            if 'control_port' in lnsd_config:
                 port = check_port_or_die(lnsd_config['control_port'])
                 self.assign('control_port', self.PRI_CONFIG, port)
-            elif 'hostname' in lnsd_config:
+            if 'control_socket' in lnsd_config:
+                self.assign('control_path', self.PRI_CONFIG,
+                    lnsd_config['control_socket'])
+            if 'control_socket_mode' in lnsd_config:
+                mode = check_mode_or_die(lnsd_config['control_socket_mode'])
+                self.assign('control_path_mode', self.PRI_CONFIG, mode)
+            if 'backlog' in lnsd_config:
+                backlog = check_positive_or_die(lnsd_config['backlog'])
+                self.assign('backlog', self.PRI_CONFIG, backlog)
+            if 'max_clients' in lnsd_config:
+                max_clients = check_positive_or_die(lnsd_config['max_clients'])
+                self.assign('max_clients', self.PRI_CONFIG, max_clients)
+            if 'client_idle_timeout' in lnsd_config:
+                timeout = check_timeout_or_die(
+                    lnsd_config['client_idle_timeout'])
+                self.assign('client_idle_timeout', self.PRI_CONFIG, timeout)
+            if 'table_file' in lnsd_config:
+                self.assign('table_path', self.PRI_CONFIG,
+                    lnsd_config['table_file'])
+            if 'dns_domain' in lnsd_config:
+                self.assign('dns_domain', self.PRI_CONFIG,
+                    lnsd_config['dns_domain'])
+            if 'dns_port' in lnsd_config:
+                port = check_port_or_die(lnsd_config['dns_port'])
+                self.assign('dns_port', self.PRI_CONFIG, port)
+            if 'dns_address' in lnsd_config:
+                self.assign('dns_address', self.PRI_CONFIG,
+                    lnsd_config['dns_address'])
+            if 'hosts_file' in lnsd_config:
+                self.assign('hosts_path', self.PRI_CONFIG,
+                    lnsd_config['hosts_file'])
+            if 'hosts_file_delay' in lnsd_config:
+                delay = check_timeout_or_die(lnsd_config['hosts_file_delay'])
+                self.assign('hosts_delay', self.PRI_CONFIG, delay or 0)
+            if 'workers' in lnsd_config:
+                count = check_workers_or_die(lnsd_config['workers'])
+                self.assign('workers', self.PRI_CONFIG, count)
+            if 'metrics_port' in lnsd_config:
+                port = check_port_or_die(lnsd_config['metrics_port'])
+                self.assign('metrics_port', self.PRI_CONFIG, port)
+            if 'metrics_address' in lnsd_config:
+                self.assign('metrics_address', self.PRI_CONFIG,
+                    lnsd_config['metrics_address'])
+            if 'metrics_cache_time' in lnsd_config:
+                cache_time = check_timeout_or_die(
+                    lnsd_config['metrics_cache_time'])
+                self.assign('metrics_cache_time', self.PRI_CONFIG,
+                    cache_time or 0)
+            if 'slow_callback_threshold' in lnsd_config:
+                threshold = check_timeout_or_die(
+                    lnsd_config['slow_callback_threshold'])
+                self.assign('slow_callback_threshold', self.PRI_CONFIG,
+                    threshold)
+            if 'stall_deadline' in lnsd_config:
+                deadline = check_timeout_or_die(lnsd_config['stall_deadline'])
+                self.assign('stall_deadline', self.PRI_CONFIG,
+                    deadline or watchdog.STALL_DEADLINE)
+            if 'profile_dir' in lnsd_config:
+                self.assign('profile_dir', self.PRI_CONFIG,
+                    lnsd_config['profile_dir'])
+            if 'trace_file' in lnsd_config:
+                self.assign('trace_path', self.PRI_CONFIG,
+                    lnsd_config['trace_file'])
+            if 'trace_max_size' in lnsd_config:
+                size = check_positive_or_die(lnsd_config['trace_max_size'])
+                self.assign('trace_max_size', self.PRI_CONFIG, size)
+            if 'log_levels' in lnsd_config:
+                levels = check_log_levels_or_die(lnsd_config['log_levels'])
+                self.assign('log_levels', self.PRI_CONFIG, levels)
+            if 'packet_log_sample' in lnsd_config:
+                sample = check_positive_or_die(
+                    lnsd_config['packet_log_sample'])
+                self.assign('packet_log_sample', self.PRI_CONFIG, sample)
+            if 'log_queue_size' in lnsd_config:
+                size = check_positive_or_die(lnsd_config['log_queue_size'])
+                self.assign('log_queue_size', self.PRI_CONFIG, size)
+            if 'hostname' in lnsd_config:
                 hostname = check_name_or_die(lnsd_config['hostname'])
                 self.assign('name', self.PRI_CONFIG, hostname)
-            elif 'daemonize' in lnsd_config:
+            if 'daemonize' in lnsd_config:
                 is_daemon = check_boolean_or_die(lnsd_config['daemonize'])
                 self.assign('daemonize', self.PRI_CONFIG, is_daemon)
-            elif 'verbose' in lnsd_config:
+            if 'verbose' in lnsd_config:
                 is_verbose = check_boolean_or_die(lnsd_config['verbose'])
                 self.assign('verbose', self.PRI_CONFIG, is_verbose)
 
@@ -220,16 +715,11 @@ def main():
         print(USAGE, file=sys.stderr) 
         return 1
 
-    if opt_handler.get_verbose():
-        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
-
     runner = LNSDaemon()
     if opt_handler.get_daemonize():
-        runner.start(opt_handler.get_name(), opt_handler.get_control_port(),
-            opt_handler.get_network_port())
+        runner.start(opt_handler)
     else:
-        runner.run(opt_handler.get_name(), opt_handler.get_control_port(),
-            opt_handler.get_network_port())
+        runner.run(opt_handler)
 
 if __name__ == '__main__':
     sys.exit(main())
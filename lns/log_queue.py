@@ -0,0 +1,201 @@
+"""
+Log Queue
+---------
+
+This keeps logging from slowing down the reactor. With ``-v``, lnsd logs a
+line for every packet it receives, which - written straight to stderr - makes
+lnsd fall behind whenever the network is busy.
+
+A :class:`LogPipeline` instead puts each record on a bounded queue, which a
+background thread writes out. The reactor never waits for the writer: when the
+queue is full, records are dropped (and counted in the ``log_records_dropped``
+metric), and the writer is told how many went missing once there is room again.
+
+The pipeline can also:
+
+- Set a level for each subsystem (like ``net_proto=info``), so that one noisy
+  module can be turned down while leaving the rest on debug.
+- Sample the lines logged for every packet, which go to the
+  :data:`PACKET_LOGGER_NAME` logger, so that only one in every so many of
+  them is written.
+"""
+import logging
+import logging.handlers
+import os
+import queue
+
+from lns import metrics
+
+# How many records can be waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = 10000
+
+# The logger that lines logged for every packet go to
+PACKET_LOGGER_NAME = 'lns.net_proto.packets'
+
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO,
+    'warning': logging.WARNING, 'error': logging.ERROR,
+    'critical': logging.CRITICAL}
+
+def parse_log_levels(text):
+    """
+    Parses a list of subsystem levels into a map from logger names to levels.
+    Subsystems are named by their module, without the ``lns.`` prefix.
+
+        >>> parse_log_levels('net_proto=info, reactor=warning')
+        {'lns.net_proto': 20, 'lns.reactor': 30}
+
+    :raises ValueError: If an entry isn't of the form ``subsystem=level``, or
+        the level is unknown.
+    """
+    levels = {}
+    for entry in text.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        subsystem, sep, level = entry.partition('=')
+        subsystem = subsystem.strip()
+        level = level.strip().lower()
+        if not sep or not subsystem:
+            raise ValueError('Expected subsystem=level, got ' + entry)
+        if level not in LOG_LEVELS:
+            raise ValueError('Unknown log level ' + level)
+
+        levels['lns.' + subsystem] = LOG_LEVELS[level]
+    return levels
+
+class SampleFilter(logging.Filter):
+    """
+    Passes one in every ``every`` records, and drops the rest.
+    """
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.seen = 0
+        self.sampled_out = metrics.REGISTRY.counter('log_records_dropped',
+            reason='sampled')
+
+    def filter(self, record):
+        self.seen += 1
+        if self.seen < self.every:
+            self.sampled_out.inc()
+            return False
+
+        self.seen = 0
+        return True
+
+class LossyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a queue without ever waiting, dropping them if the queue
+    is full.
+    """
+    def __init__(self, a_queue):
+        super().__init__(a_queue)
+
+        # Records dropped since the writer was last told about it. This is
+        # only touched while the handler's lock is held.
+        self.unreported = 0
+        self.dropped = metrics.REGISTRY.counter('log_records_dropped',
+            reason='queue-full')
+
+    def prepare(self, record):
+        """
+        Fills in the record's message, so that its arguments can't change
+        before it is written, but leaves the formatting to the writer.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.unreported:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': 'lns.log_queue', 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': 'Dropped {} log records'.format(self.unreported)}))
+                self.unreported = 0
+
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.unreported += 1
+            self.dropped.inc()
+
+class LogPipeline:
+    """
+    Sends every log record through a bounded queue to a thread which writes
+    them to a stream.
+    """
+    def __init__(self, stream, level=logging.DEBUG, levels=None,
+            packet_sample=1, queue_size=LOG_QUEUE_SIZE):
+        self.level = level
+        self.levels = levels or {}
+        self.packet_sample = packet_sample
+        self.queue_size = queue_size
+
+        self.writer = logging.StreamHandler(stream)
+        self.writer.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+        self.handler = None
+        self.listener = None
+        self.sample_filter = None
+
+    def open(self):
+        """
+        Starts the writer, and sends every record through it.
+        """
+        self.handler = LossyQueueHandler(queue.Queue(self.queue_size))
+        self.start_listener()
+
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+
+        for name, level in self.levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        if self.packet_sample > 1:
+            self.sample_filter = SampleFilter(self.packet_sample)
+            logging.getLogger(PACKET_LOGGER_NAME).addFilter(self.sample_filter)
+
+        # Threads don't survive a fork, so a forked process (like a worker,
+        # if it were forked rather than spawned) would otherwise fill up the
+        # queue without anybody writing it out
+        os.register_at_fork(after_in_child=self.on_fork)
+
+    def close(self):
+        """
+        Writes out anything left on the queue, and stops the writer.
+        """
+        logging.getLogger().removeHandler(self.handler)
+        if self.sample_filter is not None:
+            logging.getLogger(PACKET_LOGGER_NAME).removeFilter(
+                self.sample_filter)
+
+        listener = self.listener
+        self.listener = None
+        listener.stop()
+        self.writer.flush()
+
+    def start_listener(self):
+        """
+        Starts the thread which writes out the records on the queue.
+        """
+        self.listener = logging.handlers.QueueListener(self.handler.queue,
+            self.writer, respect_handler_level=True)
+        self.listener.start()
+
+    def on_fork(self):
+        """
+        Starts a new writer in a forked process, with a new queue, since the
+        old writer may have been holding the old queue's lock.
+        """
+        if self.listener is None:
+            return
+
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.start_listener()
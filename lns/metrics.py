@@ -0,0 +1,185 @@
+"""
+Metrics
+-------
+
+This keeps counters and histograms describing what lnsd is doing, which are
+reported to clients by the ``STATS`` control message.
+
+Every metric has a name, and optionally a set of labels which tell apart
+different kinds of the same thing (like the reason that a packet was
+rejected). Metrics are created by a :class:`Registry` - most code uses the
+process-wide :data:`REGISTRY`.
+
+Metrics are meant to be looked up once, when the code that updates them is set
+up, so that updating them afterwards costs very little: a :class:`Counter`
+adds to an integer, and a :class:`Histogram` bisects a short list of bucket
+bounds.
+
+Counters are updated from more than the reactor's thread - the watchdog counts
+stalls on its own thread, and the log handlers count the records they drop on
+whichever thread logged them - so each counter has a lock around its
+additions, and the registry has one around its tables of metrics. Histograms
+are only observed from the reactor's thread, and aren't locked.
+"""
+import bisect
+import math
+import threading
+
+# The upper bounds of the buckets that latencies are sorted into, in seconds.
+# Anything slower than the last bound goes into one more, unbounded, bucket.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+class Counter:
+    """
+    A count of how many times something has happened.
+    """
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Adds to the counter. This is safe to call from any thread.
+        """
+        with self.lock:
+            self.value += amount
+
+class Histogram:
+    """
+    A distribution of values (usually latencies, in seconds), kept as a count
+    of the values falling into each of a fixed set of buckets.
+
+    ``counts[i]`` is the number of values which are at most ``bounds[i]``
+    but more than the bound before it, and the last count is the number of
+    values above every bound.
+    """
+    __slots__ = ('bounds', 'counts', 'total')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+
+    @property
+    def count(self):
+        """
+        The number of values that have been observed.
+        """
+        return sum(self.counts)
+
+    def observe(self, value):
+        """
+        Adds a value to the histogram.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+def quantile_bound(bounds, counts, quantile):
+    """
+    Estimates a quantile (between 0 and 1) of a histogram, as the upper bound
+    of the bucket that it falls into. This is ``math.inf`` if the quantile is
+    above every bound, or ``None`` if the histogram is empty.
+
+        >>> quantile_bound((1, 2, 3), [1, 1, 1, 1], 0.5)
+        2
+        >>> quantile_bound((1, 2, 3), [0, 0, 0, 1], 0.5)
+        inf
+    """
+    total = sum(counts)
+    if not total:
+        return None
+
+    seen = 0
+    for bound, count in zip(bounds + (math.inf,), counts):
+        seen += count
+        if seen >= quantile * total:
+            return bound
+
+class Registry:
+    """
+    Creates metrics, and collects their values for reporting.
+    """
+    def __init__(self):
+        # Both of these map a (name, labels) pair to a metric, where the
+        # labels are a sorted tuple of (label, value) pairs
+        self.counters = {}
+        self.histograms = {}
+
+        # Metrics can be created on any thread, while they are being
+        # collected on another
+        self.lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        """
+        Gets the :class:`Counter` with the given name and labels, creating it
+        if it doesn't exist yet.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.counters:
+                self.counters[key] = Counter()
+            return self.counters[key]
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS, **labels):
+        """
+        Gets the :class:`Histogram` with the given name and labels, creating
+        it with the given bucket bounds if it doesn't exist yet.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(bounds)
+            return self.histograms[key]
+
+    def collect(self):
+        """
+        Gets the current values of every metric, as a list of counters and a
+        list of histograms sorted by name and labels. Each counter is a
+        dictionary like::
+
+            {'name': 'packets_rejected', 'labels': {'reason': 'bad-header'},
+             'value': 2}
+
+        And each histogram is a dictionary like::
+
+            {'name': 'control_request_latency', 'labels': {'type': 'host'},
+             'bounds': [0.00005, ...], 'counts': [5, ...], 'sum': 0.0012}
+        """
+        with self.lock:
+            counter_items = list(self.counters.items())
+            histogram_items = list(self.histograms.items())
+
+        counters = [
+            {'name': name, 'labels': dict(labels), 'value': counter.value}
+            for (name, labels), counter in sorted(counter_items,
+                key=lambda item: item[0])]
+
+        histograms = [
+            {'name': name, 'labels': dict(labels),
+             'bounds': list(histogram.bounds),
+             'counts': list(histogram.counts),
+             'sum': histogram.total}
+            for (name, labels), histogram in sorted(histogram_items,
+                key=lambda item: item[0])]
+
+        return counters, histograms
+
+REGISTRY = Registry()
+
+def format_labels(name, labels):
+    """
+    Formats the name and labels of a metric for display.
+
+        >>> format_labels('packets_received', {})
+        'packets_received'
+        >>> format_labels('packets_rejected', {'reason': 'bad-header'})
+        'packets_rejected{reason=bad-header}'
+    """
+    if not labels:
+        return name
+
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(label, value)
+        for label, value in sorted(labels.items())))
@@ -9,17 +9,27 @@ An ``ANNOUNCE`` packet is sent periodically to ensure that a host is still on a
 network, and that it is asserting a particular hostname. Other hosts should
 record this message as they receive it, to update their caches.
 """
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 import logging
 import socket
 import time
+import types
 
-from lns import reactor, utils
+from lns import metrics, reactor, utils
 
 LOGGER = logging.getLogger('lns.net_proto')
 
+# Lines logged for every packet (and every poll) go here, so that they can be
+# sampled or turned down without losing the rest (see lns.log_queue)
+PACKET_LOGGER = logging.getLogger('lns.net_proto.packets')
+
 NET_PORT = 15051
 
+# The address that the network socket is bound to, and the addresses that
+# Announce messages are sent to
+NET_ADDRESS = '0.0.0.0'
+BROADCAST_ADDRESSES = ('255.255.255.255',)
+
 # All packets received from the network are 512 bytes, not including the UDP
 # header
 PACKET_SIZE = 512
@@ -29,6 +39,10 @@ ANNOUNCE_ALARM = 10
 # How long to wait for another host to Announce before we drop it
 ANNOUNCE_TTL = 30
 
+# How many changes to the peer table are remembered, for clients which want
+# to know what has changed since they last looked
+CHANGE_LOG_SIZE = 1024
+
 def verify_hostname(hostname_bytes):
     """
     Verifies a hostname, to ensure that it is valid ASCII and that it doesn't
@@ -90,35 +104,318 @@ class Announce(namedtuple('Announce', ['hostname'])):
 
         return b'\x01' + raw_hostname.ljust(PACKET_SIZE - 1, b'\x00')
 
+class Snapshot(namedtuple('Snapshot',
+        ['generation', 'host_to_ips', 'ip_to_host'])):
+    """
+    An unchanging copy of a :class:`PeerTable` at some generation. The
+    mappings are read-only views, and each host's addresses are a tuple, so a
+    snapshot can be read from any thread without locking.
+    """
+    @staticmethod
+    def build(generation, host_to_ips, ip_to_host):
+        """
+        Copies the mappings of a peer table into a new snapshot.
+        """
+        return Snapshot(generation,
+            types.MappingProxyType({host: tuple(sorted(ips))
+                for host, ips in host_to_ips.items()}),
+            types.MappingProxyType(dict(ip_to_host)))
+
+    def query_host(self, host):
+        """
+        Gets a list of IP addresses which have the given hostname.
+        """
+        return list(self.host_to_ips.get(host, ()))
+
+    def query_ip(self, ip):
+        """
+        Gets a host for the given IP address, or None.
+        """
+        return self.ip_to_host.get(ip, None)
+
+    def get_host_ip_map(self):
+        """
+        Gets the host to IP address map.
+        """
+        return {host: list(ips) for host, ips in self.host_to_ips.items()}
+
+class PeerTable:
+    """
+    The mapping between the IP addresses of peers and their hostnames.
+
+    Every join, leave or rename bumps the table's *generation*, so that
+    anything derived from the table (like a serialized reply) can be cached
+    and thrown away only when the generation it was built from is stale.
+
+    The table also keeps a bounded log of its most recent changes, which
+    allows clients to ask for what has changed since a generation they
+    already know about, and calls any registered listeners as each change
+    happens.
+
+    Only the thread which changes the table may use its methods. Other
+    threads read the :attr:`snapshot` instead, which the changing thread
+    replaces with :meth:`publish_snapshot` after each batch of changes.
+    """
+    def __init__(self, change_log_size=CHANGE_LOG_SIZE):
+        self.generation = 0
+        self.host_to_ips = {}
+        self.ip_to_host = {}
+
+        # Each entry is the generation that a change produced, the IP address
+        # of the peer it changed, and the hostname that peer had before the
+        # change (or None, if it joined in that change). The log holds every
+        # change made after the generation in log_start.
+        self.change_log = deque(maxlen=change_log_size)
+        self.log_start = 0
+        self.listeners = []
+
+        self.snapshot = Snapshot.build(0, {}, {})
+
+    def add_listener(self, listener):
+        """
+        Adds a function which is called after every change to the table, with
+        the IP address of the peer that changed, its old hostname (``None``
+        if it just joined) and its new hostname (``None`` if it just left).
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Removes a function added by :meth:`add_listener`.
+        """
+        self.listeners.remove(listener)
+
+    def set_host(self, ip, hostname, generation=None):
+        """
+        Assigns a hostname to the peer at the given IP address, adding the
+        peer if it is not already in the table.
+
+        The change normally gets the next generation, unless a generation is
+        given (see :meth:`sync`).
+        """
+        old_hostname = self.ip_to_host.get(ip, None)
+        if old_hostname == hostname:
+            return
+
+        if old_hostname is not None:
+            self._remove_ip(old_hostname, ip)
+
+        self.ip_to_host[ip] = hostname
+        self.host_to_ips.setdefault(hostname, set()).add(ip)
+        self._record_change(ip, old_hostname, hostname, generation)
+
+    def drop(self, ip, generation=None):
+        """
+        Removes the peer at the given IP address from the table.
+        """
+        hostname = self.ip_to_host.pop(ip)
+        self._remove_ip(hostname, ip)
+        self._record_change(ip, hostname, None, generation)
+
+    def reset(self, host_to_ips, generation):
+        """
+        Replaces the contents of the table with a copy of another table at
+        the given generation, forgetting the change log.
+        """
+        self.host_to_ips = {host: set(ips)
+            for host, ips in host_to_ips.items()}
+        self.ip_to_host = {ip: host
+            for host, ips in host_to_ips.items()
+            for ip in ips}
+
+        self.generation = generation
+        self.change_log.clear()
+        self.log_start = generation
+
+    def sync(self, host_to_ips, generation):
+        """
+        Brings the table up to date with a copy of another table at a later
+        generation, logging and announcing each difference as a change.
+
+        Since the differences are all that is known about how the other table
+        got there, they are all logged under its new generation.
+        """
+        ip_to_host = {ip: host
+            for host, ips in host_to_ips.items()
+            for ip in ips}
+
+        for ip in [ip for ip in self.ip_to_host if ip not in ip_to_host]:
+            self.drop(ip, generation)
+        for ip, hostname in ip_to_host.items():
+            self.set_host(ip, hostname, generation)
+
+        self.generation = generation
+
+    def _record_change(self, ip, old_hostname, new_hostname, generation=None):
+        """
+        Bumps the generation of the table (or moves it to the given
+        generation), logs the change that caused it and tells the listeners
+        about it.
+        """
+        if generation is None:
+            self.generation += 1
+        else:
+            self.generation = generation
+
+        if len(self.change_log) == self.change_log.maxlen:
+            # The oldest change is about to be forgotten
+            self.log_start = self.change_log[0][0]
+        self.change_log.append((self.generation, ip, old_hostname))
+
+        for listener in self.listeners:
+            listener(ip, old_hostname, new_hostname)
+
+    def get_changes_since(self, generation):
+        """
+        Gets the changes made to the table after the given generation, as a
+        tuple of three items:
+
+         - A dictionary of the IP addresses of peers which joined, mapped to
+           their hostnames.
+         - A list of the IP addresses of peers which left.
+         - A dictionary of the IP addresses of peers which were renamed,
+           mapped to their new hostnames.
+
+        Changes are collapsed, so that a peer which joined and then left again
+        doesn't appear at all. If the changes since the given generation have
+        been dropped from the change log, then this returns ``None``.
+        """
+        if generation > self.generation or generation < self.log_start:
+            return None
+
+        # Since the log is in order, the first entry for each peer after the
+        # given generation tells us what the peer was called at that point
+        original_hostnames = {}
+        for change_generation, ip, old_hostname in reversed(self.change_log):
+            if change_generation <= generation:
+                break
+            original_hostnames[ip] = old_hostname
+
+        added = {}
+        removed = []
+        renamed = {}
+        for ip, old_hostname in original_hostnames.items():
+            new_hostname = self.ip_to_host.get(ip, None)
+            if old_hostname is None and new_hostname is not None:
+                added[ip] = new_hostname
+            elif old_hostname is not None and new_hostname is None:
+                removed.append(ip)
+            elif old_hostname != new_hostname:
+                renamed[ip] = new_hostname
+
+        return added, removed, renamed
+
+    def publish_snapshot(self):
+        """
+        Replaces the :attr:`snapshot` with a copy of the current table, if the
+        table has changed since the snapshot was taken, and returns it.
+        """
+        snapshot = self.snapshot
+        if snapshot.generation != self.generation:
+            snapshot = Snapshot.build(self.generation, self.host_to_ips,
+                self.ip_to_host)
+            # Readers on other threads only ever see the old snapshot or the
+            # new one, since replacing an attribute is atomic
+            self.snapshot = snapshot
+        return snapshot
+
+    def _remove_ip(self, hostname, ip):
+        """
+        Removes an IP address from a host's set of addresses, forgetting the
+        host entirely once it has no addresses left.
+        """
+        ips = self.host_to_ips[hostname]
+        ips.remove(ip)
+        if not ips:
+            del self.host_to_ips[hostname]
+
+    def query_host(self, host):
+        """
+        Gets a list of IP addresses which have the given hostname.
+        """
+        return list(self.host_to_ips.get(host, ()))
+
+    def query_ip(self, ip):
+        """
+        Gets a host for the given IP address, or None.
+        """
+        return self.ip_to_host.get(ip, None)
+
+    def get_host_ip_map(self):
+        """
+        Gets the host to IP address map.
+        """
+        return {host: list(ips) for host, ips in self.host_to_ips.items()}
+
 class ProtocolHandler:
     """
     Handles remote LNS servers, sending out Announce messages and caching them,
     while periodically sending out its own Announce message.
+
+    Announces are sent to every one of the broadcast addresses - there is
+    usually only the one, but a list of peers can stand in for a broadcast
+    where broadcasts don't reach (like on the loopback interface).
+
+    The clock is the function that announce times are read from, which
+    :mod:`lns.sim` replaces to run the handler on simulated time.
     """
-    def __init__(self, a_reactor, hostname, port=NET_PORT):
+    def __init__(self, a_reactor, hostname, port=NET_PORT, clock=time.time,
+            address=NET_ADDRESS, broadcast_addresses=BROADCAST_ADDRESSES,
+            announce_interval=ANNOUNCE_ALARM, announce_ttl=ANNOUNCE_TTL,
+            trace=None):
         self.reactor = a_reactor
         self.port = port
+        self.address = address
+        self.broadcast_addresses = broadcast_addresses
+        self.announce_interval = announce_interval
+        self.announce_ttl = announce_ttl
         self.server_sock = None
         self.hostname = hostname
+        self.clock = clock
+
+        # Records every datagram received, if set - see lns.trace
+        self.trace = trace
 
         self.last_announce_time = 0
         self.peer_last_announce_time = {}
-        self.host_to_ips = defaultdict(set)
-        self.ip_to_host = {}
+        self.peers = PeerTable()
         self.peer_buffers = defaultdict(bytes)
 
+        registry = metrics.REGISTRY
+        self.packets_received = registry.counter('packets_received')
+        self.packets_parsed = registry.counter('packets_parsed')
+        self.packets_bad_header = registry.counter('packets_rejected',
+            reason='bad-header')
+        self.packets_bad_hostname = registry.counter('packets_rejected',
+            reason='bad-hostname')
+        self.packets_recv_error = registry.counter('packets_dropped',
+            reason='recv-error')
+        self.packets_peer_expired = registry.counter('packets_dropped',
+            reason='peer-expired')
+        self.bytes_in = registry.counter('bytes_in', socket='net')
+        self.bytes_out = registry.counter('bytes_out', socket='net')
+        self.announces_sent = registry.counter('announces_sent')
+        self.announces_failed = registry.counter('announces_failed')
+        self.peers_joined = registry.counter('peers_joined')
+        self.peers_expired = registry.counter('peers_expired')
+        self.peers_renamed = registry.counter('peers_renamed')
+
     def open(self):
         """
         Opens up the network socket for sending and receiving Announce messages.
         """
-        LOGGER.debug('Binding to network on port %d', self.port)
+        LOGGER.debug('Binding to network on %s:%d', self.address, self.port)
 
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.server_sock.bind(('0.0.0.0', self.port))
+        self.server_sock.bind((self.address, self.port))
         self.reactor.bind(self.server_sock, reactor.READABLE, self.on_message)
         self.reactor.add_step_callback(self.on_announce_timeout)
 
+        # Announces that arrive together are published in one snapshot, once
+        # the reactor has handled all of them
+        self.reactor.add_step_callback(self.peers.publish_snapshot)
+
         # Go ahead and do our first announce, so that we appear on the
         # network ASAP
         self.on_announce_timeout()
@@ -127,33 +424,68 @@ class ProtocolHandler:
         """
         Cloes the server socket.
         """
+        self.reactor.unbind(self.server_sock)
         self.server_sock.close()
 
+    @property
+    def generation(self):
+        """
+        The generation of the peer table, which changes whenever a peer joins,
+        leaves or is renamed.
+        """
+        return self.peers.generation
+
+    def get_changes_since(self, generation):
+        """
+        Gets the changes made to the peer table since the given generation -
+        see :meth:`PeerTable.get_changes_since`.
+        """
+        return self.peers.get_changes_since(generation)
+
+    def add_change_listener(self, listener):
+        """
+        Registers a function to be called whenever a peer joins, leaves or is
+        renamed - see :meth:`PeerTable.add_listener`.
+        """
+        self.peers.add_listener(listener)
+
+    def remove_change_listener(self, listener):
+        """
+        Unregisters a function added by :meth:`add_change_listener`.
+        """
+        self.peers.remove_listener(listener)
+
+    def get_snapshot(self):
+        """
+        Gets an up to date :class:`Snapshot` of the peer table, which can be
+        handed to other threads - see :meth:`PeerTable.publish_snapshot`.
+        """
+        return self.peers.publish_snapshot()
+
     def query_host(self, host):
         """
         Gets a list of IP addresses which have the given hostname.
         """
-        return list(self.host_to_ips[host])
+        return self.peers.query_host(host)
 
     def query_ip(self, ip):
         """
         Gets a host for the given IP address, or None.
         """
-        return self.ip_to_host.get(ip, None)
+        return self.peers.query_ip(ip)
 
     def get_host_ip_map(self):
         """
         Gets the host to IP address map.
         """
-        return {host: list(ips) for host, ips in self.host_to_ips.items() 
-            if ips}
+        return self.peers.get_host_ip_map()
 
     def on_announce_timeout(self):
         """
         This sends out a new announce message, and drops any clients whose last
         announce was too far back in time.
         """
-        if time.time() - self.last_announce_time < ANNOUNCE_ALARM:
+        if self.clock() - self.last_announce_time < self.announce_interval:
             # Avoid announcing quickly - since we send out a new Announce()
             # every time the timer runs out, we could receive our own message
             # and send out a new one, causing on_announce_timeout to be called
@@ -162,10 +494,14 @@ class ProtocolHandler:
 
         # We want this to happen even if we disconnect, since we don't want to
         # throttle the CPU
-        self.last_announce_time = time.time()
+        self.last_announce_time = self.clock()
         try:
-            utils.sendto_all(self.server_sock, Announce(self.hostname).serialize(),
-                ('255.255.255.255', self.port))
+            packet = Announce(self.hostname).serialize()
+            for broadcast_address in self.broadcast_addresses:
+                utils.sendto_all(self.server_sock, packet,
+                    (broadcast_address, self.port))
+                self.announces_sent.inc()
+                self.bytes_out.inc(len(packet))
             LOGGER.debug('Sent an Announce')
         except (OSError, socket.error):
             # At this point, we've disconnected, so we need to sit on the socket
@@ -174,31 +510,35 @@ class ProtocolHandler:
             #
             # Update 13 December 2014: Cygwin raises a different exception,
             # in the socket module rather than an OSError.
-            pass
+            self.announces_failed.inc()
 
-        now = time.time()
+        now = self.clock()
         to_drop = [peer
             for peer, last_announce_time in self.peer_last_announce_time.items()
-            if now - last_announce_time > ANNOUNCE_TTL
+            if now - last_announce_time > self.announce_ttl
         ]
 
         LOGGER.debug('Dropping %d peers', len(to_drop))
         for peer in to_drop:
-            LOGGER.debug('-- Dropping: %s', peer)
+            PACKET_LOGGER.debug('-- Dropping: %s', peer)
             del self.peer_last_announce_time[peer]
-            del self.peer_buffers[peer]
+            if self.peer_buffers.pop(peer, b''):
+                # The peer went away partway through sending a packet
+                self.packets_peer_expired.inc()
+            self.peers.drop(peer)
+            self.peers_expired.inc()
 
-            peer_name = self.ip_to_host[peer]
-            del self.ip_to_host[peer]
-            self.host_to_ips[peer_name].remove(peer)
+        self.peers.publish_snapshot()
 
     def get_time_until_next_announce(self):
         """
         Gets the amount of time since the last announce.
         """
-        time_since_last_announce = time.time() - self.last_announce_time
-        time_until_next_announce = max(ANNOUNCE_ALARM - time_since_last_announce, 0)
-        LOGGER.debug('Sending Announce in %f seconds', time_until_next_announce)
+        time_since_last_announce = self.clock() - self.last_announce_time
+        time_until_next_announce = max(
+            self.announce_interval - time_since_last_announce, 0)
+        PACKET_LOGGER.debug('Sending Announce in %f seconds',
+            time_until_next_announce)
         return time_until_next_announce
 
     def handle_messages(self, host):
@@ -208,7 +548,7 @@ class ProtocolHandler:
         buffer_stream = utils.TransactionalBytesIO(self.peer_buffers[host])
         while True:
             with buffer_stream.get_transaction() as txn:
-                LOGGER.debug('Message from %s', host)
+                PACKET_LOGGER.debug('Message from %s', host)
                 stream = txn.get_stream()
                 packet = stream.read(PACKET_SIZE)
                 if len(packet) < PACKET_SIZE:
@@ -222,24 +562,31 @@ class ProtocolHandler:
                 if not Announce.parses(packet):
                     # A corrupt Announce packet (or some other kind of data we
                     # cannot use) is best ignored, since we can't do anything
+                    self.packets_bad_header.inc()
                     continue
 
-                message = Announce.unserialize(packet)
+                try:
+                    message = Announce.unserialize(packet)
+                except ValueError:
+                    self.packets_bad_hostname.inc()
+                    continue
 
-                self.peer_last_announce_time[host] = time.time()
-                # The host might have been renamed, so we have to dispose of
-                # the old name before assigning the new one
-                if host in self.ip_to_host:
-                    old_hostname = self.ip_to_host[host]
+                self.packets_parsed.inc()
+                self.peer_last_announce_time[host] = self.clock()
+                # The host might have been renamed, in which case the peer
+                # table disposes of the old name before assigning the new one
+                old_hostname = self.peers.query_ip(host)
+                if old_hostname is None:
+                    self.peers_joined.inc()
+                elif old_hostname != message.hostname:
                     LOGGER.debug('Host at %s: %s -> %s',
                         host, 
                         old_hostname, 
                         message.hostname)
-                    self.host_to_ips[old_hostname].remove(host)
+                    self.peers_renamed.inc()
 
-                LOGGER.debug('%s -> %s', host, message.hostname)
-                self.ip_to_host[host] = message.hostname
-                self.host_to_ips[message.hostname].add(host)
+                PACKET_LOGGER.debug('%s -> %s', host, message.hostname)
+                self.peers.set_host(host, message.hostname)
 
         self.peer_buffers[host] = buffer_stream.read()
 
@@ -249,7 +596,18 @@ class ProtocolHandler:
         buffer, possibly handling any complete messages in that peer's
         buffer.
         """
-        data, (host, _) = self.server_sock.recvfrom(PACKET_SIZE)
-        LOGGER.debug('%d bytes of data from %s', len(data), host)
+        try:
+            data, (host, port) = self.server_sock.recvfrom(PACKET_SIZE)
+        except OSError as err:
+            PACKET_LOGGER.debug('Could not receive a packet: %s', err)
+            self.packets_recv_error.inc()
+            return
+
+        if self.trace is not None:
+            self.trace.record(data, host, port)
+
+        PACKET_LOGGER.debug('%d bytes of data from %s', len(data), host)
+        self.packets_received.inc()
+        self.bytes_in.inc(len(data))
         self.peer_buffers[host] += data
         self.handle_messages(host)
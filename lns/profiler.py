@@ -0,0 +1,233 @@
+"""
+Profiler
+--------
+
+This profiles a running lnsd in place, so that slowness which only shows up
+under real traffic (like a flood of announces, or a storm of lookups) can be
+looked into without having to reproduce it elsewhere.
+
+There are two kinds of profile:
+
+- ``cprofile`` uses :mod:`cProfile` to trace every function call on the
+  reactor's thread. It is exact, but slows lnsd down while it runs. The
+  output is a ``.pstats`` file, which can be read with :mod:`pstats` or a
+  viewer like snakeviz.
+- ``sampling`` runs a thread which looks at the reactor's stack every
+  :const:`SAMPLE_INTERVAL` seconds, and counts how often each stack is seen.
+  It barely slows lnsd down, but only shows where time is spent on average.
+  The output is a ``.collapsed`` file, with one line per stack and its count
+  (the format that flamegraph.pl and speedscope read). Time spent waiting
+  for events shows up under the reactor's ``poll``.
+
+Profiles are started and stopped through the reactor, by a timer which runs
+between callbacks, so a profile never starts or stops partway through one.
+Each profile is written to the profile directory when it stops, named after
+lnsd's process ID, the time it started, and how many profiles this process has
+started before it (so that profiles started within the same second don't
+overwrite each other).
+"""
+from collections import Counter
+import cProfile
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+LOGGER = logging.getLogger('lns.profiler')
+
+# How often the sampling profiler looks at the reactor's stack, in seconds.
+# Sampling much faster than the interpreter switches threads (every 5ms by
+# default) only makes the sampler compete with the reactor.
+SAMPLE_INTERVAL = 0.005
+
+PROFILE_MODES = ('cprofile', 'sampling')
+
+# The file extension used for the output of each kind of profile
+PROFILE_EXTENSIONS = {'cprofile': '.pstats', 'sampling': '.collapsed'}
+
+def collapse_stack(frame):
+    """
+    Describes a stack as a single line, from the outermost frame to the
+    innermost, like ``lns.lnsd:main;lns.reactor:LinuxReactor.poll``.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(frame.f_globals.get('__name__', '?'),
+            getattr(code, 'co_qualname', code.co_name)))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class SamplingProfiler:
+    """
+    Samples the stack of a thread from another thread. This has the same
+    ``enable``, ``disable`` and ``dump_stats`` methods as
+    :class:`cProfile.Profile`, but profiles the given thread rather than the
+    one that enables it.
+    """
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+
+        # Maps each collapsed stack to the number of times it was seen
+        self.samples = Counter()
+
+        self.stopping = threading.Event()
+        self.sampler = None
+
+    def enable(self):
+        """
+        Starts sampling.
+        """
+        self.stopping.clear()
+        self.sampler = threading.Thread(target=self.run_sampler,
+            name='profile-sampler', daemon=True)
+        self.sampler.start()
+
+    def disable(self):
+        """
+        Stops sampling.
+        """
+        self.stopping.set()
+        self.sampler.join()
+
+    def run_sampler(self):
+        """
+        Takes samples until sampling is stopped.
+        """
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+
+    def dump_stats(self, path):
+        """
+        Writes the samples to a file, with the most common stacks first.
+        """
+        with open(path, 'w') as output:
+            for stack, count in self.samples.most_common():
+                output.write('{} {}\n'.format(stack, count))
+
+class Profiler:
+    """
+    Starts and stops profiles of the reactor's thread, and writes them to a
+    directory.
+    """
+    def __init__(self, a_reactor, directory=None):
+        self.reactor = a_reactor
+        self.directory = (directory if directory is not None
+            else tempfile.gettempdir())
+
+        # The kind of profile that is running, and the file it will be
+        # written to (both None when nothing is running)
+        self.mode = None
+        self.path = None
+
+        # The profile which is running once the reactor has started it, and
+        # the file that it will be written to
+        self.profile = None
+        self.profile_path = None
+
+        # Numbers each profile, so that no two get the same file
+        self.sequence = itertools.count(1)
+
+    def is_running(self):
+        """
+        Returns whether a profile is running (or about to start).
+        """
+        return self.mode is not None
+
+    def start(self, mode):
+        """
+        Starts a profile of the given kind, returning the path it will be
+        written to once it stops.
+
+        :raises ValueError: If the mode is unknown, or a profile is already
+            running.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError('Unknown profile mode {}, expected one of {}'.
+                format(mode, ', '.join(PROFILE_MODES)))
+
+        if self.is_running():
+            raise ValueError('A {} profile is already running'.format(
+                self.mode))
+
+        path = os.path.join(self.directory, 'lnsd-{}-{}-{}{}'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S'), next(self.sequence),
+            PROFILE_EXTENSIONS[mode]))
+        self.mode = mode
+        self.path = path
+
+        LOGGER.info('Starting a %s profile', mode)
+        self.reactor.call_later(0, lambda: self.on_start(mode, path))
+        return path
+
+    def stop(self):
+        """
+        Stops the running profile, returning the path that it will be written
+        to.
+
+        :raises ValueError: If no profile is running.
+        """
+        if not self.is_running():
+            raise ValueError('No profile is running')
+
+        path = self.path
+        self.mode = None
+        self.path = None
+
+        self.reactor.call_later(0, self.on_stop)
+        return path
+
+    def toggle(self, mode):
+        """
+        Starts a profile of the given kind if nothing is running, or stops
+        the running profile otherwise. This is what the profiling signals do.
+        """
+        if self.is_running():
+            self.stop()
+        else:
+            self.start(mode)
+
+    def on_start(self, mode, path):
+        """
+        Starts profiling, between the reactor's callbacks.
+        """
+        if mode == 'cprofile':
+            self.profile = cProfile.Profile()
+        else:
+            self.profile = SamplingProfiler(threading.get_ident())
+        self.profile_path = path
+        self.profile.enable()
+
+    def on_stop(self):
+        """
+        Stops profiling, between the reactor's callbacks, and writes out the
+        profile.
+        """
+        if self.profile is None:
+            return
+
+        profile, path = self.profile, self.profile_path
+        self.profile = None
+        self.profile_path = None
+        profile.disable()
+
+        try:
+            profile.dump_stats(path)
+            LOGGER.info('Wrote profile to %s', path)
+        except OSError as err:
+            LOGGER.error('Could not write profile to %s: %s', path, err)
+
+    def close(self):
+        """
+        Stops and writes out any running profile, without waiting for the
+        reactor.
+        """
+        self.mode = None
+        self.path = None
+        self.on_stop()
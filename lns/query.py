@@ -4,14 +4,18 @@ The query program for lnsd, which can connect to the daemon to query the
 name-host mapping.
 """
 import getopt
+import ipaddress
+import math
 import sys
 
-from lns import control_proto, net_proto
+from lns import control_proto, metrics, net_proto
 
 HELP = """lns-query - Query the lnsd server.
 Usage:
 
-    lns-query [-h] <-a | -i ip | -n hostname | -q> [-p control_port]
+    lns-query [-h] <-a | -i ip | -n hostname | -W hostname:timeout | -w | -s |
+                    -R mode | -q>
+              [-p control_port | -u control_path] [-P prefix] [-N subnet]
 
 Options:
 
@@ -31,9 +35,52 @@ Options:
         Prints out the IP addresses associated with the given hostname;
         produces no output if no IP addresses are found.
 
+    -W HOSTNAME:TIMEOUT
+        Waits up to TIMEOUT seconds for the given hostname to appear, and then
+        prints out its IP addresses. If the hostname doesn't appear in time,
+        produces no output and exits with a non-zero status.
+
+    -w
+        Watches for hosts joining, leaving and being renamed, printing a line
+        for each change until interrupted. E.g.
+
+            joined 1.2.3.4 A
+            renamed 1.2.3.4 A B
+            left 1.2.3.4 B
+
+    -s
+        Prints out the server's counters, one per line, followed by its
+        latency histograms with their count, their total in seconds, and the
+        bucket bounds that the median and 99th percentile fall under. E.g.
+
+            packets_received 120
+            packets_rejected{reason=bad-header} 2
+            control_request_latency{type=name} count=40 sum=0.0031 p50<=0.0001 p99<=0.00025
+
+        When lnsd runs workers (with -w), only its main process keeps stats.
+        A worker may answer on the control port, and refuses - use -u to ask
+        the main process through the Unix control socket instead.
+
+    -R MODE
+        Starts a profile of the server, where MODE is cprofile (which traces
+        every call) or sampling (which slows the server down much less), or
+        stops the running profile if MODE is stop. Prints the file that the
+        profile is written to once it stops.
+
+    -P PREFIX
+        With -w, only prints changes to hosts whose names start with PREFIX.
+
+    -N SUBNET
+        With -w, only prints changes to hosts whose addresses are within
+        SUBNET, like 192.168.1.0/24.
+
     -p CONTROL_PORT
         The port to use to connect to the server (default: 10771).
 
+    -u CONTROL_PATH
+        The Unix socket to use to connect to the server, instead of the
+        control port. lnsd must have been started with the same path.
+
     -q
         Terminates the server.
 
@@ -41,7 +88,9 @@ Options:
         Prints out this help page.
 """
 
-USAGE = "lns-query [-h] <-a | -i IP | -n hostname | -q> [-p control_port]"
+USAGE = ("lns-query [-h] <-a | -i IP | -n hostname | -W hostname:timeout | "
+    "-w | -s | -R mode | -q> [-p control_port | -u control_path] "
+    "[-P prefix] [-N subnet]")
 
 MAX_PORT = 65535
 def check_port_or_die(argvalue):
@@ -87,6 +136,34 @@ def check_ip_or_die(argvalue):
         print('Invalid IP address: ' + str(err), file=sys.stderr)
         sys.exit(1)
 
+def check_subnet_or_die(argvalue):
+    """
+    Ensures that the argument value is a valid IPv4 subnet, or dies.
+    """
+    try:
+        ipaddress.IPv4Network(argvalue, strict=False)
+        return argvalue
+    except ValueError as err:
+        print('Invalid subnet: ' + str(err), file=sys.stderr)
+        sys.exit(1)
+
+def check_wait_or_die(argvalue):
+    """
+    Ensures that the argument value is a valid hostname and a finite,
+    non-negative timeout joined by a :, or dies.
+    """
+    try:
+        host, timeout = argvalue.rsplit(':', 1)
+        timeout = float(timeout)
+        if not math.isfinite(timeout) or timeout < 0:
+            raise ValueError
+    except ValueError:
+        print('-W option must contain a hostname and a timeout in seconds '
+            'joined by a :', file=sys.stderr)
+        sys.exit(1)
+
+    return check_name_or_die(host), timeout
+
 def get_ip_addresses(host, client):
     """
     Prints out the IP addresses associated with the given hostname, or none
@@ -96,6 +173,18 @@ def get_ip_addresses(host, client):
     for ip in client.get_ip(host):
         print(ip)
 
+def wait_for_host(host, timeout, client):
+    """
+    Waits for the given host to appear, and prints out its IP addresses. If it
+    doesn't appear before the timeout, then nothing is printed and the exit
+    status is non-zero.
+    """
+    ip_addrs = client.wait_for_host(host, timeout)
+    for ip in ip_addrs:
+        print(ip)
+
+    return 0 if ip_addrs else 1
+
 def get_hostname(ip, client):
     """
     Prints out the hostname associated with the given IP address, or nothing
@@ -116,6 +205,67 @@ def get_all(client):
         for addr in addrs:
             print(addr, host)
 
+def watch(prefix, subnet, client):
+    """
+    Prints out each change to the hosts matching the given filters, until
+    interrupted or until the server goes away.
+    """
+    client.subscribe(prefix, subnet)
+    try:
+        for event in client.iter_events():
+            if isinstance(event, control_proto.Joined):
+                print('joined', event.ip, event.hostname, flush=True)
+            elif isinstance(event, control_proto.Left):
+                print('left', event.ip, event.hostname, flush=True)
+            elif isinstance(event, control_proto.Renamed):
+                print('renamed', event.ip, event.old_hostname, event.hostname,
+                    flush=True)
+    except KeyboardInterrupt:
+        pass
+
+def print_stats(client):
+    """
+    Prints out the server's counters and latency histograms.
+    """
+    stats = client.get_stats()
+    if stats.error is not None:
+        print(stats.error, file=sys.stderr)
+        return 1
+
+    for counter in stats.counters:
+        print(metrics.format_labels(counter['name'], counter['labels']),
+            counter['value'])
+
+    for histogram in stats.histograms:
+        bounds = tuple(histogram['bounds'])
+        counts = histogram['counts']
+        fields = ['count={}'.format(sum(counts)),
+            'sum={:.6g}'.format(histogram['sum'])]
+        if sum(counts):
+            fields.append('p50<={}'.format(
+                metrics.quantile_bound(bounds, counts, 0.5)))
+            fields.append('p99<={}'.format(
+                metrics.quantile_bound(bounds, counts, 0.99)))
+
+        print(metrics.format_labels(histogram['name'], histogram['labels']),
+            *fields)
+
+def profile(mode, client):
+    """
+    Starts or stops a profile of the server, and prints the file that it is
+    written to.
+    """
+    if mode == 'stop':
+        reply = client.stop_profile()
+    else:
+        reply = client.start_profile(mode)
+
+    if reply.error is not None:
+        print(reply.error, file=sys.stderr)
+        return 1
+
+    print(reply.path)
+
 def terminate(client):
     """
     Terminates the server.
@@ -128,7 +278,7 @@ def main():
         return 0
 
     try:
-        opts, rest = getopt.getopt(sys.argv[1:], 'ai:n:p:q')
+        opts, rest = getopt.getopt(sys.argv[1:], 'ai:n:p:u:qsR:wW:P:N:')
     except getopt.GetoptError:
         print(USAGE, file=sys.stderr)
         return 1
@@ -140,6 +290,9 @@ def main():
     # to it (excepting the ClientHandler, which is done automatically)
     mode = None
     control_port = control_proto.CONTROL_PORT
+    control_path = None
+    watch_prefix = None
+    watch_subnet = None
     for optname, optvalue in opts:
         if optname == '-a':
             mode = (get_all, [])
@@ -147,23 +300,39 @@ def main():
             mode = (get_hostname, [optvalue])
         elif optname == '-n':
             mode = (get_ip_addresses, [optvalue])
+        elif optname == '-W':
+            mode = (wait_for_host, list(check_wait_or_die(optvalue)))
+        elif optname == '-w':
+            mode = (watch, [])
+        elif optname == '-s':
+            mode = (print_stats, [])
+        elif optname == '-R':
+            mode = (profile, [optvalue])
         elif optname == '-q':
             mode = (terminate, [])
         elif optname == '-p':
             control_port = check_port_or_die(optvalue)
+        elif optname == '-u':
+            control_path = optvalue
+        elif optname == '-P':
+            watch_prefix = optvalue
+        elif optname == '-N':
+            watch_subnet = check_subnet_or_die(optvalue)
 
     if mode is None:
-        print('One option out of -a, -i, -n, -q is required',
+        print('One option out of -a, -i, -n, -W, -w, -s, -R, -q is required',
             file=sys.stderr)
         return 1
 
+    if mode[0] is watch:
+        mode = (watch, [watch_prefix, watch_subnet])
+
     try:
-        client = control_proto.ClientHandler(control_port)
+        client = control_proto.ClientHandler(control_port, control_path)
         with client:
             func, args = mode
             args.append(client)
-            func(*args)
-        return 0
+            return func(*args) or 0
     except OSError:
         print('Connection error', file=sys.stderr)
         return 1
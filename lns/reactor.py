@@ -10,7 +10,13 @@ The core class provided by this module is the :class:`Reactor`, which
 provides the layer on top of select/poll/epoll and attaches callbacks to
 individual file descriptors. It is also capable of attacking *step callbacks*
 which are run after each poll of the reactor completes, which can be used for
-maintenance functions.
+maintenance functions, and *timers* which run a callback once after a delay.
+
+Reactors aren't thread-safe, with two exceptions: any thread can use
+:meth:`StepCallbackProcessor.call_soon_threadsafe` to have the reactor's
+thread run a function, and the reactor's thread can use
+:meth:`StepCallbackProcessor.run_in_worker` to run slow functions on a small
+pool of threads and get their results back on the reactor's thread.
 
 The default :class:`Reactor` that is provided is different for each platform.
 The :class:`LinuxReactor` is preferred, followed by :class:`PollReactor` and
@@ -35,11 +41,28 @@ On systems supporing only select::
 
     >>> type(r)
     <class 'reactor.SelectReactor'>
+
+There is also an :class:`AsyncioReactor`, which is never chosen as the
+default, but which runs its callbacks on an asyncio event loop so that LNS can
+be embedded into an asyncio program.
+
+Any reactor can have monitoring turned on with
+:meth:`StepCallbackProcessor.enable_monitoring`, which times its callbacks and
+watches for it getting stuck - see :mod:`lns.watchdog`.
 """
+import asyncio
+from collections import deque
+import concurrent.futures
+import heapq
+import itertools
 import logging
+import os
 import select
+import threading
 import time
 
+from lns import metrics, watchdog
+
 LOGGER = logging.getLogger('reactor')
 
 class Token:
@@ -126,18 +149,237 @@ def to_file_descriptor(fobj):
 # we have to convert float seconds into integer milliseconds.
 MSECS_PER_SECOND = 1000
 
+# How many threads run_in_worker() can use at once - any more work than this
+# waits for a thread to become free
+WORKER_THREADS = 4
+
 READABLE = Token('READABLE')
 WRITABLE = Token('WRITABLE')
 ERROR = Token('ERROR')
 
+class Timer:
+    """
+    A callback which is scheduled to run once, at some point in the future.
+    Timers are created by :meth:`StepCallbackProcessor.call_later`.
+    """
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Prevents the timer's callback from running, if it hasn't already.
+        """
+        self.cancelled = True
+
 class StepCallbackProcessor:
     """
     The base of all reactors. This provides a *very* minimal interface for
-    having a list of callback functions, which can be called all at once.
+    having a list of callback functions, which can be called all at once, as
+    well as a set of timers which can be run once they expire.
     """
     def __init__(self):
         self.step_callbacks = set()
 
+        # A heap of (deadline, sequence number, timer), where the sequence
+        # number keeps timers with equal deadlines in the order they were
+        # added (and prevents the timers themselves from being compared)
+        self.timers = []
+        self.timer_sequence = itertools.count()
+
+        # Functions passed to call_soon_threadsafe(), the pipe used to wake
+        # up the reactor when one is added, and whether a wakeup has been
+        # written to the pipe that the reactor hasn't read yet
+        self.pending_calls = deque()
+        self.wakeup_pipe = None
+        self.wakeup_pending = False
+
+        # Held while the wakeup pipe is being opened, since that can happen on
+        # any thread (or in a signal handler, hence the re-entrant lock)
+        self.wakeup_lock = threading.RLock()
+
+        self.worker_pool = None
+
+        # How long events wait between the poll returning them and their
+        # callbacks being run - long waits mean that earlier callbacks in the
+        # same batch are slow
+        self.dispatch_latency = metrics.REGISTRY.histogram(
+            'reactor_dispatch_latency')
+
+        # How late timers run after their deadlines - this grows whenever the
+        # reactor is kept from getting back to its poll
+        self.timer_lag = metrics.REGISTRY.histogram('reactor_timer_lag')
+
+        # The watchdog.CallbackMonitor which runs every callback, if
+        # monitoring is turned on
+        self.monitor = None
+
+    def enable_monitoring(self, threshold=watchdog.SLOW_CALLBACK_THRESHOLD,
+            deadline=watchdog.STALL_DEADLINE):
+        """
+        Starts timing every callback, warning about any that take longer than
+        the threshold, and watching for the reactor going longer than the
+        deadline without getting back to its poll (both in seconds). See
+        :class:`lns.watchdog.CallbackMonitor`.
+        """
+        self.monitor = watchdog.CallbackMonitor(threshold, deadline)
+        self.monitor.open()
+
+    def call_later(self, delay, func):
+        """
+        Schedules a function to run once, after at least the given number of
+        seconds have passed. The function should take no arguments, and its
+        return value is ignored.
+
+        Returns a :class:`Timer`, which can be used to cancel the call.
+        """
+        timer = Timer(time.monotonic() + delay, func)
+        heapq.heappush(self.timers,
+            (timer.deadline, next(self.timer_sequence), timer))
+        return timer
+
+    def run_timers(self):
+        """
+        Runs the callbacks of all the timers which have expired.
+        """
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.timer_lag.observe(now - timer.deadline)
+                timer.cancelled = True
+                if self.monitor is None:
+                    timer.callback()
+                else:
+                    self.monitor.run(timer.callback)
+
+    def _limit_timeout(self, timeout):
+        """
+        Shortens a poll timeout (in seconds, where ``None`` or a negative
+        value means to wait forever), so that the poll returns in time to run
+        the next timer.
+        """
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+
+        if not self.timers:
+            return timeout
+
+        until_next_timer = max(self.timers[0][0] - time.monotonic(), 0)
+        if timeout is None or timeout < 0:
+            return until_next_timer
+        else:
+            return min(timeout, until_next_timer)
+
+    def open_wakeup_pipe(self):
+        """
+        Creates the pipe that :meth:`call_soon_threadsafe` uses to wake the
+        reactor up, and starts watching it, unless that has already been
+        done.
+
+        The pipe is opened the first time it is needed, but a poll or select
+        which is already waiting won't notice a pipe opened by another
+        thread. Anything that calls :meth:`call_soon_threadsafe` from other
+        threads (or signal handlers) should call this before it does.
+        """
+        with self.wakeup_lock:
+            if self.wakeup_pipe is not None:
+                return
+
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(read_fd, False)
+            os.set_blocking(write_fd, False)
+            self.bind(read_fd, READABLE, self.on_wakeup)
+            self.wakeup_pipe = (read_fd, write_fd)
+
+    def is_wakeup_fd(self, fd):
+        """
+        Returns whether a file descriptor is the reactor's own wakeup pipe,
+        which doesn't count as a client.
+        """
+        return self.wakeup_pipe is not None and fd == self.wakeup_pipe[0]
+
+    def call_soon_threadsafe(self, func):
+        """
+        Runs a function on the reactor's thread, as soon as the reactor can.
+        Unlike everything else on the reactor, this can be called from any
+        thread. The function should take no arguments, and its return value
+        is ignored.
+        """
+        if self.wakeup_pipe is None:
+            self.open_wakeup_pipe()
+
+        self.pending_calls.append(func)
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            try:
+                os.write(self.wakeup_pipe[1], b'\0')
+            except BlockingIOError:
+                # The pipe is full of wakeups already
+                pass
+
+    def on_wakeup(self, event):
+        """
+        Runs the functions passed to :meth:`call_soon_threadsafe`.
+        """
+        try:
+            while os.read(self.wakeup_pipe[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        # This has to be cleared before the functions are taken off the
+        # queue, so that a function added after this point either gets run
+        # now, or writes a new wakeup
+        self.wakeup_pending = False
+        while self.pending_calls:
+            func = self.pending_calls.popleft()
+            if self.monitor is None:
+                func()
+            else:
+                self.monitor.run(func)
+
+    def run_in_worker(self, func, callback):
+        """
+        Runs a function (which takes no arguments) on a worker thread, and
+        then runs the callback on the reactor's thread with a
+        :class:`concurrent.futures.Future` holding the function's result.
+
+        At most :const:`WORKER_THREADS` functions run at once. Since they run
+        alongside the reactor, they must not touch anything that the reactor
+        may be changing.
+        """
+        if self.worker_pool is None:
+            self.open_wakeup_pipe()
+            self.worker_pool = concurrent.futures.ThreadPoolExecutor(
+                WORKER_THREADS, thread_name_prefix='reactor-worker')
+
+        future = self.worker_pool.submit(func)
+        future.add_done_callback(
+            lambda future: self.call_soon_threadsafe(lambda: callback(future)))
+        return future
+
+    def close(self):
+        """
+        Waits for any functions running on worker threads, and releases the
+        reactor's own resources. File objects bound to the reactor are left
+        for their owners to close.
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+            self.worker_pool = None
+
+        if self.monitor is not None:
+            self.monitor.close()
+            self.monitor = None
+
+        if self.wakeup_pipe is not None:
+            self.unbind(self.wakeup_pipe[0])
+            for fd in self.wakeup_pipe:
+                os.close(fd)
+            self.wakeup_pipe = None
+
     def add_step_callback(self, func):
         """
         Adds a stepper function which runs after :meth:`poll`. The stepper
@@ -149,8 +391,12 @@ class StepCallbackProcessor:
         """
         Runs all the step callbacks.
         """
-        for callback in self.step_callbacks:
-            callback()
+        if self.monitor is None:
+            for callback in self.step_callbacks:
+                callback()
+        else:
+            for callback in self.step_callbacks:
+                self.monitor.run(callback)
 
 # This is the callback used if an error happens, and a file descriptor is lost.
 # This shouldn't happen, but to avoid crashing the program, this is used as a
@@ -183,7 +429,7 @@ class PollLikeReactor(StepCallbackProcessor):
         Returns True if any sockets have attached callbacks, or False
         otherwise.
         """
-        return self.callbacks != {}
+        return any(not self.is_wakeup_fd(fd) for fd in self.fd_events)
 
     def poll(self, timeout=None):
         """
@@ -199,28 +445,34 @@ class PollLikeReactor(StepCallbackProcessor):
           whether or not it processed any events.
         - If greater than zero, this method will wait that many seconds
           for events before returning.
+
+        In any case, this method returns early if a timer expires.
         """
-        timeout = self._convert_timeout(timeout)
+        timeout = self._convert_timeout(self._limit_timeout(timeout))
+        monitor = self.monitor
+        if monitor is not None:
+            monitor.enter_poll()
         events = self.pollster.poll(timeout)
+        polled_at = time.monotonic()
+        if monitor is not None:
+            monitor.leave_poll()
 
         for fd, event_flag in events:
+            self.dispatch_latency.observe(time.monotonic() - polled_at)
             event_set = self._flags_to_event_set(event_flag)
 
             # Since the write method may end up raising an exception (writing
             # to a closed sockets raises exceptions), make a best effort to
             # ensure that all data is read by running the read callback first.
-            if READABLE in event_set:
-                callback = self.callbacks.get((fd, READABLE), EMPTY_CALLBACK)
-                callback((fd, READABLE))
-
-            if WRITABLE in event_set:
-                callback = self.callbacks.get((fd, WRITABLE), EMPTY_CALLBACK)
-                callback((fd, WRITABLE))
-
-            if ERROR in event_set:
-                callback = self.callbacks.get((fd, ERROR), EMPTY_CALLBACK)
-                callback((fd, ERROR))
-
+            for event in (READABLE, WRITABLE, ERROR):
+                if event in event_set:
+                    callback = self.callbacks.get((fd, event), EMPTY_CALLBACK)
+                    if monitor is None:
+                        callback((fd, event))
+                    else:
+                        monitor.run(callback, (fd, event))
+
+        self.run_timers()
         self.run_step_callbacks()
 
     def _convert_timeout(self, timeout):
@@ -379,9 +631,9 @@ else:
             Returns True if any sockets have attached callbacks, or False
             otherwise.
             """
-            return (self.readers != {} or
-                    self.writers != {} or
-                    self.errors != {})
+            return any(not self.is_wakeup_fd(fd)
+                for fd in itertools.chain(self.readers, self.writers,
+                    self.errors))
 
         def poll(self, timeout=None):
             """
@@ -397,39 +649,49 @@ else:
               whether or not it processed any events.
             - If greater than zero, this method will wait that many seconds
               for events before returning.
+
+            In any case, this method returns early if a timer expires.
             """
             # If you try to run select() on Windows without any args, it
             # gives up and raises an exception. We have to catch this
             # condition before Windows does and kills us.
-            timeout = self._convert_timeout(timeout)
-            if not self.has_clients():
+            timeout = self._convert_timeout(self._limit_timeout(timeout))
+            if not self.has_clients() and self.wakeup_pipe is None:
                 # So, if we don't have any sockets we care about, then
                 # this should block forever and stall the process. This
                 # is bad, so just return instead.
                 if timeout is None:
+                    self.run_timers()
                     self.run_step_callbacks()
                     return
                 else:
                     time.sleep(timeout)
+                    self.run_timers()
                     self.run_step_callbacks()
                     return
 
+            monitor = self.monitor
+            if monitor is not None:
+                monitor.enter_poll()
             rlist, wlist, xlist = select.select(list(self.readers),
                 list(self.writers), list(self.errors),
                 timeout)
+            polled_at = time.monotonic()
+            if monitor is not None:
+                monitor.leave_poll()
+
+            ready = ([(fd, READABLE, self.readers) for fd in rlist] +
+                     [(fd, WRITABLE, self.writers) for fd in wlist] +
+                     [(fd, ERROR, self.errors) for fd in xlist])
+            for fd, event, callbacks in ready:
+                self.dispatch_latency.observe(time.monotonic() - polled_at)
+                callback = callbacks.get(fd, EMPTY_CALLBACK)
+                if monitor is None:
+                    callback((fd, event))
+                else:
+                    monitor.run(callback, (fd, event))
 
-            for reader in rlist:
-                callback = self.readers.get(reader, EMPTY_CALLBACK)
-                callback((reader, READABLE))
-
-            for writer in wlist:
-                callback = self.writers.get(writer, EMPTY_CALLBACK)
-                callback((writer, WRITABLE))
-
-            for error in xlist:
-                callback = self.errors.get(error, EMPTY_CALLBACK)
-                callback((error, ERROR))
-
+            self.run_timers()
             self.run_step_callbacks()
 
         def _convert_timeout(self, timeout):
@@ -497,3 +759,209 @@ else:
                 del self.errors[fd]
 
     Reactor = SelectReactor
+
+class AsyncioReactor(StepCallbackProcessor):
+    """
+    This provides a reactor on top of an asyncio event loop, which lets the
+    protocol handlers run alongside other asyncio code.
+
+    Callbacks are run by the event loop whenever their file descriptors are
+    ready, and timers are run by the event loop once they expire - either
+    way, the step callbacks run once the event loop has finished processing
+    that batch of events. Asyncio doesn't report errors separately, so
+    :const:`ERROR` callbacks run when the file descriptor becomes readable,
+    if it has no :const:`READABLE` callback.
+
+    While the event loop is running, :meth:`wait` takes the place of
+    :meth:`poll`. If the event loop isn't running, :meth:`poll` runs it until
+    the same point that it would return for the other reactors.
+
+    Since the event loop does its own polling, this reactor doesn't record the
+    ``reactor_dispatch_latency`` metric. With monitoring turned on, each
+    callback from the event loop counts as leaving the poll, so the watchdog
+    reports any of them which runs past the stall deadline.
+    """
+    def __init__(self, loop=None):
+        super().__init__()
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = asyncio.new_event_loop()
+        self.loop = loop
+
+        self.readers = {}
+        self.writers = {}
+        self.errors = {}
+
+        # The handle of the pending run of the step callbacks, and the future
+        # that wait() is blocked on (if anything is waiting)
+        self.step_handle = None
+        self.waiter = None
+
+    def has_clients(self):
+        """
+        Returns True if any sockets have attached callbacks, or False
+        otherwise.
+        """
+        return (self.readers != {} or
+                self.writers != {} or
+                self.errors != {})
+
+    def call_later(self, delay, func):
+        """
+        Schedules a function to run once, after at least the given number of
+        seconds have passed. See :meth:`StepCallbackProcessor.call_later`.
+        """
+        timer = super().call_later(delay, func)
+        self.loop.call_later(delay, self.schedule_step)
+        return timer
+
+    def open_wakeup_pipe(self):
+        """
+        Does nothing, since the event loop has its own way of being woken up
+        by :meth:`call_soon_threadsafe`.
+        """
+
+    def call_soon_threadsafe(self, func):
+        """
+        Runs a function on the event loop's thread, as soon as the event loop
+        can. See :meth:`StepCallbackProcessor.call_soon_threadsafe`.
+        """
+        self.loop.call_soon_threadsafe(self.run_threadsafe_call, func)
+
+    def run_threadsafe_call(self, func):
+        """
+        Runs a function passed to :meth:`call_soon_threadsafe`, followed by
+        the step callbacks.
+        """
+        self.run_callback(func)
+        self.schedule_step()
+
+    def run_callback(self, callback, *args):
+        """
+        Runs a callback for the event loop, through the monitor if monitoring
+        is turned on.
+        """
+        monitor = self.monitor
+        if monitor is None:
+            callback(*args)
+            return
+
+        monitor.leave_poll()
+        try:
+            monitor.run(callback, *args)
+        finally:
+            monitor.enter_poll()
+
+    def schedule_step(self):
+        """
+        Runs the expired timers and the step callbacks once the event loop has
+        finished with its current batch of events.
+        """
+        if self.step_handle is None:
+            self.step_handle = self.loop.call_soon(self.run_step)
+
+    def run_step(self):
+        """
+        Runs the expired timers and the step callbacks, and wakes up anything
+        waiting in :meth:`wait`.
+        """
+        self.step_handle = None
+        if self.monitor is not None:
+            self.monitor.leave_poll()
+        try:
+            self.run_timers()
+            self.run_step_callbacks()
+        finally:
+            if self.monitor is not None:
+                self.monitor.enter_poll()
+
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def on_readable(self, fd):
+        """
+        Runs the callback for a file descriptor which is readable.
+        """
+        if fd in self.readers:
+            self.run_callback(self.readers[fd], (fd, READABLE))
+        elif fd in self.errors:
+            self.run_callback(self.errors[fd], (fd, ERROR))
+        self.schedule_step()
+
+    def on_writable(self, fd):
+        """
+        Runs the callback for a file descriptor which is writable.
+        """
+        callback = self.writers.get(fd, EMPTY_CALLBACK)
+        self.run_callback(callback, (fd, WRITABLE))
+        self.schedule_step()
+
+    async def wait(self, timeout=None):
+        """
+        Waits until the step callbacks have run after the next batch of
+        events, or until the timeout (in seconds) expires and the step
+        callbacks have run anyway. A timeout of ``None``, or a negative
+        timeout, waits indefinitely for events.
+        """
+        self.waiter = self.loop.create_future()
+        timeout_handle = None
+        if timeout is not None and timeout >= 0:
+            timeout_handle = self.loop.call_later(timeout, self.schedule_step)
+
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+            if timeout_handle is not None:
+                timeout_handle.cancel()
+
+    def poll(self, timeout=None):
+        """
+        Runs the event loop until the step callbacks have run, as described
+        by :meth:`wait`. This can't be used while the event loop is already
+        running.
+        """
+        self.loop.run_until_complete(self.wait(timeout))
+
+    def bind(self, fobj, events, callback):
+        """
+        Binds a callback, to be called when one of a list of events occurs
+        on a file object. See :meth:`PollLikeReactor.bind`.
+        """
+        fd = to_file_descriptor(fobj)
+        events = to_iterable(events, set)
+
+        if READABLE in events:
+            self.readers[fd] = callback
+        if WRITABLE in events:
+            self.writers[fd] = callback
+            self.loop.add_writer(fd, self.on_writable, fd)
+        if ERROR in events:
+            self.errors[fd] = callback
+
+        if READABLE in events or ERROR in events:
+            self.loop.add_reader(fd, self.on_readable, fd)
+
+    def unbind(self, fobj, events=None):
+        """
+        Stops watching the given file for the given events, or for all
+        events if no events are given. See :meth:`PollLikeReactor.unbind`.
+        """
+        fd = to_file_descriptor(fobj)
+        if events is None:
+            events = {READABLE, WRITABLE, ERROR}
+        else:
+            events = to_iterable(events, set)
+
+        if READABLE in events:
+            self.readers.pop(fd, None)
+        if ERROR in events:
+            self.errors.pop(fd, None)
+        if WRITABLE in events and fd in self.writers:
+            del self.writers[fd]
+            self.loop.remove_writer(fd)
+
+        if fd not in self.readers and fd not in self.errors:
+            self.loop.remove_reader(fd)
@@ -0,0 +1,470 @@
+"""
+Shared Table
+------------
+
+This publishes the host-name mapping into a memory-mapped file, so that local
+programs can look up names without talking to lnsd at all - a lookup is only
+a few reads from memory, with no socket and no work done by the daemon.
+
+The file starts with a fixed size header::
+
+      8       4         4         8          8          16         16
+    +-------+---------+--------+----------+------------+----------+----------+
+    | Magic | Version | Active | Sequence | Generation | Slot 0   | Slot 1   |
+    +-------+---------+--------+----------+------------+----------+----------+
+
+ - "Magic" is ``LNSTABLE``, and "Version" is the version of this format.
+ - "Active" is the slot (0 or 1) that readers should look in.
+ - "Sequence" is a seqlock counter. It is odd while the header is being
+   changed, and changes every time a new slot is made active.
+ - "Generation" is the generation of the peer table stored in the active
+   slot.
+ - Each "Slot" is the offset of that slot within the file, followed by the
+   length of the data stored in it.
+
+The table is double-buffered: the writer fills in the inactive slot, and then
+makes it active by updating the header. Readers note the sequence before
+doing a lookup and check it again afterwards; if it has changed, the writer
+may have reused the slot they were reading from, so they retry.
+
+Each slot contains a read-only hash index, which starts with the number of
+buckets in the name index and in the address index. Each of those indexes is
+an array of offsets (relative to the start of the slot) to entries, where an
+offset of 0 marks an empty bucket. Collisions are resolved by linear probing.
+
+ - A name entry is the length of the name, the name, the number of addresses
+   and then each address as 4 packed bytes.
+ - An address entry is the address as 4 packed bytes, and the offset of the
+   name entry for the host with that address.
+
+All integers are little-endian.
+"""
+import mmap
+import os
+import socket
+import struct
+import zlib
+
+MAGIC = b'LNSTABLE'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sIIQQQQQQ')
+SLOT_HEADER = struct.Struct('<II')
+BUCKET = struct.Struct('<I')
+NAME_LENGTH = struct.Struct('<H')
+ADDR_COUNT = struct.Struct('<H')
+ADDR_ENTRY = struct.Struct('<4sI')
+
+# Where the sequence lives in the header, so that it can be updated on its own
+SEQUENCE_OFFSET = 16
+
+# How many times a reader retries a lookup which raced with the writer,
+# before giving up
+MAX_READ_ATTEMPTS = 1000
+
+def _bucket_count(entries):
+    """
+    Gets the number of buckets to use for an index with the given number of
+    entries, which keeps the index at most half full.
+    """
+    buckets = 8
+    while buckets < entries * 2:
+        buckets *= 2
+    return buckets
+
+def _hash(key):
+    """
+    Hashes a key from the index. This has to be the same across processes, so
+    Python's own (randomized) hash can't be used.
+    """
+    return zlib.crc32(key)
+
+def build_index(host_to_ips):
+    """
+    Builds the contents of a slot from a host to IP address mapping.
+    """
+    name_buckets = _bucket_count(len(host_to_ips))
+    addr_count = sum(len(ips) for ips in host_to_ips.values())
+    addr_buckets = _bucket_count(addr_count)
+
+    name_index = [0] * name_buckets
+    addr_index = [0] * addr_buckets
+
+    entries_offset = (SLOT_HEADER.size +
+        (name_buckets + addr_buckets) * BUCKET.size)
+    entries = bytearray()
+    addr_entries = []
+
+    for host, ips in host_to_ips.items():
+        name = host.encode('ascii')
+        name_offset = entries_offset + len(entries)
+
+        bucket = _hash(name) % name_buckets
+        while name_index[bucket]:
+            bucket = (bucket + 1) % name_buckets
+        name_index[bucket] = name_offset
+
+        entries += NAME_LENGTH.pack(len(name))
+        entries += name
+        entries += ADDR_COUNT.pack(len(ips))
+        for ip in ips:
+            packed_ip = socket.inet_aton(ip)
+            entries += packed_ip
+            addr_entries.append((packed_ip, name_offset))
+
+    for packed_ip, name_offset in addr_entries:
+        addr_offset = entries_offset + len(entries)
+
+        bucket = _hash(packed_ip) % addr_buckets
+        while addr_index[bucket]:
+            bucket = (bucket + 1) % addr_buckets
+        addr_index[bucket] = addr_offset
+
+        entries += ADDR_ENTRY.pack(packed_ip, name_offset)
+
+    index = bytearray(SLOT_HEADER.pack(name_buckets, addr_buckets))
+    index += struct.pack('<{}I'.format(name_buckets), *name_index)
+    index += struct.pack('<{}I'.format(addr_buckets), *addr_index)
+    index += entries
+    return bytes(index)
+
+class SharedTableWriter:
+    """
+    Writes the host-name mapping into a memory-mapped file, which can be read
+    by any number of :class:`SharedTableReader` objects.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.map = None
+        self.sequence = 0
+
+        # The offset and capacity of each slot
+        self.slots = [(0, 0), (0, 0)]
+        self.slot_lengths = [0, 0]
+        self.active = 0
+
+    def open(self):
+        """
+        Creates the file, containing an empty table.
+        """
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+            0o644)
+        os.ftruncate(self.fd, HEADER.size)
+        self.map = mmap.mmap(self.fd, HEADER.size)
+        self.write_header(0)
+
+    def close(self):
+        """
+        Removes the file, so that nobody reads stale information from it.
+        """
+        self.map.close()
+        os.close(self.fd)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def write_header(self, generation):
+        """
+        Writes out the entire header, with the current sequence. While the
+        table is published, this is only called with an odd sequence, since
+        readers could otherwise see the new sequence before the rest of the
+        header.
+        """
+        HEADER.pack_into(self.map, 0, MAGIC, FORMAT_VERSION, self.active,
+            self.sequence, generation,
+            self.slots[0][0], self.slot_lengths[0],
+            self.slots[1][0], self.slot_lengths[1])
+
+    def grow_slot(self, slot, size):
+        """
+        Moves a slot to the end of the file, so that it has room for at least
+        the given number of bytes. The space used by the old slot is
+        abandoned, since readers may still be looking at it.
+        """
+        capacity = max(size, 2 * self.slots[slot][1], mmap.PAGESIZE)
+        offset = len(self.map)
+        os.ftruncate(self.fd, offset + capacity)
+
+        self.map.close()
+        self.map = mmap.mmap(self.fd, offset + capacity)
+        self.slots[slot] = (offset, capacity)
+
+    def publish(self, host_to_ips, generation):
+        """
+        Replaces the contents of the table with the given host to IP address
+        mapping.
+        """
+        index = build_index(host_to_ips)
+        inactive = 1 - self.active
+
+        offset, capacity = self.slots[inactive]
+        if capacity < len(index):
+            self.grow_slot(inactive, len(index))
+            offset, _ = self.slots[inactive]
+
+        self.map[offset:offset + len(index)] = index
+        self.slot_lengths[inactive] = len(index)
+
+        # Only the header needs to be protected by the sequence - readers
+        # never look at the inactive slot, and if they were reading it before
+        # it became inactive, the sequence will have changed since then
+        self.sequence += 1
+        struct.pack_into('<Q', self.map, SEQUENCE_OFFSET, self.sequence)
+
+        self.active = inactive
+        self.write_header(generation)
+
+        # The even sequence goes in last, so that readers only accept the
+        # header once every other field of it has been written
+        self.sequence += 1
+        struct.pack_into('<Q', self.map, SEQUENCE_OFFSET, self.sequence)
+
+class TableChanged(Exception):
+    """
+    Raised internally when a reader notices that the writer has changed the
+    table in the middle of a lookup.
+    """
+
+class SharedTableReader:
+    """
+    Looks up names and addresses in a table published by a
+    :class:`SharedTableWriter`, without any communication with lnsd.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.map = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        """
+        Opens and maps the table file.
+
+        :raises ValueError: If the file isn't a table.
+        """
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.remap()
+
+        magic, version = struct.unpack_from('<8sI', self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError('{} is not a version {} LNS table'.format(
+                self.path, FORMAT_VERSION))
+
+    def close(self):
+        """
+        Unmaps and closes the table file.
+        """
+        self.map.close()
+        os.close(self.fd)
+
+    def remap(self):
+        """
+        Maps the whole table file, which may have grown since it was last
+        mapped.
+        """
+        if self.map is not None:
+            self.map.close()
+
+        size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+
+    def read_consistent(self, reader):
+        """
+        Calls the given function with the active slot's offset, retrying
+        until it runs without the writer changing the table underneath it.
+        Produces the generation of the table that was read, along with the
+        function's return value.
+        """
+        for _ in range(MAX_READ_ATTEMPTS):
+            (_, _, active, sequence, generation,
+                offset_0, length_0, offset_1, length_1) = HEADER.unpack_from(
+                    self.map, 0)
+            if sequence % 2 == 1:
+                continue
+
+            offset, length = ((offset_0, length_0) if active == 0
+                else (offset_1, length_1))
+            if offset + length > len(self.map):
+                self.remap()
+                continue
+
+            try:
+                result = reader(offset) if length else None
+            except (struct.error, IndexError, ValueError, TableChanged):
+                # A torn read can produce all kinds of garbage - the check
+                # below decides whether that's what happened
+                result = TableChanged
+
+            check, = struct.unpack_from('<Q', self.map, SEQUENCE_OFFSET)
+            if check == sequence:
+                if result is TableChanged:
+                    raise ValueError('{} is corrupt'.format(self.path))
+                return generation, result
+
+        raise TableChanged('Table changed too often to read')
+
+    @property
+    def generation(self):
+        """
+        The generation of the peer table that was most recently published.
+        """
+        generation, _ = self.read_consistent(lambda offset: None)
+        return generation
+
+    def _find_name(self, offset, name):
+        """
+        Finds the offset of the name entry for the given name, or ``None``.
+        """
+        name_buckets, _ = SLOT_HEADER.unpack_from(self.map, offset)
+        buckets_offset = offset + SLOT_HEADER.size
+
+        bucket = _hash(name) % name_buckets
+        for _ in range(name_buckets):
+            entry, = BUCKET.unpack_from(self.map,
+                buckets_offset + bucket * BUCKET.size)
+            if not entry:
+                return None
+
+            entry += offset
+            name_length, = NAME_LENGTH.unpack_from(self.map, entry)
+            name_start = entry + NAME_LENGTH.size
+            if self.map[name_start:name_start + name_length] == name:
+                return entry
+
+            bucket = (bucket + 1) % name_buckets
+
+        return None
+
+    def _read_name_entry(self, entry):
+        """
+        Gets the hostname and list of IP addresses stored in a name entry.
+        """
+        name_length, = NAME_LENGTH.unpack_from(self.map, entry)
+        name_start = entry + NAME_LENGTH.size
+        name = self.map[name_start:name_start + name_length].decode('ascii')
+
+        count_offset = name_start + name_length
+        addr_count, = ADDR_COUNT.unpack_from(self.map, count_offset)
+        addrs_start = count_offset + ADDR_COUNT.size
+        ips = [socket.inet_ntoa(self.map[start:start + 4])
+            for start in range(addrs_start, addrs_start + 4 * addr_count, 4)]
+        return name, ips
+
+    def query_host(self, host):
+        """
+        Gets a list of IP addresses which have the given hostname.
+        """
+        name = host.encode('ascii')
+
+        def reader(offset):
+            entry = self._find_name(offset, name)
+            if entry is None:
+                return []
+            _, ips = self._read_name_entry(entry)
+            return ips
+
+        _, ips = self.read_consistent(reader)
+        return ips or []
+
+    def query_ip(self, ip):
+        """
+        Gets a host for the given IP address, or None.
+        """
+        packed_ip = socket.inet_aton(ip)
+
+        def reader(offset):
+            name_buckets, addr_buckets = SLOT_HEADER.unpack_from(self.map,
+                offset)
+            buckets_offset = (offset + SLOT_HEADER.size +
+                name_buckets * BUCKET.size)
+
+            bucket = _hash(packed_ip) % addr_buckets
+            for _ in range(addr_buckets):
+                entry, = BUCKET.unpack_from(self.map,
+                    buckets_offset + bucket * BUCKET.size)
+                if not entry:
+                    return None
+
+                entry_ip, name_entry = ADDR_ENTRY.unpack_from(self.map,
+                    offset + entry)
+                if entry_ip == packed_ip:
+                    name, _ = self._read_name_entry(offset + name_entry)
+                    return name
+
+                bucket = (bucket + 1) % addr_buckets
+
+            return None
+
+        _, host = self.read_consistent(reader)
+        return host
+
+    def get_host_ip_map(self):
+        """
+        Gets the host to IP address map.
+        """
+        _, host_to_ips = self.read_host_ip_map()
+        return host_to_ips
+
+    def read_host_ip_map(self):
+        """
+        Gets the generation of the table along with its host to IP address
+        map, both read from the same version of the table.
+        """
+        def reader(offset):
+            name_buckets, _ = SLOT_HEADER.unpack_from(self.map, offset)
+            buckets = struct.unpack_from('<{}I'.format(name_buckets),
+                self.map, offset + SLOT_HEADER.size)
+
+            host_to_ips = {}
+            for entry in buckets:
+                if entry:
+                    name, ips = self._read_name_entry(offset + entry)
+                    host_to_ips[name] = ips
+            return host_to_ips
+
+        generation, host_to_ips = self.read_consistent(reader)
+        return generation, host_to_ips or {}
+
+class SharedTablePublisher:
+    """
+    Keeps a :class:`SharedTableWriter` up to date with the network handler's
+    peer table, by republishing it after any reactor step which changed it.
+    """
+    def __init__(self, network_handler, a_reactor, path):
+        self.network_handler = network_handler
+        self.reactor = a_reactor
+        self.writer = SharedTableWriter(path)
+        self.published_generation = None
+
+    def open(self):
+        """
+        Creates the table file, and starts keeping it up to date.
+        """
+        self.writer.open()
+        self.on_step()
+        self.reactor.add_step_callback(self.on_step)
+
+    def close(self):
+        """
+        Removes the table file.
+        """
+        self.writer.close()
+
+    def on_step(self):
+        """
+        Republishes the table if it has changed since it was last published.
+        """
+        generation = self.network_handler.generation
+        if generation != self.published_generation:
+            self.writer.publish(self.network_handler.get_host_ip_map(),
+                generation)
+            self.published_generation = generation
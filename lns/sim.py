@@ -0,0 +1,306 @@
+"""
+Network Simulator
+-----------------
+
+This runs a real :class:`lns.net_proto.ProtocolHandler` against a simulated
+network, so that its behavior with thousands of peers can be measured on one
+machine.
+
+The handler is given a :class:`SimSocket` in place of its UDP socket, and a
+:class:`VirtualClock` in place of the system clock, so that a minute of
+announces from 100,000 peers takes only as long as the handler needs to
+process them. The :class:`NetworkSimulator` plays the part of the peers, and
+of the reactor:
+
+- Every simulated peer announces itself every
+  :const:`lns.net_proto.ANNOUNCE_ALARM` seconds, starting at a random point
+  in the first interval.
+- Once every interval, some of the peers leave the network (and are replaced
+  by new ones, with new addresses), and some are renamed.
+- Any announce can be lost on the way, or delivered twice.
+- Time moves in ticks of :const:`SIM_TICK` seconds. The announces sent during
+  a tick are handed to the handler together, and then the handler's step
+  callbacks run, like they would after a poll.
+
+The CPU time that the handler spends receiving packets and running its step
+callbacks is kept in a :class:`SimStats`. Everything is driven by a seeded
+random number generator, so that a run can be repeated exactly.
+"""
+from collections import deque
+import heapq
+import random
+import time
+
+from lns import net_proto
+
+# The virtual time that simulations start at, in seconds. The handler takes a
+# time of 0 to mean that it has never announced itself.
+START_TIME = 1000.0
+
+# How far the virtual clock moves between polls of the handler, in seconds
+SIM_TICK = 0.1
+
+class VirtualClock:
+    """
+    A clock which only moves when it is told to, and which can stand in for
+    :func:`time.time`.
+    """
+    def __init__(self, start=START_TIME):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, when):
+        """
+        Moves the clock forward to the given time, unless it is already past
+        it.
+        """
+        if when > self.now:
+            self.now = when
+
+class SimSocket:
+    """
+    Stands in for a handler's UDP socket, holding the datagrams sent to it
+    until the handler receives them, and counting the ones the handler sends.
+    """
+    def __init__(self, port=net_proto.NET_PORT):
+        self.port = port
+        self.inbox = deque()
+        self.packets_sent = 0
+        self.bytes_sent = 0
+
+    def deliver(self, data, host):
+        """
+        Queues up a datagram from the given host, to be received by the
+        handler.
+        """
+        self.inbox.append((data, (host, self.port)))
+
+    def recvfrom(self, size):
+        if not self.inbox:
+            raise BlockingIOError('No datagrams waiting')
+
+        data, addr = self.inbox.popleft()
+        return data[:size], addr
+
+    def sendto(self, data, addr):
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+def make_ip(i):
+    """
+    Gets a distinct IPv4 address for each integer.
+
+        >>> make_ip(258)
+        '10.0.1.2'
+    """
+    return '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256)
+
+class SimPeer:
+    """
+    A simulated peer, and the announce it sends.
+    """
+    __slots__ = ('ip', 'hostname', 'packet', 'alive')
+
+    def __init__(self, ip, hostname):
+        self.ip = ip
+        self.alive = True
+        self.rename(hostname)
+
+    def rename(self, hostname):
+        """
+        Changes the name that the peer announces.
+        """
+        self.hostname = hostname
+        self.packet = net_proto.Announce(hostname).serialize()
+
+class SimStats:
+    """
+    What happened during a simulation, and what it cost the handler.
+    """
+    def __init__(self):
+        self.packets_sent = 0
+        self.packets_lost = 0
+        self.packets_duplicated = 0
+        self.packets_delivered = 0
+        self.peers_left = 0
+        self.peers_renamed = 0
+
+        # The CPU time spent receiving packets, running the handler's announce
+        # timeout (which announces and expires peers when it is due), and
+        # publishing snapshots of the peer table
+        self.receive_time = 0
+        self.timeout_time = 0
+        self.snapshot_time = 0
+
+        # The steps in which the handler announced itself and looked for
+        # expired peers, and the CPU time they took
+        self.expiry_runs = 0
+        self.expiry_time = 0
+        self.expiry_longest = 0
+
+    def as_dict(self):
+        """
+        Gets the stats as a dictionary, along with the averages derived from
+        them, for reporting.
+        """
+        report = dict(vars(self))
+        report['receive_time_per_packet'] = (
+            self.receive_time / self.packets_delivered
+            if self.packets_delivered else None)
+        report['expiry_time_per_run'] = (
+            self.expiry_time / self.expiry_runs if self.expiry_runs else None)
+        return report
+
+class NetworkSimulator:
+    """
+    Drives a :class:`lns.net_proto.ProtocolHandler` with announces from a
+    number of simulated peers.
+
+    ``churn`` and ``renames`` are the fractions of the peers which leave, and
+    which are renamed, in each announce interval. ``loss`` and ``duplicates``
+    are the chances of an announce being lost, and of it being delivered
+    twice.
+    """
+    def __init__(self, peers, churn=0, renames=0, loss=0, duplicates=0,
+            seed=0, tick=SIM_TICK):
+        self.churn = churn
+        self.renames = renames
+        self.loss = loss
+        self.duplicates = duplicates
+        self.tick = tick
+        self.random = random.Random(seed)
+
+        self.clock = VirtualClock()
+        self.socket = SimSocket()
+        self.handler = net_proto.ProtocolHandler(None, 'sim',
+            clock=self.clock)
+        self.handler.server_sock = self.socket
+
+        self.stats = SimStats()
+
+        # The peers on the network, and the number of peers that have ever
+        # joined (which picks the address of the next one)
+        self.peers = []
+        self.joined = 0
+
+        # The announces waiting to be sent, as (time, order, peer) entries -
+        # the order keeps peers announcing at the same time comparable
+        self.schedule = []
+        self.order = 0
+
+        self.next_turnover = self.clock.now + net_proto.ANNOUNCE_ALARM
+        for _ in range(peers):
+            self.add_peer()
+
+    def add_peer(self):
+        """
+        Adds a new peer, which first announces itself at some point within
+        the next announce interval.
+        """
+        peer = SimPeer(make_ip(self.joined), 'peer-{}'.format(self.joined))
+        self.joined += 1
+        self.peers.append(peer)
+        self.schedule_announce(peer, self.clock.now +
+            self.random.uniform(0, net_proto.ANNOUNCE_ALARM))
+
+    def schedule_announce(self, peer, when):
+        """
+        Has a peer announce itself at the given time.
+        """
+        heapq.heappush(self.schedule, (when, self.order, peer))
+        self.order += 1
+
+    def turn_over(self):
+        """
+        Replaces some of the peers with new ones, and renames some others.
+        """
+        leaving = self.random.sample(range(len(self.peers)),
+            round(self.churn * len(self.peers)))
+        for index in leaving:
+            self.peers[index].alive = False
+
+        if leaving:
+            self.peers = [peer for peer in self.peers if peer.alive]
+            for _ in leaving:
+                self.add_peer()
+            self.stats.peers_left += len(leaving)
+
+        renaming = self.random.sample(self.peers,
+            round(self.renames * len(self.peers)))
+        for peer in renaming:
+            self.stats.peers_renamed += 1
+            peer.rename('renamed-{}'.format(self.stats.peers_renamed))
+
+    def send_announce(self, peer):
+        """
+        Sends an announce from a peer, which may get lost or duplicated.
+        """
+        self.stats.packets_sent += 1
+        if self.loss and self.random.random() < self.loss:
+            self.stats.packets_lost += 1
+            return
+
+        self.socket.deliver(peer.packet, peer.ip)
+        if self.duplicates and self.random.random() < self.duplicates:
+            self.stats.packets_duplicated += 1
+            self.socket.deliver(peer.packet, peer.ip)
+
+    def step(self):
+        """
+        Moves time forward by one tick, delivering the announces sent during
+        it and then running the handler's step callbacks.
+        """
+        tick_end = self.clock.now + self.tick
+        if tick_end >= self.next_turnover:
+            self.turn_over()
+            self.next_turnover += net_proto.ANNOUNCE_ALARM
+
+        schedule = self.schedule
+        while schedule and schedule[0][0] <= tick_end:
+            when, _, peer = heapq.heappop(schedule)
+            if peer.alive:
+                self.send_announce(peer)
+                self.schedule_announce(peer,
+                    when + net_proto.ANNOUNCE_ALARM)
+
+        self.clock.advance_to(tick_end)
+
+        handler = self.handler
+        inbox = self.socket.inbox
+        delivered = len(inbox)
+        started = time.process_time()
+        for _ in range(delivered):
+            handler.on_message(None)
+        finished = time.process_time()
+        self.stats.packets_delivered += delivered
+        self.stats.receive_time += finished - started
+
+        last_announce = handler.last_announce_time
+        started = time.process_time()
+        handler.on_announce_timeout()
+        expired = time.process_time()
+        handler.peers.publish_snapshot()
+        finished = time.process_time()
+        self.stats.timeout_time += expired - started
+        self.stats.snapshot_time += finished - expired
+
+        if handler.last_announce_time != last_announce:
+            self.stats.expiry_runs += 1
+            self.stats.expiry_time += expired - started
+            self.stats.expiry_longest = max(self.stats.expiry_longest,
+                expired - started)
+
+    def run(self, duration):
+        """
+        Runs the simulation for the given number of virtual seconds.
+        """
+        end = self.clock.now + duration
+        while self.clock.now < end:
+            self.step()
+        return self.stats
@@ -0,0 +1,281 @@
+"""
+Packet Traces
+-------------
+
+This records the datagrams that lnsd receives on its network port, so that
+trouble on a real network can be looked into (and reproduced) elsewhere.
+
+Traces are pcap files, with a synthesized IPv4 and UDP header in front of
+each datagram, so that Wireshark (with ``extra/lns-dissect.lua``), tcpdump and
+the like can read them. Each record keeps the time the datagram arrived and
+the address and port it came from. The headers claim that every datagram was
+sent to the broadcast address, since lnsd doesn't see where datagrams were
+addressed to.
+
+Announces are mostly NUL padding, so to keep traces small, the padding at the
+end of each datagram isn't written - the record is marked as cut short, and
+:func:`read_trace` puts the padding back.
+
+A :class:`TraceWriter` only ever appends to its file, and stops recording
+once the file reaches its size limit. A :class:`Replayer` feeds a trace back
+into a :class:`lns.net_proto.ProtocolHandler`, on the trace's own time, either
+as fast as it can or paced to some multiple of the original speed.
+"""
+from collections import namedtuple
+import logging
+import socket
+import struct
+import time
+
+from lns import metrics, net_proto, sim
+
+LOGGER = logging.getLogger('lns.trace')
+
+# The largest that a trace file can get before recording stops, in bytes
+TRACE_MAX_SIZE = 64 * 1024 * 1024
+
+# How often recorded datagrams are flushed to the file, in seconds
+TRACE_FLUSH_INTERVAL = 1
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_VERSION = (2, 4)
+
+# Records hold raw IPv4 packets, without any link layer header
+LINKTYPE_IPV4 = 228
+
+# The largest record any reader should expect - a whole IPv4 packet
+PCAP_SNAPLEN = 65535
+
+PCAP_HEADER = struct.Struct('<IHHiIII')
+RECORD_HEADER = struct.Struct('<IIII')
+IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+UDP_HEADER = struct.Struct('!HHHH')
+
+# The address that every recorded datagram is said to have been sent to
+TRACE_DESTINATION = '255.255.255.255'
+
+class TraceRecord(namedtuple('TraceRecord',
+        ['timestamp', 'host', 'port', 'data'])):
+    """
+    A datagram read from a trace, with the time it arrived and the address
+    and port it came from.
+    """
+
+def ipv4_checksum(header):
+    """
+    Computes the checksum of an IPv4 header (whose checksum field is zero).
+    """
+    total = sum(struct.unpack('!{}H'.format(len(header) // 2), header))
+    while total > 0xffff:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+def is_trace_header(header):
+    """
+    Returns whether the given bytes start a trace that lnsd can read.
+    """
+    if len(header) != PCAP_HEADER.size:
+        return False
+
+    magic, _, _, _, _, _, linktype = PCAP_HEADER.unpack(header)
+    return magic == PCAP_MAGIC and linktype == LINKTYPE_IPV4
+
+def build_frame(data, host, port, destination=TRACE_DESTINATION,
+        destination_port=net_proto.NET_PORT):
+    """
+    Builds the IPv4 and UDP headers which carried a datagram from the given
+    address and port. The UDP checksum is left out, which IPv4 allows.
+    """
+    udp_length = UDP_HEADER.size + len(data)
+    total_length = IPV4_HEADER.size + udp_length
+    source = socket.inet_aton(host)
+    destination = socket.inet_aton(destination)
+
+    ip_header = IPV4_HEADER.pack(0x45, 0, total_length, 0, 0, 64,
+        socket.IPPROTO_UDP, 0, source, destination)
+    ip_header = IPV4_HEADER.pack(0x45, 0, total_length, 0, 0, 64,
+        socket.IPPROTO_UDP, ipv4_checksum(ip_header), source, destination)
+    return ip_header + UDP_HEADER.pack(port, destination_port, udp_length, 0)
+
+class TraceWriter:
+    """
+    Appends the datagrams received by a network protocol handler to a trace
+    file, until it reaches its size limit.
+    """
+    def __init__(self, a_reactor, path, port=net_proto.NET_PORT,
+            max_size=TRACE_MAX_SIZE, clock=time.time):
+        self.reactor = a_reactor
+        self.path = path
+        self.port = port
+        self.max_size = max_size
+        self.clock = clock
+
+        self.trace_file = None
+        self.size = 0
+        self.full = False
+        self.flush_timer = None
+
+        self.packets_traced = metrics.REGISTRY.counter('packets_traced')
+        self.packets_untraced = metrics.REGISTRY.counter('packets_untraced')
+
+    def open(self):
+        """
+        Opens the trace file, writing the pcap header if it is new.
+
+        :raises ValueError: If the file exists, but isn't a trace that can be
+            appended to.
+        """
+        self.trace_file = open(self.path, 'ab')
+        self.size = self.trace_file.tell()
+        if self.size == 0:
+            header = PCAP_HEADER.pack(PCAP_MAGIC, *PCAP_VERSION, 0, 0,
+                PCAP_SNAPLEN, LINKTYPE_IPV4)
+            self.trace_file.write(header)
+            self.size = len(header)
+        else:
+            with open(self.path, 'rb') as existing:
+                header = existing.read(PCAP_HEADER.size)
+            if not is_trace_header(header):
+                self.trace_file.close()
+                raise ValueError('{} is not an lnsd trace'.format(self.path))
+
+        self.flush_timer = self.reactor.call_later(TRACE_FLUSH_INTERVAL,
+            self.on_flush)
+
+    def close(self):
+        """
+        Writes out anything buffered, and closes the trace file.
+        """
+        self.flush_timer.cancel()
+        self.trace_file.close()
+
+    def on_flush(self):
+        """
+        Writes recorded datagrams out to the file, so that they aren't lost
+        if lnsd is killed.
+        """
+        self.trace_file.flush()
+        self.flush_timer = self.reactor.call_later(TRACE_FLUSH_INTERVAL,
+            self.on_flush)
+
+    def record(self, data, host, port):
+        """
+        Appends a datagram received from the given address and port, unless
+        the trace is full.
+        """
+        # The IP and UDP headers describe the whole datagram, but only the
+        # part before the padding is captured
+        payload = data.rstrip(b'\x00')
+        frame = build_frame(data, host, port, destination_port=self.port)
+        captured = len(frame) + len(payload)
+        if self.size + RECORD_HEADER.size + captured > self.max_size:
+            self.packets_untraced.inc()
+            if not self.full:
+                self.full = True
+                LOGGER.warning('Trace %s is full - no longer recording',
+                    self.path)
+            return
+
+        now = self.clock()
+        seconds = int(now)
+        self.trace_file.write(RECORD_HEADER.pack(seconds,
+            int((now - seconds) * 1000000), captured, len(frame) + len(data)))
+        self.trace_file.write(frame)
+        self.trace_file.write(payload)
+
+        self.size += RECORD_HEADER.size + captured
+        self.packets_traced.inc()
+
+def read_trace(path):
+    """
+    Reads the datagrams in a trace written by a :class:`TraceWriter`,
+    yielding a :class:`TraceRecord` for each.
+
+    :raises ValueError: If the file isn't an lnsd trace.
+    """
+    with open(path, 'rb') as trace_file:
+        if not is_trace_header(trace_file.read(PCAP_HEADER.size)):
+            raise ValueError('{} is not an lnsd trace'.format(path))
+
+        while True:
+            record_header = trace_file.read(RECORD_HEADER.size)
+            if len(record_header) < RECORD_HEADER.size:
+                # A record cut off partway through was being written when
+                # lnsd stopped
+                return
+
+            seconds, micros, captured, original = RECORD_HEADER.unpack(
+                record_header)
+            frame = trace_file.read(captured)
+            if len(frame) < captured:
+                return
+
+            header_length = (frame[0] & 0x0f) * 4
+            source = socket.inet_ntoa(frame[12:16])
+            source_port, = struct.unpack_from('!H', frame, header_length)
+            data = frame[header_length + UDP_HEADER.size:]
+            data += b'\x00' * (original - captured)
+
+            yield TraceRecord(seconds + micros / 1000000, source, source_port,
+                data)
+
+class Replayer:
+    """
+    Feeds the datagrams in a trace to a network protocol handler which runs
+    on the trace's time, so that the handler ends up where the one which
+    recorded the trace was.
+
+    With a speed, datagrams are delivered that many times faster than they
+    arrived (1 being the original speed). Without one, they are delivered as
+    fast as possible - either way, the handler sees the same times.
+    """
+    def __init__(self, records, hostname='replay', speed=None):
+        self.records = records
+        self.speed = speed
+
+        self.clock = None
+        self.socket = sim.SimSocket()
+        self.handler = None
+        self.hostname = hostname
+
+        self.first_timestamp = None
+        self.packets = 0
+        self.receive_time = 0
+        self.elapsed = 0
+
+    def run(self):
+        """
+        Replays every datagram, returning the handler (or ``None``, if there
+        were no datagrams in the trace).
+        """
+        started = time.monotonic()
+        for record in self.records:
+            if self.handler is None:
+                # The handler starts at the time of the first datagram, as
+                # if it had just been started then
+                self.first_timestamp = record.timestamp
+                self.clock = sim.VirtualClock(record.timestamp)
+                self.handler = net_proto.ProtocolHandler(None, self.hostname,
+                    clock=self.clock)
+                self.handler.server_sock = self.socket
+                self.handler.on_announce_timeout()
+
+            if self.speed is not None:
+                elapsed = record.timestamp - self.first_timestamp
+                delay = elapsed / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.clock.advance_to(record.timestamp)
+            self.socket.deliver(record.data, record.host)
+
+            receive_started = time.process_time()
+            self.handler.on_message(None)
+            self.receive_time += time.process_time() - receive_started
+            self.packets += 1
+
+            self.handler.on_announce_timeout()
+            self.handler.peers.publish_snapshot()
+
+        self.elapsed = time.monotonic() - started
+        return self.handler
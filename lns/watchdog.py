@@ -0,0 +1,217 @@
+"""
+Watchdog
+--------
+
+This finds out what is keeping a reactor busy. Once a reactor has monitoring
+turned on (see :meth:`lns.reactor.StepCallbackProcessor.enable_monitoring`),
+it runs every callback - for file events, timers, step callbacks and calls
+from other threads - through a :class:`CallbackMonitor`, which:
+
+- Times the callback, and keeps the number of calls, the total time and the
+  longest time of each callback, by the function that it runs.
+- Warns about any callback which takes longer than the slow callback
+  threshold.
+- Runs a watchdog thread, which looks in on the reactor's thread. If a
+  callback is still running past the threshold, or the reactor hasn't got back
+  to polling within the stall deadline, the watchdog logs a stack trace of the
+  reactor's thread, showing what it is doing at that moment.
+
+Reactors without monitoring only pay for checking that their monitor is
+``None``.
+"""
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from lns import metrics
+
+LOGGER = logging.getLogger('lns.watchdog')
+
+# How long a callback can run before it is reported as slow, in seconds
+SLOW_CALLBACK_THRESHOLD = 0.1
+
+# How long the reactor can go without getting back to polling before the
+# watchdog reports it as stalled, in seconds
+STALL_DEADLINE = 1
+
+# How many of the slowest callbacks are logged when monitoring stops
+REPORT_CALLBACKS = 10
+
+def describe_callback(callback):
+    """
+    Gets a readable name for a callback, including where its function is
+    defined, so that lambdas can be told apart.
+    """
+    func = getattr(callback, '__func__', callback)
+    while isinstance(func, functools.partial):
+        func = func.func
+
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return repr(func)
+
+    return '{}.{} ({}:{})'.format(func.__module__, func.__qualname__,
+        os.path.basename(code.co_filename), code.co_firstlineno)
+
+def get_callback_key(callback):
+    """
+    Gets the value that calls to the same callback are grouped by - the code
+    that it runs, so that every client's copy of a lambda counts together.
+    """
+    func = getattr(callback, '__func__', callback)
+    while isinstance(func, functools.partial):
+        func = func.func
+    return getattr(func, '__code__', func)
+
+class CallbackStats:
+    """
+    The timings of all the calls to one callback.
+    """
+    __slots__ = ('name', 'calls', 'total', 'longest')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0
+        self.longest = 0
+
+class CallbackMonitor:
+    """
+    Times a reactor's callbacks, and watches the reactor from another thread
+    for callbacks that run too long and for polls that don't happen in time.
+    """
+    def __init__(self, threshold=SLOW_CALLBACK_THRESHOLD,
+            deadline=STALL_DEADLINE):
+        self.threshold = threshold
+        self.deadline = deadline
+
+        # Maps the key of each callback (see get_callback_key) to its stats
+        self.callback_stats = {}
+
+        # These are written by the reactor's thread and read by the watchdog.
+        # The callback that is running and when it started (or None), and
+        # when the reactor last stopped polling (or None while it polls).
+        self.reactor_thread = None
+        self.current = None
+        self.busy_since = None
+
+        # The last callback and the last stall that the watchdog reported, so
+        # that each is only reported once
+        self.reported_current = None
+        self.reported_busy_since = None
+
+        self.stopping = threading.Event()
+        self.watchdog = None
+
+        self.slow_callbacks = metrics.REGISTRY.counter('slow_callbacks')
+        self.stalls = metrics.REGISTRY.counter('reactor_stalls')
+
+    def open(self):
+        """
+        Starts the watchdog thread.
+        """
+        self.watchdog = threading.Thread(target=self.run_watchdog,
+            name='reactor-watchdog', daemon=True)
+        self.watchdog.start()
+
+    def close(self):
+        """
+        Stops the watchdog thread, and logs the slowest callbacks.
+        """
+        self.stopping.set()
+        self.watchdog.join()
+
+        for stats in self.get_slowest(REPORT_CALLBACKS):
+            LOGGER.info('%s: %d calls, %.6fs total, %.6fs longest',
+                stats.name, stats.calls, stats.total, stats.longest)
+
+    def enter_poll(self):
+        """
+        Notes that the reactor is about to wait for events.
+        """
+        self.busy_since = None
+
+    def leave_poll(self):
+        """
+        Notes that the reactor has stopped waiting, and is running callbacks.
+        """
+        self.reactor_thread = threading.get_ident()
+        self.busy_since = time.monotonic()
+
+    def run(self, callback, *args):
+        """
+        Runs a callback, and records how long it took.
+        """
+        # Callbacks can run other callbacks (like the functions passed to
+        # call_soon_threadsafe), so the outer one is put back afterwards
+        outer = self.current
+        started = time.monotonic()
+        self.current = (callback, started)
+        try:
+            callback(*args)
+        finally:
+            elapsed = time.monotonic() - started
+            self.current = outer
+
+            key = get_callback_key(callback)
+            stats = self.callback_stats.get(key)
+            if stats is None:
+                stats = CallbackStats(describe_callback(callback))
+                self.callback_stats[key] = stats
+
+            stats.calls += 1
+            stats.total += elapsed
+            if elapsed > stats.longest:
+                stats.longest = elapsed
+
+            if elapsed > self.threshold:
+                self.slow_callbacks.inc()
+                LOGGER.warning('Slow callback %s took %.3fs', stats.name,
+                    elapsed)
+
+    def get_slowest(self, count):
+        """
+        Gets the :class:`CallbackStats` of the callbacks which have taken the
+        longest in a single call, slowest first.
+        """
+        return sorted(self.callback_stats.values(),
+            key=lambda stats: stats.longest, reverse=True)[:count]
+
+    def format_reactor_stack(self):
+        """
+        Formats the stack of the reactor's thread, as it is right now.
+        """
+        frame = sys._current_frames().get(self.reactor_thread)
+        if frame is None:
+            return '(no stack available)'
+        return ''.join(traceback.format_stack(frame))
+
+    def run_watchdog(self):
+        """
+        Looks in on the reactor's thread, until monitoring stops.
+        """
+        interval = min(self.threshold, self.deadline) / 4
+        while not self.stopping.wait(interval):
+            now = time.monotonic()
+
+            current = self.current
+            if (current is not None and current is not self.reported_current
+                    and now - current[1] > self.threshold):
+                self.reported_current = current
+                callback, started = current
+                LOGGER.warning('Callback %s has been running for %.3fs:\n%s',
+                    describe_callback(callback), now - started,
+                    self.format_reactor_stack())
+
+            busy_since = self.busy_since
+            if (busy_since is not None and
+                    busy_since != self.reported_busy_since and
+                    now - busy_since > self.deadline):
+                self.reported_busy_since = busy_since
+                self.stalls.inc()
+                LOGGER.warning('Reactor has not polled for %.3fs:\n%s',
+                    now - busy_since, self.format_reactor_stack())
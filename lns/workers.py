@@ -0,0 +1,241 @@
+"""
+Worker Processes
+----------------
+
+This spreads the work of answering control clients over several processes,
+so that lookups aren't limited to what a single core can handle.
+
+The process that lnsd starts in is the *owner*. It runs the network protocol,
+publishes the peer table into a :mod:`lns.shared_table` file, and serves the
+control port like it always does. It also starts a number of *workers*, each
+of which binds the same control port with ``SO_REUSEPORT`` - the kernel then
+hands each new client to one of the owner or the workers.
+
+Each worker follows the shared table, checking it for a new generation every
+:const:`WORKER_CHECK_INTERVAL` seconds and applying the differences to a
+:class:`lns.net_proto.PeerTable` of its own. That way, the worker can answer
+every kind of control request, including ``GET-CHANGES``, ``SUBSCRIBE`` and
+``WAIT-HOST``, with versions that agree with the owner's.
+
+The owner checks on its workers every :const:`WORKER_SUPERVISE_INTERVAL`
+seconds, and replaces any which have died. A worker which gets a ``QUIT``
+message passes it on to the owner, which stops all of the workers before it
+stops itself. Workers whose owner has gone away stop on their own.
+
+Workers are started as fresh interpreters (multiprocessing's ``spawn``), not
+forked from the owner. A forked worker would inherit every descriptor the
+owner has open - its sockets, its clients' connections and its reactor's
+wakeup pipe - which would keep clients connected after the owner closed them.
+It would also be forked in the middle of whatever the owner's threads (the
+log writer, the hosts file writer, the watchdog) were doing. Only the control
+port, the table path and the options that a worker needs are passed on.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+from lns import control_proto, log_queue, net_proto, reactor, shared_table
+
+LOGGER = logging.getLogger('lns.workers')
+
+# How often a worker checks the shared table for changes, in seconds
+WORKER_CHECK_INTERVAL = 0.1
+
+# How often the owner checks for workers which have died, in seconds
+WORKER_SUPERVISE_INTERVAL = 1
+
+class TableFollower:
+    """
+    Provides the same view of the peer table as the network protocol
+    handler, by following a table published by
+    :class:`lns.shared_table.SharedTablePublisher` in another process.
+    """
+    def __init__(self, a_reactor, path, interval=WORKER_CHECK_INTERVAL):
+        self.reactor = a_reactor
+        self.interval = interval
+        self.reader = shared_table.SharedTableReader(path)
+        self.peers = net_proto.PeerTable()
+        self.check_timer = None
+
+    def open(self):
+        """
+        Loads the current table, and starts following it.
+        """
+        self.reader.open()
+        generation, host_to_ips = self.reader.read_host_ip_map()
+        self.peers.reset(host_to_ips, generation)
+        self.check_timer = self.reactor.call_later(self.interval,
+            self.on_check)
+
+    def close(self):
+        """
+        Stops following the table.
+        """
+        self.check_timer.cancel()
+        self.reader.close()
+
+    def on_check(self):
+        """
+        Applies any changes made to the shared table since the last check.
+        """
+        if self.reader.generation != self.peers.generation:
+            generation, host_to_ips = self.reader.read_host_ip_map()
+            self.peers.sync(host_to_ips, generation)
+            self.peers.publish_snapshot()
+
+        self.check_timer = self.reactor.call_later(self.interval,
+            self.on_check)
+
+    @property
+    def generation(self):
+        """
+        The generation of the peer table that the follower last applied.
+        """
+        return self.peers.generation
+
+    def get_changes_since(self, generation):
+        """
+        See :meth:`lns.net_proto.PeerTable.get_changes_since`.
+        """
+        return self.peers.get_changes_since(generation)
+
+    def add_change_listener(self, listener):
+        """
+        See :meth:`lns.net_proto.PeerTable.add_listener`.
+        """
+        self.peers.add_listener(listener)
+
+    def remove_change_listener(self, listener):
+        """
+        See :meth:`lns.net_proto.PeerTable.remove_listener`.
+        """
+        self.peers.remove_listener(listener)
+
+    def get_snapshot(self):
+        """
+        See :meth:`lns.net_proto.PeerTable.publish_snapshot`.
+        """
+        return self.peers.publish_snapshot()
+
+    def query_host(self, host):
+        """
+        Gets a list of IP addresses which have the given hostname.
+        """
+        return self.peers.query_host(host)
+
+    def query_ip(self, ip):
+        """
+        Gets a host for the given IP address, or None.
+        """
+        return self.peers.query_ip(ip)
+
+    def get_host_ip_map(self):
+        """
+        Gets the host to IP address map.
+        """
+        return self.peers.get_host_ip_map()
+
+def run_worker(owner_pid, port, table_path, control_options,
+        log_options=None):
+    """
+    Serves the control port from the shared table at the given path, until
+    the worker is told to quit or its owner goes away. If there are log
+    options, the worker logs to stderr like the owner does with them.
+    """
+    # The owner stops its workers itself, even on a Ctrl-C to the whole
+    # process group, and only the owner can be profiled
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+    log_pipeline = None
+    if log_options is not None:
+        log_pipeline = log_queue.LogPipeline(sys.stderr, **log_options)
+        log_pipeline.open()
+
+    my_reactor = reactor.Reactor()
+    follower = TableFollower(my_reactor, table_path)
+    control_handler = control_proto.ProtocolHandler(follower, my_reactor,
+        port=port, reuse_port=True, serve_stats=False, **control_options)
+
+    follower.open()
+    control_handler.open()
+    LOGGER.debug('Worker %d serving port %d', os.getpid(), port)
+
+    while control_handler.is_running() and os.getppid() == owner_pid:
+        my_reactor.poll(WORKER_SUPERVISE_INTERVAL)
+
+    if control_handler.is_running():
+        LOGGER.info('Worker %d lost its owner', os.getpid())
+    else:
+        os.kill(owner_pid, signal.SIGTERM)
+
+    control_handler.close()
+    follower.close()
+    my_reactor.close()
+    if log_pipeline is not None:
+        log_pipeline.close()
+
+class WorkerSupervisor:
+    """
+    Starts worker processes which serve the control port alongside the
+    owner, and keeps that many of them running.
+    """
+    def __init__(self, a_reactor, count, port, table_path, log_options=None,
+            **control_options):
+        self.reactor = a_reactor
+        self.count = count
+        self.port = port
+        self.table_path = table_path
+        self.log_options = log_options
+        self.control_options = control_options
+
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.supervise_timer = None
+
+    def open(self):
+        """
+        Starts the workers, and starts checking on them.
+        """
+        self.workers = [self.start_worker() for _ in range(self.count)]
+        self.supervise_timer = self.reactor.call_later(
+            WORKER_SUPERVISE_INTERVAL, self.on_supervise)
+
+    def close(self):
+        """
+        Stops the workers, and waits for them to exit.
+        """
+        self.supervise_timer.cancel()
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def start_worker(self):
+        """
+        Starts a new worker process.
+        """
+        worker = self.context.Process(target=run_worker,
+            args=(os.getpid(), self.port, self.table_path,
+                self.control_options, self.log_options),
+            name='lnsd worker', daemon=True)
+        worker.start()
+        return worker
+
+    def on_supervise(self):
+        """
+        Replaces any workers which have died.
+        """
+        for index, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                LOGGER.warning('Worker %d exited with %s - restarting it',
+                    worker.pid, worker.exitcode)
+                worker.join()
+                self.workers[index] = self.start_worker()
+
+        self.supervise_timer = self.reactor.call_later(
+            WORKER_SUPERVISE_INTERVAL, self.on_supervise)
@@ -0,0 +1,159 @@
+"""
+Ensures that the asynchronous client can make concurrent requests, and that
+it recovers from dropped connections.
+"""
+import asyncio
+import threading
+import unittest
+
+from lns import aio, control_proto, reactor
+from test_handlers import MockNetworkHandler, reactor_runner_thread
+
+# A port for the embedded server's network handler, which needs to be
+# available on your machine
+TEST_NET_PORT = 15099
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.net_handler = MockNetworkHandler()
+        self.reactor = reactor.Reactor()
+        self.control_handler = control_proto.ProtocolHandler(self.net_handler,
+            self.reactor, port=0)
+        self.control_handler.open()
+        _, self.port = self.control_handler.server_sock.getsockname()
+
+        self.reactor_thread_quit_event = threading.Event()
+        self.reactor_thread = threading.Thread(target=reactor_runner_thread,
+            args=(self.reactor, self.control_handler,
+                self.reactor_thread_quit_event))
+        self.reactor_thread.daemon = True
+        self.reactor_thread.start()
+
+    def tearDown(self):
+        self.reactor_thread_quit_event.set()
+        self.reactor_thread.join()
+        self.reactor.close()
+
+    def run_client(self, test, pool_size=aio.ASYNC_POOL_SIZE):
+        "Runs a coroutine function with a connected client."
+        async def runner():
+            async with aio.AsyncClientHandler(port=self.port,
+                    pool_size=pool_size) as client:
+                await test(client)
+        asyncio.run(runner())
+
+    def test_concurrent_requests(self):
+        """
+        Ensures that many requests outstanding at once each get their own
+        reply, without opening more connections than the pool allows.
+        """
+        async def test(client):
+            hosts = ['a', 'b', 'c', 'nonexistent'] * 50
+            replies = await asyncio.gather(*[client.get_ip(host)
+                for host in hosts])
+            self.assertEqual(replies,
+                [self.net_handler.query_host(host) for host in hosts])
+
+            self.assertEqual(await client.get_host('5.6.7.8'), 'b')
+            self.assertEqual(await client.get_host('0.0.0.0'), None)
+            self.assertEqual(await client.get_host_ip_mapping(),
+                self.net_handler.get_host_ip_map())
+            self.assertLessEqual(len(client.connections), 2)
+
+        self.run_client(test, pool_size=2)
+
+    def test_large_host_ip_mapping(self):
+        """
+        Ensures that a mapping split over several messages is put back
+        together, without confusing the replies to later requests.
+        """
+        for i in range(5 * control_proto.OFFLOAD_REPLY_HOSTS):
+            ip = '10.0.{}.{}'.format(i // 256, i % 256)
+            self.net_handler.host_ips['host-{}'.format(i)] = [ip]
+            self.net_handler.ip_hosts[ip] = 'host-{}'.format(i)
+        self.net_handler.generation += 1
+
+        async def test(client):
+            mapping, ips = await asyncio.gather(client.get_host_ip_mapping(),
+                client.get_ip('b'))
+            self.assertEqual(mapping, self.net_handler.get_host_ip_map())
+            self.assertEqual(ips, ['5.6.7.8'])
+
+        self.run_client(test, pool_size=1)
+
+    def test_wait_host(self):
+        """
+        Ensures that waiting for a host doesn't hold up other requests.
+        """
+        async def test(client):
+            waiter = asyncio.ensure_future(client.wait_for_host('d', 5))
+            self.assertEqual(await client.get_ip('b'), ['5.6.7.8'])
+            self.assertFalse(waiter.done())
+
+            self.net_handler.add_host('d', '17.18.19.20')
+            self.assertEqual(await waiter, ['17.18.19.20'])
+
+        self.run_client(test)
+
+    def test_reconnect(self):
+        """
+        Ensures that a request made after the connection is dropped goes out
+        on a new connection.
+        """
+        async def test(client):
+            self.assertEqual(await client.get_ip('b'), ['5.6.7.8'])
+            for connection in client.connections:
+                connection.writer.transport.abort()
+            await asyncio.sleep(0)
+
+            self.assertEqual(await client.get_ip('b'), ['5.6.7.8'])
+
+        self.run_client(test)
+
+class TestEmbeddedServer(unittest.TestCase):
+    def test_serve(self):
+        """
+        Runs the protocol handlers on an event loop, alongside a client which
+        queries them through the control protocol.
+        """
+        async def test():
+            server = aio.EmbeddedServer('embedded', net_port=TEST_NET_PORT,
+                control_port=0)
+            task = server.start()
+            await asyncio.sleep(0)
+            _, port = server.control_handler.server_sock.getsockname()
+
+            async with aio.AsyncClientHandler(port=port) as client:
+                self.assertEqual(await client.get_ip('nonexistent'), [])
+                self.assertEqual(await client.get_host_ip_mapping(),
+                    server.get_host_ip_map())
+
+            server.stop()
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(test())
+
+    def test_close(self):
+        """
+        Ensures that the server releases its reactor's resources, like its
+        worker threads, once it stops.
+        """
+        async def test():
+            server = aio.EmbeddedServer('embedded', net_port=TEST_NET_PORT)
+            task = server.start()
+            await asyncio.sleep(0)
+
+            finished = asyncio.Event()
+            server.reactor.run_in_worker(lambda: None,
+                lambda future: finished.set())
+            await asyncio.wait_for(finished.wait(), 5)
+            self.assertIsNotNone(server.reactor.worker_pool)
+
+            server.stop()
+            await asyncio.wait_for(task, 5)
+            self.assertIsNone(server.reactor.worker_pool)
+
+        asyncio.run(test())
+
+if __name__ == '__main__':
+    unittest.main()
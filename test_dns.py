@@ -0,0 +1,146 @@
+"""
+Ensures that the DNS responder answers queries from the peer table, and
+refuses anything it isn't responsible for.
+"""
+import socket
+import unittest
+
+from lns import dns_proto, net_proto, reactor
+
+def make_query(name, qtype, query_id=0x1234):
+    "Builds a DNS query for a single name."
+    header = dns_proto.HEADER.pack(query_id, dns_proto.FLAG_RECURSION_DESIRED,
+        1, 0, 0, 0)
+    return (header + dns_proto.encode_name(name.split('.')) +
+        dns_proto.QUESTION_TAIL.pack(qtype, dns_proto.CLASS_IN))
+
+def parse_response(response):
+    "Gets the ID, response code and answer records' data from a response."
+    query_id, flags, question_count, answer_count, _, _ = (
+        dns_proto.HEADER.unpack_from(response))
+    offset = dns_proto.HEADER.size
+    if question_count:
+        question, _, _, _ = dns_proto.parse_question(response)
+        offset += len(question)
+
+    answers = []
+    for _ in range(answer_count):
+        offset += len(dns_proto.QUESTION_NAME_POINTER)
+        _, _, _, length = dns_proto.RECORD_TAIL.unpack_from(response, offset)
+        offset += dns_proto.RECORD_TAIL.size
+        answers.append(response[offset:offset + length])
+        offset += length
+
+    return query_id, flags & 0xF, answers
+
+class TestDNSResponder(unittest.TestCase):
+    def setUp(self):
+        self.peers = net_proto.PeerTable()
+        self.peers.set_host('1.2.3.4', 'Alpha')
+        self.peers.set_host('9.10.11.12', 'Alpha')
+        self.peers.set_host('5.6.7.8', 'beta')
+
+        self.reactor = reactor.Reactor()
+        self.handler = dns_proto.ProtocolHandler(self.peers, self.reactor,
+            domain='lan', port=0)
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def query(self, name, qtype):
+        response = self.handler.build_response(make_query(name, qtype))
+        query_id, rcode, answers = parse_response(response)
+        self.assertEqual(query_id, 0x1234)
+        return rcode, answers
+
+    def test_a(self):
+        """
+        Queries known and unknown names within the domain.
+        """
+        rcode, answers = self.query('alpha.LAN', dns_proto.TYPE_A)
+        self.assertEqual(rcode, dns_proto.RCODE_OK)
+        self.assertEqual(answers,
+            [socket.inet_aton('1.2.3.4'), socket.inet_aton('9.10.11.12')])
+
+        rcode, answers = self.query('gamma.lan', dns_proto.TYPE_A)
+        self.assertEqual(rcode, dns_proto.RCODE_NXDOMAIN)
+        self.assertEqual(answers, [])
+
+        rcode, answers = self.query('example.com', dns_proto.TYPE_A)
+        self.assertEqual(rcode, dns_proto.RCODE_REFUSED)
+
+    def test_a_case_collision(self):
+        """
+        Ensures that hosts whose names differ only by case are all answered
+        for, since they share a DNS name.
+        """
+        self.peers.set_host('13.14.15.16', 'ALPHA')
+        self.peers.set_host('17.18.19.20', 'alpha')
+
+        rcode, answers = self.query('Alpha.lan', dns_proto.TYPE_A)
+        self.assertEqual(rcode, dns_proto.RCODE_OK)
+        self.assertEqual(sorted(answers), sorted(socket.inet_aton(ip)
+            for ip in ['1.2.3.4', '9.10.11.12', '13.14.15.16', '17.18.19.20']))
+
+        rcode, answers = self.query('beta.lan', dns_proto.TYPE_A)
+        self.assertEqual(answers, [socket.inet_aton('5.6.7.8')])
+
+    def test_ptr(self):
+        """
+        Queries known and unknown reverse names.
+        """
+        rcode, answers = self.query('8.7.6.5.in-addr.arpa', dns_proto.TYPE_PTR)
+        self.assertEqual(rcode, dns_proto.RCODE_OK)
+        self.assertEqual(answers, [dns_proto.encode_name(['beta', 'lan'])])
+
+        rcode, answers = self.query('1.0.0.127.in-addr.arpa',
+            dns_proto.TYPE_PTR)
+        self.assertEqual(rcode, dns_proto.RCODE_REFUSED)
+
+    def test_cache_invalidation(self):
+        """
+        Ensures that cached answers are dropped once the peer table changes.
+        """
+        self.assertEqual(self.query('beta.lan', dns_proto.TYPE_A)[1],
+            [socket.inet_aton('5.6.7.8')])
+
+        self.peers.set_host('5.6.7.8', 'gamma')
+        self.assertEqual(self.query('beta.lan', dns_proto.TYPE_A)[0],
+            dns_proto.RCODE_NXDOMAIN)
+        self.assertEqual(self.query('gamma.lan', dns_proto.TYPE_A)[1],
+            [socket.inet_aton('5.6.7.8')])
+
+    def test_malformed(self):
+        """
+        Ensures that mangled queries get format errors, or no reply at all.
+        """
+        self.assertEqual(self.handler.build_response(b'\x00'), None)
+
+        query = make_query('beta.lan', dns_proto.TYPE_A)
+        _, rcode, _ = parse_response(self.handler.build_response(query[:-3]))
+        self.assertEqual(rcode, dns_proto.RCODE_FORMAT_ERROR)
+
+    def test_udp(self):
+        """
+        Sends a query through the UDP socket.
+        """
+        self.handler.address = '127.0.0.1'
+        self.handler.open()
+        try:
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.sendto(make_query('beta.lan', dns_proto.TYPE_A),
+                self.handler.udp_sock.getsockname())
+            self.reactor.poll(1)
+
+            client.settimeout(1)
+            response, _ = client.recvfrom(dns_proto.MAX_UDP_SIZE)
+            client.close()
+        finally:
+            self.handler.close()
+
+        _, rcode, answers = parse_response(response)
+        self.assertEqual(rcode, dns_proto.RCODE_OK)
+        self.assertEqual(answers, [socket.inet_aton('5.6.7.8')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,20 +3,27 @@ Ensures that the protocol handlers for the control protocol and the network
 protocol work as expected.
 """
 from collections import defaultdict
+import os
 import socket
+import stat
+import tempfile
 import threading
+import time
 import traceback
 import unittest
 
-from lns import control_proto, reactor
+from lns import control_proto, net_proto, reactor
 
 # Change this to some port that is available on your machine, so that the
 # control protocol handler and the control protocol client can communicate
 TEST_CONTROL_PORT = 4097
 
+# The same, for the network protocol handlers which announce to each other
+TEST_NET_PORT = 4098
+
 # How long to check back with a threading.Event, so that the reactor runner
 # thread can die within a reasonable time
-RUNNER_CHECK_TIME = 2
+RUNNER_CHECK_TIME = 0.1
 
 def reactor_runner_thread(reactor, handler, event):
     "Steps a reactor, until the given event is triggered."
@@ -30,11 +37,36 @@ class MockNetworkHandler:
     provides static data for testing.
     """
     def __init__(self):
+        self.generation = 0
         self.host_ips = {'a': ['1.2.3.4', '9.10.11.12'], 
             'b': ['5.6.7.8'], 'c': ['13.14.15.16']}
         self.ip_hosts = {'1.2.3.4': 'a', '5.6.7.8': 'b', '9.10.11.12': 'a',
             '13.14.15.16': 'c'}
 
+        self.added = []
+        self.listeners = []
+
+    def add_host(self, host, ip):
+        self.host_ips.setdefault(host, []).append(ip)
+        self.ip_hosts[ip] = host
+        self.generation += 1
+        self.added.append((self.generation, ip, host))
+        for listener in self.listeners:
+            listener(ip, None, host)
+
+    def add_change_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_change_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def get_changes_since(self, generation):
+        if generation < 0 or generation > self.generation:
+            return None
+        added = {ip: host for change_generation, ip, host in self.added
+            if change_generation > generation}
+        return added, [], {}
+
     def query_host(self, host):
         return self.host_ips.get(host, [])
 
@@ -44,16 +76,136 @@ class MockNetworkHandler:
     def get_host_ip_map(self):
         return self.host_ips.copy()
 
+    def get_snapshot(self):
+        return net_proto.Snapshot.build(self.generation, self.host_ips,
+            self.ip_hosts)
+
+class TestPeerTable(unittest.TestCase):
+    def test_generation(self):
+        """
+        Ensures that joins, renames and leaves change the generation, while
+        repeated announces of the same name do not.
+        """
+        peers = net_proto.PeerTable()
+        generations = [peers.generation]
+
+        peers.set_host('1.2.3.4', 'a')
+        generations.append(peers.generation)
+        self.assertEqual(peers.get_host_ip_map(), {'a': ['1.2.3.4']})
+
+        peers.set_host('1.2.3.4', 'a')
+        self.assertEqual(peers.generation, generations[-1])
+
+        peers.set_host('1.2.3.4', 'b')
+        generations.append(peers.generation)
+        self.assertEqual(peers.get_host_ip_map(), {'b': ['1.2.3.4']})
+
+        peers.drop('1.2.3.4')
+        generations.append(peers.generation)
+        self.assertEqual(peers.get_host_ip_map(), {})
+        self.assertEqual(peers.query_host('b'), [])
+
+        self.assertEqual(len(set(generations)), len(generations))
+
+    def test_changes_since(self):
+        """
+        Ensures that changes are collapsed per peer, and that the table asks
+        for a resync once it has forgotten the requested changes.
+        """
+        peers = net_proto.PeerTable(change_log_size=4)
+        peers.set_host('1.2.3.4', 'a')
+        peers.set_host('5.6.7.8', 'b')
+        start = peers.generation
+
+        peers.set_host('9.10.11.12', 'c')
+        peers.set_host('1.2.3.4', 'd')
+        peers.drop('5.6.7.8')
+        self.assertEqual(peers.get_changes_since(start),
+            ({'9.10.11.12': 'c'}, ['5.6.7.8'], {'1.2.3.4': 'd'}))
+
+        peers.set_host('13.14.15.16', 'e')
+        peers.drop('13.14.15.16')
+        self.assertEqual(peers.get_changes_since(start), None)
+        self.assertEqual(peers.get_changes_since(peers.generation), ({}, [], {}))
+        self.assertEqual(peers.get_changes_since(peers.generation + 1), None)
+
+    def test_snapshot(self):
+        """
+        Ensures that snapshots are only rebuilt once the table changes, and
+        that published snapshots don't change afterwards.
+        """
+        peers = net_proto.PeerTable()
+        peers.set_host('1.2.3.4', 'a')
+        snapshot = peers.publish_snapshot()
+        self.assertIs(peers.publish_snapshot(), snapshot)
+        self.assertEqual(snapshot.query_host('a'), ['1.2.3.4'])
+
+        peers.set_host('5.6.7.8', 'a')
+        peers.set_host('1.2.3.4', 'b')
+        self.assertIs(peers.snapshot, snapshot)
+        self.assertEqual(snapshot.query_ip('1.2.3.4'), 'a')
+
+        new_snapshot = peers.publish_snapshot()
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertEqual(new_snapshot.generation, peers.generation)
+        self.assertEqual(new_snapshot.get_host_ip_map(),
+            {'a': ['5.6.7.8'], 'b': ['1.2.3.4']})
+        with self.assertRaises(TypeError):
+            new_snapshot.ip_to_host['1.2.3.4'] = 'c'
+
+class TestAnnounces(unittest.TestCase):
+    def test_announce_to_peers(self):
+        """
+        Ensures that handlers bound to their own addresses find each other
+        by announcing to a list of addresses, and expire a handler which
+        stops announcing.
+        """
+        addresses = ('127.0.0.2', '127.0.0.3')
+        my_reactor = reactor.Reactor()
+        handlers = [net_proto.ProtocolHandler(my_reactor, name,
+                port=TEST_NET_PORT, address=address,
+                broadcast_addresses=addresses, announce_interval=0.1,
+                announce_ttl=0.3)
+            for name, address in zip(('a', 'b'), addresses)]
+        for handler in handlers:
+            handler.open()
+
+        expected = {'a': ['127.0.0.2'], 'b': ['127.0.0.3']}
+        deadline = time.monotonic() + 5
+        while (any(handler.get_host_ip_map() != expected
+                    for handler in handlers) and
+                time.monotonic() < deadline):
+            my_reactor.poll(0.05)
+        for handler in handlers:
+            self.assertEqual(handler.get_host_ip_map(), expected)
+
+        # The reactor keeps calling b's announce timeout, but it can't send
+        # anything once its socket is gone
+        handlers[1].close()
+        deadline = time.monotonic() + 5
+        while (handlers[0].get_host_ip_map() != {'a': ['127.0.0.2']} and
+                time.monotonic() < deadline):
+            my_reactor.poll(0.05)
+        self.assertEqual(handlers[0].get_host_ip_map(), {'a': ['127.0.0.2']})
+
+        handlers[0].close()
+        my_reactor.close()
+
 class TestNetworkProtocol(unittest.TestCase):
+    def get_control_path(self):
+        "Gets the path of the Unix control socket that clients use, if any."
+        return None
+
     def setUp(self):
         self.net_handler = MockNetworkHandler()
         self.reactor = reactor.Reactor()
 
         self.control_handler = control_proto.ProtocolHandler(self.net_handler, 
-            self.reactor, port=TEST_CONTROL_PORT)
+            self.reactor, port=TEST_CONTROL_PORT,
+            path=self.get_control_path())
         self.control_handler.open()
 
-        self.client = control_proto.ClientHandler(port=TEST_CONTROL_PORT)
+        self.client = self.make_client()
         self.client.open()
 
         self.reactor_thread_quit_event = threading.Event()
@@ -68,6 +220,12 @@ class TestNetworkProtocol(unittest.TestCase):
 
         self.reactor_thread_quit_event.set()
         self.reactor_thread.join()
+        self.reactor.close()
+
+    def make_client(self):
+        "Creates a client connected to the control handler under test."
+        return control_proto.ClientHandler(port=TEST_CONTROL_PORT,
+            path=self.get_control_path())
 
     def test_query_host(self):
         """
@@ -94,5 +252,301 @@ class TestNetworkProtocol(unittest.TestCase):
         self.assertEqual(self.client.get_host_ip_mapping(), 
             {'a': ['1.2.3.4', '9.10.11.12'], 'b': ['5.6.7.8'], 'c': ['13.14.15.16']})
 
+    def test_offloaded_host_ip_mapping(self):
+        """
+        Ensures that a mapping built on a worker thread is sent before the
+        replies to any requests that the client sent after it.
+        """
+        self.control_handler.offload_hosts = 1
+        self.client.command_sock.sendall(control_proto.GetAll().serialize() +
+            control_proto.Host('b').serialize())
+
+        reply = self.client.read_json_message(control_proto.NameIPMapping)
+        self.assertEqual(reply.host_to_ips, self.net_handler.get_host_ip_map())
+        reply = self.client.read_json_message(control_proto.IP)
+        self.assertEqual(reply.ip_addrs, ['5.6.7.8'])
+
+    def test_large_host_ip_mapping(self):
+        """
+        Ensures that a mapping too large for one message, which is built on a
+        worker thread, still reaches the client whole.
+        """
+        for i in range(5 * control_proto.OFFLOAD_REPLY_HOSTS):
+            ip = '10.0.{}.{}'.format(i // 256, i % 256)
+            self.net_handler.host_ips['host-{}'.format(i)] = [ip]
+            self.net_handler.ip_hosts[ip] = 'host-{}'.format(i)
+        self.net_handler.generation += 1
+
+        self.assertEqual(self.client.get_host_ip_mapping(),
+            self.net_handler.get_host_ip_map())
+        self.assertEqual(self.client.get_ip('b'), ['5.6.7.8'])
+
+    def test_large_changes(self):
+        """
+        Ensures that changes too large for one message make the client
+        resync instead.
+        """
+        since = self.net_handler.generation
+        for i in range(5000):
+            self.net_handler.add_host('host-{}'.format(i),
+                '10.0.{}.{}'.format(i // 256, i % 256))
+
+        changes = self.client.get_changes(since)
+        self.assertTrue(changes.resync)
+        self.assertEqual(changes.version, self.net_handler.generation)
+
+    def test_stats(self):
+        """
+        Ensures that the server counts the requests it handles, and the bytes
+        it sends and receives.
+        """
+        def get_counters():
+            return {(counter['name'], tuple(sorted(counter['labels'].items()))):
+                    counter['value']
+                for counter in self.client.get_stats().counters}
+
+        before = get_counters()
+        self.client.get_ip('a')
+        after = get_counters()
+
+        requests = ('control_requests', (('type', 'name'),))
+        self.assertEqual(after[requests] - before.get(requests, 0), 1)
+
+        bytes_in = ('bytes_in', (('socket', 'control'),))
+        self.assertGreater(after[bytes_in], before[bytes_in])
+
+        histograms = {histogram['name'] for histogram
+            in self.client.get_stats().histograms}
+        self.assertIn('control_request_latency', histograms)
+
+    def test_stats_unavailable(self):
+        """
+        Ensures that a server which doesn't keep stats (like a worker) refuses
+        to report them, rather than reporting only some of them.
+        """
+        self.assertIsNone(self.client.get_stats().error)
+
+        self.control_handler.serve_stats = False
+        stats = self.client.get_stats()
+        self.assertEqual((stats.counters, stats.histograms), ([], []))
+        self.assertIsNotNone(stats.error)
+
+    def test_profile_unavailable(self):
+        """
+        Ensures that a server without a profiler refuses to profile.
+        """
+        reply = self.client.start_profile('sampling')
+        self.assertIsNone(reply.path)
+        self.assertIsNotNone(reply.error)
+
+    def test_host_ip_mapping_changes(self):
+        """
+        Ensures that the mapping is refreshed once the peer table changes.
+        """
+        self.client.get_host_ip_mapping()
+        self.net_handler.add_host('d', '17.18.19.20')
+        self.assertEqual(self.client.get_host_ip_mapping(), 
+            {'a': ['1.2.3.4', '9.10.11.12'], 'b': ['5.6.7.8'], 
+             'c': ['13.14.15.16'], 'd': ['17.18.19.20']})
+
+    def test_update_mirror(self):
+        """
+        Ensures that a mirror is filled in by a resync, and then kept up to
+        date by applying changes.
+        """
+        mirror = control_proto.TableMirror()
+        self.client.update_mirror(mirror)
+        self.assertEqual(mirror.query_ip('5.6.7.8'), 'b')
+        self.assertEqual(mirror.version, self.net_handler.generation)
+
+        self.net_handler.add_host('d', '17.18.19.20')
+        self.client.update_mirror(mirror)
+        self.assertEqual(mirror.query_host('d'), ['17.18.19.20'])
+        self.assertEqual(mirror.version, self.net_handler.generation)
+
+    def test_wait_host(self):
+        """
+        Waits for a known host, a host which never appears, and a host which
+        appears while the request is waiting.
+        """
+        self.assertEqual(self.client.wait_for_host('b', 5), ['5.6.7.8'])
+        self.assertEqual(self.client.wait_for_host('nonexistent', 0.1), [])
+
+        joiner = threading.Timer(0.1,
+            lambda: self.net_handler.add_host('d', '17.18.19.20'))
+        joiner.start()
+        self.assertEqual(self.client.wait_for_host('d', 5), ['17.18.19.20'])
+        joiner.join()
+
+        # Make sure the connection is still usable for other requests
+        self.assertEqual(self.client.get_host('5.6.7.8'), 'b')
+
+    def test_subscribe(self):
+        """
+        Ensures that subscribers get events for the hosts matching their
+        filters, and nothing else.
+        """
+        subscriber = self.make_client()
+        with subscriber:
+            version = subscriber.subscribe(prefix='d', subnet='17.18.0.0/16')
+            self.assertEqual(version, self.net_handler.generation)
+
+            self.net_handler.add_host('e', '17.18.19.21')
+            self.net_handler.add_host('d', '21.22.23.24')
+            self.net_handler.add_host('d', '17.18.19.20')
+            self.assertEqual(subscriber.read_event(),
+                control_proto.Joined('17.18.19.20', 'd'))
+
+class TestClientLimits(unittest.TestCase):
+    def setUp(self):
+        self.reactor = reactor.Reactor()
+        # The server closes connections itself in these tests, leaving them in
+        # TIME_WAIT - use a fresh port each time so that they can't interfere
+        # with the other tests
+        self.control_handler = control_proto.ProtocolHandler(
+            MockNetworkHandler(), self.reactor, port=0,
+            max_clients=2, idle_timeout=0.2)
+        self.control_handler.open()
+        _, self.port = self.control_handler.server_sock.getsockname()
+
+        self.reactor_thread_quit_event = threading.Event()
+        self.reactor_thread = threading.Thread(target=reactor_runner_thread,
+            args=(self.reactor, self.control_handler, self.reactor_thread_quit_event))
+        self.reactor_thread.daemon = True
+        self.reactor_thread.start()
+
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+        self.reactor_thread_quit_event.set()
+        self.reactor_thread.join()
+        self.reactor.close()
+
+    def connect(self):
+        "Connects a new client to the control handler."
+        client = control_proto.ClientHandler(port=self.port)
+        client.open()
+        self.clients.append(client)
+        return client
+
+    def test_max_clients(self):
+        """
+        Ensures that clients beyond the limit are dropped, without affecting
+        the clients that are already connected.
+        """
+        first = self.connect()
+        second = self.connect()
+        self.assertEqual(first.get_host('5.6.7.8'), 'b')
+        self.assertEqual(second.get_host('5.6.7.8'), 'b')
+
+        third = self.connect()
+        with self.assertRaises(OSError):
+            third.get_host('5.6.7.8')
+
+        self.assertEqual(first.get_host('1.2.3.4'), 'a')
+
+    def test_idle_eviction(self):
+        """
+        Ensures that idle clients are dropped, but that active clients are
+        not.
+        """
+        idle = self.connect()
+        active = self.connect()
+        for _ in range(4):
+            time.sleep(0.1)
+            self.assertEqual(active.get_host('5.6.7.8'), 'b')
+
+        with self.assertRaises(OSError):
+            idle.get_host('5.6.7.8')
+
+    def test_caching_client_reconnects(self):
+        """
+        Ensures that a caching client keeps working after the server has
+        dropped its idle command connection.
+        """
+        client = control_proto.CachingClientHandler(port=self.port)
+        client.open()
+        self.clients.append(client)
+
+        self.assertEqual(client.get_host('5.6.7.8'), 'b')
+        time.sleep(0.4)
+        self.assertEqual(client.get_host('1.2.3.4'), 'a')
+        self.assertEqual(client.get_ip('b'), ['5.6.7.8'])
+
+class TestUnixControlSocket(TestNetworkProtocol):
+    """
+    Runs the same tests as :class:`TestNetworkProtocol`, but with the client
+    connecting through the Unix control socket.
+    """
+    def setUp(self):
+        self.socket_dir = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.assertFalse(os.path.exists(self.get_control_path()))
+        self.socket_dir.cleanup()
+
+    def get_control_path(self):
+        return os.path.join(self.socket_dir.name, 'lnsd.sock')
+
+    def test_socket_mode(self):
+        """
+        Ensures that the socket has the configured permissions.
+        """
+        mode = stat.S_IMODE(os.stat(self.get_control_path()).st_mode)
+        self.assertEqual(mode, control_proto.CONTROL_SOCKET_MODE)
+
+class TestCachingClient(TestNetworkProtocol):
+    """
+    Runs the same tests as :class:`TestNetworkProtocol`, but with a caching
+    client, and ensures that cached answers are forgotten when they change.
+    """
+    def make_client(self):
+        return control_proto.CachingClientHandler(port=TEST_CONTROL_PORT,
+            path=self.get_control_path())
+
+    def test_cache_stats(self):
+        """
+        Ensures that repeated lookups are answered from the cache.
+        """
+        for _ in range(3):
+            self.assertEqual(self.client.get_ip('a'), ['1.2.3.4', '9.10.11.12'])
+            self.assertEqual(self.client.get_host('0.0.0.0'), None)
+
+        self.assertEqual(self.client.get_cache_stats(),
+            control_proto.CacheStats(hits=2, negative_hits=2, misses=2,
+                invalidations=0))
+
+    def test_event_invalidation(self):
+        """
+        Ensures that a cached answer is forgotten as soon as the server
+        reports a change to it.
+        """
+        self.assertEqual(self.client.get_ip('d'), [])
+        self.assertEqual(self.client.get_host('17.18.19.20'), None)
+
+        self.net_handler.add_host('d', '17.18.19.20')
+        self.assertEqual(self.client.get_ip('d'), ['17.18.19.20'])
+        self.assertEqual(self.client.get_host('17.18.19.20'), 'd')
+        self.assertEqual(self.client.get_cache_stats().invalidations, 1)
+
+    def test_ttl_invalidation(self):
+        """
+        Ensures that cached answers expire when events aren't used.
+        """
+        client = control_proto.CachingClientHandler(port=TEST_CONTROL_PORT,
+            path=self.get_control_path(), negative_ttl=0.1, use_events=False)
+        with client:
+            self.assertEqual(client.get_ip('d'), [])
+            self.net_handler.add_host('d', '17.18.19.20')
+            self.assertEqual(client.get_ip('d'), [])
+
+            time.sleep(0.1)
+            self.assertEqual(client.get_ip('d'), ['17.18.19.20'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,86 @@
+"""
+Ensures that the hosts file follows the peer table, and that changes which
+happen close together are written at once.
+"""
+import os
+import tempfile
+import time
+import unittest
+
+from lns import hosts_file, net_proto, reactor
+
+class TestHostsFile(unittest.TestCase):
+    def setUp(self):
+        self.hosts_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.hosts_dir.name, 'hosts')
+
+        self.peers = net_proto.PeerTable()
+        self.peers.set_host('5.6.7.8', 'b')
+        self.peers.set_host('1.2.3.4', 'a')
+
+        self.reactor = reactor.Reactor()
+        self.exporter = hosts_file.HostsFileExporter(self.peers, self.reactor,
+            self.path, delay=0.05)
+
+    def tearDown(self):
+        self.reactor.close()
+        self.hosts_dir.cleanup()
+
+    def read_entries(self):
+        "Reads the address and name of each entry in the hosts file."
+        with open(self.path) as hosts:
+            return [tuple(line.split()) for line in hosts
+                if not line.startswith('#')]
+
+    def run_reactor(self, duration):
+        "Runs the reactor for the given number of seconds."
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            self.reactor.poll(deadline - time.monotonic())
+
+    def test_render(self):
+        """
+        Ensures that entries are sorted, and that names which would break the
+        file are left out.
+        """
+        contents = hosts_file.render_hosts({'a': ['1.2.3.4', '0.1.2.3'],
+            'b c': ['5.6.7.8'], 'd#': ['9.10.11.12']})
+        self.assertEqual(contents,
+            hosts_file.HEADER + '0.1.2.3\ta\n1.2.3.4\ta\n')
+
+    def test_export(self):
+        """
+        Ensures that the initial table is written, and that a burst of changes
+        produces a single rewrite.
+        """
+        self.exporter.open()
+        try:
+            self.run_reactor(0.05)
+            self.assertEqual(self.read_entries(),
+                [('1.2.3.4', 'a'), ('5.6.7.8', 'b')])
+
+            written = []
+            real_render = hosts_file.render_hosts
+            def render_hosts(host_to_ips):
+                written.append(host_to_ips)
+                return real_render(host_to_ips)
+            hosts_file.render_hosts = render_hosts
+
+            try:
+                self.peers.set_host('9.10.11.12', 'c')
+                self.run_reactor(0.01)
+                self.peers.set_host('5.6.7.8', 'd')
+                self.peers.drop('1.2.3.4')
+                self.run_reactor(0.2)
+            finally:
+                hosts_file.render_hosts = real_render
+        finally:
+            self.exporter.close()
+
+        self.assertEqual(len(written), 1)
+        self.assertEqual(self.read_entries(),
+            [('5.6.7.8', 'd'), ('9.10.11.12', 'c')])
+        self.assertEqual(os.listdir(self.hosts_dir.name), ['hosts'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Ensures that metrics are rendered in the Prometheus text format, and served
+over HTTP without getting in the reactor's way.
+"""
+import http.client
+import threading
+import time
+import unittest
+
+from lns import http_metrics, metrics, net_proto, reactor
+from test_handlers import MockNetworkHandler, reactor_runner_thread
+
+class TestRender(unittest.TestCase):
+    def test_render(self):
+        """
+        Ensures that counters, histograms and the peer gauges are rendered.
+        """
+        registry = metrics.Registry()
+        registry.counter('packets_rejected', reason='bad-header').inc(2)
+        histogram = registry.histogram('latency', bounds=(0.5, 1))
+        histogram.observe(0.25)
+        histogram.observe(2)
+
+        snapshot = net_proto.Snapshot.build(7, {'a': ['1.2.3.4']},
+            {'1.2.3.4': 'a'})
+        lines = http_metrics.render_metrics(registry,
+            snapshot).decode('utf-8').splitlines()
+
+        self.assertEqual(lines, [
+            '# TYPE lnsd_peers gauge',
+            'lnsd_peers 1',
+            '# TYPE lnsd_table_generation gauge',
+            'lnsd_table_generation 7',
+            '# TYPE lnsd_packets_rejected_total counter',
+            'lnsd_packets_rejected_total{reason="bad-header"} 2',
+            '# TYPE lnsd_latency_seconds histogram',
+            'lnsd_latency_seconds_bucket{le="0.5"} 1',
+            'lnsd_latency_seconds_bucket{le="1"} 1',
+            'lnsd_latency_seconds_bucket{le="+Inf"} 2',
+            'lnsd_latency_seconds_sum 2.25',
+            'lnsd_latency_seconds_count 2',
+        ])
+
+class TestMetricsServer(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter('scraped')
+
+        self.reactor = reactor.Reactor()
+        self.server = http_metrics.MetricsServer(MockNetworkHandler(),
+            self.reactor, port=0, cache_time=60, registry=self.registry)
+        self.server.open()
+        _, self.port = self.server.server_sock.getsockname()
+
+        self.quit_event = threading.Event()
+        self.reactor_thread = threading.Thread(target=reactor_runner_thread,
+            args=(self.reactor, self.server, self.quit_event), daemon=True)
+        self.reactor_thread.start()
+
+    def tearDown(self):
+        self.quit_event.set()
+        self.reactor_thread.join()
+        self.reactor.close()
+
+    def test_scrape(self):
+        """
+        Ensures that several requests can be made over one connection, and
+        that the page is reused until it expires.
+        """
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request('GET', '/metrics')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertIn(b'lnsd_peers 4\n', response.read())
+
+            # The cached page doesn't see this until it is rendered again
+            self.counter.inc()
+            connection.request('GET', '/metrics?format=text')
+            response = connection.getresponse()
+            self.assertIn(b'lnsd_scraped_total 0\n', response.read())
+
+            connection.request('GET', '/')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 404)
+            response.read()
+
+            connection.request('POST', '/metrics')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 405)
+            response.read()
+        finally:
+            connection.close()
+
+        self.server.cache_time = 0
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request('GET', '/metrics',
+                headers={'Connection': 'close'})
+            response = connection.getresponse()
+            self.assertIn(b'lnsd_scraped_total 1\n', response.read())
+            self.assertEqual(response.getheader('Connection'), 'close')
+        finally:
+            connection.close()
+
+class TestHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.interval = http_metrics.HEARTBEAT_INTERVAL
+        http_metrics.HEARTBEAT_INTERVAL = 0.05
+        self.registry = metrics.Registry()
+        self.reactor = reactor.Reactor()
+        self.server = http_metrics.MetricsServer(MockNetworkHandler(),
+            self.reactor, port=0, registry=self.registry)
+
+    def tearDown(self):
+        http_metrics.HEARTBEAT_INTERVAL = self.interval
+        self.reactor.close()
+
+    def test_idle_loop_lag(self):
+        """
+        Ensures that the loop lag is measured even when nothing else is
+        happening, and that a stall shows up in it.
+        """
+        lag = self.server.loop_lag
+        slow = lag.bounds.index(0.25) + 1
+        observed = lag.count
+        stalled = sum(lag.counts[slow:])
+        self.server.open()
+        try:
+            started = time.monotonic()
+            while time.monotonic() - started < 0.5:
+                self.reactor.poll(0.1)
+            self.assertGreater(lag.count, observed + 1)
+
+            # Keeping the reactor away from its poll makes the next
+            # heartbeat late by nearly as long
+            time.sleep(0.35)
+            self.reactor.poll(0.1)
+            self.assertEqual(sum(lag.counts[slow:]), stalled + 1)
+
+            # The lag is reported by the server's own registry
+            self.assertIn('reactor_loop_lag', {histogram['name'] for histogram
+                in self.registry.collect()[1]})
+        finally:
+            self.server.close()
+
+if __name__ == '__main__':
+    unittest.main()
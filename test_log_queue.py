@@ -0,0 +1,92 @@
+"""
+Ensures that log records are written by the background writer, and dropped
+rather than waited on when it falls behind.
+"""
+import io
+import logging
+import queue
+import unittest
+
+from lns import log_queue
+
+class TestLossyQueueHandler(unittest.TestCase):
+    def test_overflow(self):
+        """
+        Ensures that records are dropped when the queue is full, and that the
+        drop is reported once there is room again.
+        """
+        handler = log_queue.LossyQueueHandler(queue.Queue(2))
+        before = handler.dropped.value
+        for index in range(5):
+            handler.handle(logging.makeLogRecord({'msg': 'Record %d',
+                'args': (index,)}))
+
+        self.assertEqual(handler.dropped.value - before, 3)
+        self.assertEqual(handler.unreported, 3)
+        self.assertEqual(handler.queue.get_nowait().msg, 'Record 0')
+        self.assertEqual(handler.queue.get_nowait().msg, 'Record 1')
+
+        handler.handle(logging.makeLogRecord({'msg': 'Record 5'}))
+        self.assertEqual(handler.queue.get_nowait().msg,
+            'Dropped 3 log records')
+        self.assertEqual(handler.queue.get_nowait().msg, 'Record 5')
+        self.assertEqual(handler.unreported, 0)
+
+class TestSampleFilter(unittest.TestCase):
+    def test_sample(self):
+        """
+        Ensures that only one in every so many records gets through.
+        """
+        sample_filter = log_queue.SampleFilter(3)
+        record = logging.makeLogRecord({})
+        self.assertEqual([sample_filter.filter(record) for _ in range(6)],
+            [False, False, True, False, False, True])
+
+class TestLogLevels(unittest.TestCase):
+    def test_parse(self):
+        """
+        Parses valid and invalid lists of subsystem levels.
+        """
+        self.assertEqual(log_queue.parse_log_levels(
+            'net_proto=info, reactor = WARNING,'),
+            {'lns.net_proto': logging.INFO, 'lns.reactor': logging.WARNING})
+        self.assertEqual(log_queue.parse_log_levels(''), {})
+
+        with self.assertRaises(ValueError):
+            log_queue.parse_log_levels('net_proto')
+        with self.assertRaises(ValueError):
+            log_queue.parse_log_levels('net_proto=loud')
+
+class TestLogPipeline(unittest.TestCase):
+    def setUp(self):
+        self.root_level = logging.getLogger().level
+
+    def tearDown(self):
+        logging.getLogger().setLevel(self.root_level)
+        logging.getLogger('lns.test_quiet').setLevel(logging.NOTSET)
+
+    def test_pipeline(self):
+        """
+        Ensures that records are written out by the time the pipeline is
+        closed, with subsystem levels and packet sampling applied.
+        """
+        stream = io.StringIO()
+        pipeline = log_queue.LogPipeline(stream,
+            levels={'lns.test_quiet': logging.WARNING}, packet_sample=2)
+        pipeline.open()
+        try:
+            logging.getLogger('lns.test_loud').debug('Loud %d', 1)
+            logging.getLogger('lns.test_quiet').debug('Quiet')
+            packets = logging.getLogger(log_queue.PACKET_LOGGER_NAME)
+            for index in range(4):
+                packets.debug('Packet %d', index)
+        finally:
+            pipeline.close()
+
+        self.assertEqual(stream.getvalue().splitlines(), [
+            'DEBUG:lns.test_loud:Loud 1',
+            'DEBUG:lns.net_proto.packets:Packet 1',
+            'DEBUG:lns.net_proto.packets:Packet 3'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Ensures that metrics count what they should, and are collected properly.
+"""
+import math
+import sys
+import threading
+import unittest
+
+from lns import metrics
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        """
+        Ensures that counters are shared between lookups with the same name
+        and labels, and kept apart otherwise.
+        """
+        self.registry.counter('dropped', reason='a').inc()
+        self.registry.counter('dropped', reason='a').inc(2)
+        self.registry.counter('dropped', reason='b').inc()
+
+        counters, histograms = self.registry.collect()
+        self.assertEqual(counters, [
+            {'name': 'dropped', 'labels': {'reason': 'a'}, 'value': 3},
+            {'name': 'dropped', 'labels': {'reason': 'b'}, 'value': 1}])
+        self.assertEqual(histograms, [])
+
+    def test_counter_threads(self):
+        """
+        Ensures that no additions are lost when a counter is updated from
+        several threads at once.
+        """
+        counter = self.registry.counter('stalls')
+
+        def count():
+            for _ in range(20000):
+                counter.inc()
+
+        # Switching threads as often as possible gives an unlocked counter
+        # the most chances to lose an update
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=count) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(counter.value, 80000)
+
+    def test_histogram(self):
+        """
+        Ensures that values are sorted into the right buckets, including the
+        unbounded bucket past the last bound.
+        """
+        histogram = self.registry.histogram('latency', bounds=(1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.total, 6)
+
+        _, (collected,) = self.registry.collect()
+        self.assertEqual(collected['bounds'], [1, 2])
+        self.assertEqual(collected['counts'], [2, 1, 1])
+
+    def test_quantile_bound(self):
+        """
+        Ensures that quantiles are estimated by the bounds of their buckets.
+        """
+        bounds = (1, 2)
+        self.assertIsNone(metrics.quantile_bound(bounds, [0, 0, 0], 0.5))
+        self.assertEqual(metrics.quantile_bound(bounds, [2, 1, 1], 0.5), 1)
+        self.assertEqual(metrics.quantile_bound(bounds, [2, 1, 1], 0.75), 2)
+        self.assertEqual(metrics.quantile_bound(bounds, [2, 1, 1], 0.99),
+            math.inf)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Ensures that profiles start and stop between the reactor's callbacks, and are
+written out when they stop.
+"""
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+from lns import profiler, reactor
+
+def busy_work():
+    "Keeps the reactor busy for a little while, so that it can be profiled."
+    deadline = time.monotonic() + 0.05
+    while time.monotonic() < deadline:
+        sum(range(1000))
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.reactor = reactor.Reactor()
+        self.profiler = profiler.Profiler(self.reactor, self.directory.name)
+
+    def tearDown(self):
+        self.profiler.close()
+        self.reactor.close()
+        self.directory.cleanup()
+
+    def run_profile(self, mode):
+        """
+        Profiles some work on the reactor, returning the profile's path.
+        """
+        path = self.profiler.start(mode)
+        self.reactor.poll(0)
+        self.assertIsNotNone(self.profiler.profile)
+
+        self.reactor.call_later(0, busy_work)
+        self.reactor.poll(0)
+
+        self.assertEqual(self.profiler.stop(), path)
+        self.reactor.poll(0)
+        self.assertIsNone(self.profiler.profile)
+        return path
+
+    def test_cprofile(self):
+        """
+        Ensures that a cProfile profile is written as pstats.
+        """
+        path = self.run_profile('cprofile')
+        self.assertTrue(path.endswith('.pstats'))
+
+        stats = pstats.Stats(path)
+        self.assertTrue(any(function == 'busy_work'
+            for _, _, function in stats.stats))
+
+    def test_sampling(self):
+        """
+        Ensures that a sampling profile is written as collapsed stacks.
+        """
+        path = self.run_profile('sampling')
+        self.assertTrue(path.endswith('.collapsed'))
+
+        with open(path) as samples:
+            lines = samples.read().splitlines()
+        self.assertTrue(any('test_profiler:busy_work' in line
+            for line in lines))
+
+    def test_unique_paths(self):
+        """
+        Ensures that profiles started within the same second are written to
+        different files.
+        """
+        first = self.run_profile('sampling')
+        second = self.run_profile('sampling')
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_errors(self):
+        """
+        Ensures that unknown modes, starting twice and stopping when nothing
+        is running are refused.
+        """
+        with self.assertRaises(ValueError):
+            self.profiler.start('tracing')
+
+        with self.assertRaises(ValueError):
+            self.profiler.stop()
+
+        self.profiler.start('sampling')
+        with self.assertRaises(ValueError):
+            self.profiler.start('cprofile')
+
+    def test_stop_before_start(self):
+        """
+        Ensures that a profile stopped before the reactor started it is still
+        written out.
+        """
+        path = self.profiler.start('cprofile')
+        self.profiler.stop()
+        self.reactor.poll(0)
+
+        self.assertIsNone(self.profiler.profile)
+        self.assertTrue(os.path.exists(path))
+
+    def test_close(self):
+        """
+        Ensures that closing the profiler writes out a running profile.
+        """
+        path = self.profiler.start('sampling')
+        self.reactor.poll(0)
+        self.profiler.close()
+        self.assertTrue(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,11 @@
 Ensures that the protocol manager can encode and decode messages circularly, so
 that a message which is encoded and decoded is equal to the original message.
 """
+import contextlib
 import io
 import unittest
 
-from lns import control_proto, net_proto
+from lns import control_proto, net_proto, query
 
 class NetworkProtocol(unittest.TestCase):
     def roundtrip(self, message):
@@ -87,5 +88,123 @@ class ControlProtocol(unittest.TestCase):
             with self.assertRaises(ValueError):
                 self.roundtrip(control_proto.NameIPMapping({'a': [bad_ip]}))
 
+    def test_split_name_ip_mapping(self):
+        """
+        Ensures that a mapping too large for one message is split into parts
+        that each fit, and that together hold the whole mapping.
+        """
+        mapping = {'host-{}'.format(i):
+                ['10.0.{}.{}'.format(i // 256, i % 256)]
+            for i in range(5000)}
+        stream = io.BytesIO(control_proto.NameIPMapping(mapping).serialize())
+
+        parts = []
+        while stream.tell() < len(stream.getvalue()):
+            parts.append(control_proto.NameIPMapping.unserialize(
+                control_proto.get_length_encoded_json(stream)))
+
+        self.assertGreater(len(parts), 1)
+        self.assertEqual([part.more for part in parts],
+            [True] * (len(parts) - 1) + [False])
+
+        joined = {}
+        for part in parts:
+            joined.update(part.host_to_ips)
+        self.assertEqual(joined, mapping)
+
+    def test_get_changes(self):
+        self.roundtrip(control_proto.GetChanges(42))
+
+        with self.assertRaises(ValueError):
+            self.roundtrip(control_proto.GetChanges('42'))
+
+    def test_changes(self):
+        self.roundtrip(control_proto.Changes(0, {}, [], {}, True))
+        self.roundtrip(control_proto.Changes(5, {'1.2.3.4': 'a'},
+            ['5.6.7.8'], {'9.10.11.12': 'b'}, False))
+
+        for bad_host in self.BAD_HOSTNAMES:
+            with self.assertRaises(ValueError):
+                self.roundtrip(control_proto.Changes(1, {'1.2.3.4': bad_host},
+                    [], {}, False))
+
+        for bad_ip in self.BAD_IPS:
+            with self.assertRaises(ValueError):
+                self.roundtrip(control_proto.Changes(1, {}, [bad_ip], {},
+                    False))
+
+    def test_wait_host(self):
+        self.roundtrip(control_proto.WaitHost('foo', 30))
+        self.roundtrip(control_proto.WaitHost('foo', 0.5))
+
+        for bad_host in self.BAD_HOSTNAMES:
+            with self.assertRaises(ValueError):
+                self.roundtrip(control_proto.WaitHost(bad_host, 30))
+
+        with self.assertRaises(ValueError):
+            self.roundtrip(control_proto.WaitHost('foo', -1))
+
+        # JSON's NaN and Infinity parse as floats, but can't be waited on
+        for bad_timeout in [float('nan'), float('inf'), True]:
+            with self.assertRaises(ValueError):
+                self.roundtrip(control_proto.WaitHost('foo', bad_timeout))
+
+        for bad_timeout in ['nan', 'inf', '-1']:
+            with self.assertRaises(SystemExit):
+                with contextlib.redirect_stderr(io.StringIO()):
+                    query.check_wait_or_die('foo:' + bad_timeout)
+        self.assertEqual(query.check_wait_or_die('foo:1.5'), ('foo', 1.5))
+
+    def test_subscribe(self):
+        self.roundtrip(control_proto.Subscribe(None, None))
+        self.roundtrip(control_proto.Subscribe('web-', '10.0.0.0/8'))
+
+        with self.assertRaises(ValueError):
+            self.roundtrip(control_proto.Subscribe(None, '10.0.0.0/33'))
+
+    def test_subscribed(self):
+        self.roundtrip(control_proto.Subscribed(42))
+
+    def test_events(self):
+        self.roundtrip(control_proto.Joined('1.2.3.4', 'a'))
+        self.roundtrip(control_proto.Left('1.2.3.4', 'a'))
+        self.roundtrip(control_proto.Renamed('1.2.3.4', 'a', 'b'))
+
+        for bad_host in self.BAD_HOSTNAMES:
+            with self.assertRaises(ValueError):
+                self.roundtrip(control_proto.Joined('1.2.3.4', bad_host))
+
+        for bad_ip in self.BAD_IPS:
+            with self.assertRaises(ValueError):
+                self.roundtrip(control_proto.Left(bad_ip, 'a'))
+
+    def test_stats(self):
+        self.roundtrip(control_proto.GetStats())
+        self.roundtrip(control_proto.Stats([], []))
+        self.roundtrip(control_proto.Stats([], [], 'Not kept here'))
+        self.roundtrip(control_proto.Stats(
+            [{'name': 'packets_received', 'labels': {}, 'value': 3}],
+            [{'name': 'latency', 'labels': {'type': 'name'},
+              'bounds': [0.1, 1], 'counts': [1, 0, 2], 'sum': 4.5}]))
+
+        with self.assertRaises(ValueError):
+            self.roundtrip(control_proto.Stats(
+                [{'name': 'packets_received', 'labels': {}, 'value': '3'}], []))
+
+        with self.assertRaises(ValueError):
+            self.roundtrip(control_proto.Stats([],
+                [{'name': 'latency', 'labels': {}, 'bounds': [0.1, 1],
+                  'counts': [1, 0], 'sum': 4.5}]))
+
+    def test_profile(self):
+        self.roundtrip(control_proto.Profile('start', 'sampling'))
+        self.roundtrip(control_proto.Profile('stop', None))
+        self.roundtrip(control_proto.Profiling('cprofile', '/tmp/a.pstats',
+            None))
+        self.roundtrip(control_proto.Profiling(None, None, 'No profile'))
+
+        with self.assertRaises(ValueError):
+            self.roundtrip(control_proto.Profile('pause', None))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,228 @@
+"""
+Ensures that the reactor runs timers and callbacks when it should.
+"""
+import os
+import socket
+import threading
+import time
+import unittest
+
+from lns import reactor
+
+class TestTimers(unittest.TestCase):
+    def setUp(self):
+        self.reactor = reactor.Reactor()
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def test_call_later(self):
+        """
+        Ensures that timers run in order, once their deadline has passed,
+        and that a poll doesn't wait past the next timer.
+        """
+        calls = []
+        self.reactor.call_later(0.05, lambda: calls.append('second'))
+        self.reactor.call_later(0.01, lambda: calls.append('first'))
+
+        start = time.monotonic()
+        while len(calls) < 2 and time.monotonic() - start < 5:
+            self.reactor.poll(5)
+
+        self.assertEqual(calls, ['first', 'second'])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_cancel(self):
+        """
+        Ensures that cancelled timers never run.
+        """
+        calls = []
+        timer = self.reactor.call_later(0.01, lambda: calls.append('cancelled'))
+        self.reactor.call_later(0.02, lambda: calls.append('kept'))
+        timer.cancel()
+
+        start = time.monotonic()
+        while not calls and time.monotonic() - start < 5:
+            self.reactor.poll(5)
+
+        self.assertEqual(calls, ['kept'])
+
+class TestThreads(unittest.TestCase):
+    def setUp(self):
+        self.reactor = reactor.Reactor()
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def poll_until(self, condition):
+        "Polls the reactor until the condition is true, or too long passes."
+        start = time.monotonic()
+        while not condition() and time.monotonic() - start < 5:
+            self.reactor.poll(5)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_call_soon_threadsafe(self):
+        """
+        Ensures that a call from another thread wakes up a waiting reactor,
+        and runs on the reactor's thread.
+        """
+        threads = []
+        self.reactor.open_wakeup_pipe()
+        caller = threading.Timer(0.05,
+            lambda: self.reactor.call_soon_threadsafe(
+                lambda: threads.append(threading.get_ident())))
+        caller.start()
+
+        self.poll_until(lambda: threads)
+        self.assertEqual(threads, [threading.get_ident()])
+        caller.join()
+
+    def test_run_in_worker(self):
+        """
+        Ensures that functions run on worker threads, and that their results
+        (and errors) are delivered back on the reactor's thread.
+        """
+        results = []
+        def on_done(future):
+            results.append((threading.get_ident(), future.result()))
+        self.reactor.run_in_worker(threading.get_ident, on_done)
+        self.poll_until(lambda: results)
+
+        (delivered_on, worker), = results
+        self.assertEqual(delivered_on, threading.get_ident())
+        self.assertNotEqual(worker, threading.get_ident())
+
+        errors = []
+        self.reactor.run_in_worker(lambda: 1 / 0,
+            lambda future: errors.append(future.exception()))
+        self.poll_until(lambda: errors)
+        self.assertIsInstance(errors[0], ZeroDivisionError)
+
+class TestWakeupPipe(unittest.TestCase):
+    def test_lazy(self):
+        """
+        Ensures that the wakeup pipe is only opened once it is needed, never
+        counts as a client, and is closed along with the reactor.
+        """
+        my_reactor = reactor.Reactor()
+        self.assertIsNone(my_reactor.wakeup_pipe)
+        self.assertFalse(my_reactor.has_clients())
+
+        calls = []
+        my_reactor.call_soon_threadsafe(lambda: calls.append(1))
+        read_fd, write_fd = my_reactor.wakeup_pipe
+        self.assertFalse(my_reactor.has_clients())
+
+        my_reactor.open_wakeup_pipe()
+        self.assertEqual(my_reactor.wakeup_pipe, (read_fd, write_fd))
+
+        my_reactor.poll(1)
+        self.assertEqual(calls, [1])
+
+        my_reactor.close()
+        self.assertIsNone(my_reactor.wakeup_pipe)
+        with self.assertRaises(OSError):
+            os.fstat(read_fd)
+
+class TestAsyncioThreads(TestThreads):
+    """
+    Runs the same tests as :class:`TestThreads`, with the asyncio reactor.
+    """
+    def setUp(self):
+        self.reactor = reactor.AsyncioReactor()
+
+    def tearDown(self):
+        self.reactor.close()
+        self.reactor.loop.close()
+
+class TestAsyncioTimers(TestTimers):
+    """
+    Runs the same tests as :class:`TestTimers`, with the asyncio reactor.
+    """
+    def setUp(self):
+        self.reactor = reactor.AsyncioReactor()
+
+    def tearDown(self):
+        self.reactor.close()
+        self.reactor.loop.close()
+
+class TestMonitoring(unittest.TestCase):
+    def setUp(self):
+        self.reactor = reactor.Reactor()
+        self.reactor.enable_monitoring(threshold=0.05, deadline=0.1)
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def test_slow_callback(self):
+        """
+        Ensures that callbacks are timed, and that the watchdog reports a
+        callback which runs too long along with the reactor's stack.
+        """
+        def slow_timer():
+            time.sleep(0.3)
+
+        calls = []
+        self.reactor.call_later(0, slow_timer)
+        self.reactor.call_later(0, lambda: calls.append('fast'))
+        with self.assertLogs('lns.watchdog', 'WARNING') as logs:
+            while not calls:
+                self.reactor.poll(1)
+
+        output = '\n'.join(logs.output)
+        self.assertIn('has been running', output)
+        self.assertIn('has not polled', output)
+        self.assertIn('in slow_timer', output)
+        self.assertIn('Slow callback', output)
+
+        slowest, = self.reactor.monitor.get_slowest(1)
+        self.assertIn('slow_timer', slowest.name)
+        self.assertEqual(slowest.calls, 1)
+        self.assertGreaterEqual(slowest.longest, 0.3)
+
+class TestAsyncioMonitoring(TestMonitoring):
+    """
+    Runs the same tests as :class:`TestMonitoring`, with the asyncio reactor.
+    """
+    def setUp(self):
+        self.reactor = reactor.AsyncioReactor()
+        self.reactor.enable_monitoring(threshold=0.05, deadline=0.1)
+
+    def tearDown(self):
+        self.reactor.close()
+        self.reactor.loop.close()
+
+class TestAsyncioReactor(unittest.TestCase):
+    def setUp(self):
+        self.reactor = reactor.AsyncioReactor()
+        self.reader, self.writer = socket.socketpair()
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        self.reactor.close()
+        self.reactor.loop.close()
+
+    def test_bind(self):
+        """
+        Ensures that callbacks run when their sockets are ready, followed by
+        the step callbacks, and that unbound callbacks no longer run.
+        """
+        calls = []
+        def on_readable(event):
+            fd, event_type = event
+            calls.append((event_type, self.reader.recv(100)))
+        self.reactor.bind(self.reader, reactor.READABLE, on_readable)
+        self.reactor.add_step_callback(lambda: calls.append('step'))
+
+        self.writer.send(b'ping')
+        self.reactor.poll(5)
+        self.assertEqual(calls, [(reactor.READABLE, b'ping'), 'step'])
+
+        self.reactor.unbind(self.reader)
+        self.writer.send(b'pong')
+        self.reactor.poll(0.05)
+        self.assertEqual(calls, [(reactor.READABLE, b'ping'), 'step', 'step'])
+
+if __name__ == '__main__':
+    unittest.main()
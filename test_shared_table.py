@@ -0,0 +1,91 @@
+"""
+Ensures that tables published into shared memory can be read back, both
+before and after they change.
+"""
+import os
+import tempfile
+import unittest
+
+from lns import shared_table
+
+class TestSharedTable(unittest.TestCase):
+    def setUp(self):
+        self.table_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.table_dir.name, 'lnsd.table')
+
+        self.writer = shared_table.SharedTableWriter(self.path)
+        self.writer.open()
+
+        self.reader = shared_table.SharedTableReader(self.path)
+        self.reader.open()
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        self.table_dir.cleanup()
+
+    def test_empty(self):
+        """
+        Queries a table which hasn't had anything published to it yet.
+        """
+        self.assertEqual(self.reader.generation, 0)
+        self.assertEqual(self.reader.query_host('a'), [])
+        self.assertEqual(self.reader.query_ip('1.2.3.4'), None)
+        self.assertEqual(self.reader.get_host_ip_map(), {})
+
+    def test_lookup(self):
+        """
+        Queries known and unknown hosts and addresses.
+        """
+        self.writer.publish({'a': ['1.2.3.4', '9.10.11.12'], 'b': ['5.6.7.8']},
+            3)
+        self.assertEqual(self.reader.generation, 3)
+        self.assertEqual(self.reader.query_host('a'), ['1.2.3.4', '9.10.11.12'])
+        self.assertEqual(self.reader.query_host('b'), ['5.6.7.8'])
+        self.assertEqual(self.reader.query_host('c'), [])
+        self.assertEqual(self.reader.query_ip('9.10.11.12'), 'a')
+        self.assertEqual(self.reader.query_ip('5.6.7.8'), 'b')
+        self.assertEqual(self.reader.query_ip('0.0.0.0'), None)
+
+    def test_republish(self):
+        """
+        Ensures that readers see each new version of the table, including
+        versions which are too big to fit where the old ones were.
+        """
+        self.writer.publish({'a': ['1.2.3.4']}, 1)
+        self.writer.publish({'b': ['1.2.3.4']}, 2)
+        self.assertEqual(self.reader.query_ip('1.2.3.4'), 'b')
+        self.assertEqual(self.reader.query_host('a'), [])
+
+        big_table = {'host-{}'.format(i): ['10.0.{}.{}'.format(i // 256, i % 256)]
+            for i in range(5000)}
+        self.writer.publish(big_table, 3)
+        self.assertEqual(self.reader.generation, 3)
+        self.assertEqual(self.reader.query_host('host-4321'), ['10.0.16.225'])
+        self.assertEqual(self.reader.query_ip('10.0.0.7'), 'host-7')
+        self.assertEqual(self.reader.get_host_ip_map(), big_table)
+
+    def test_publish_in_progress(self):
+        """
+        Ensures that readers can't accept the header while a publish is
+        still writing it, which could hand them an old generation or slot.
+        """
+        headers = []
+        def check_header(generation):
+            write_header(generation)
+            headers.append(shared_table.HEADER.unpack_from(self.writer.map, 0))
+            with self.assertRaises(shared_table.TableChanged):
+                self.reader.generation
+
+        write_header = self.writer.write_header
+        self.writer.write_header = check_header
+        self.writer.publish({'a': ['1.2.3.4']}, 1)
+        self.writer.publish({'b': ['5.6.7.8']}, 2)
+
+        self.assertEqual([header[4] for header in headers], [1, 2])
+        self.assertTrue(all(header[3] % 2 == 1 for header in headers))
+        self.assertEqual(self.reader.generation, 2)
+        self.assertEqual(self.reader.query_ip('5.6.7.8'), 'b')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Ensures that the network simulator drives the real protocol handler the way a
+network of peers would.
+"""
+import unittest
+
+from lns import net_proto, sim
+
+class TestNetworkSimulator(unittest.TestCase):
+    def test_steady(self):
+        """
+        Ensures that every peer is known once each has had a chance to
+        announce itself.
+        """
+        simulator = sim.NetworkSimulator(50)
+        stats = simulator.run(net_proto.ANNOUNCE_ALARM + 1)
+
+        self.assertEqual(simulator.handler.get_host_ip_map(),
+            {peer.hostname: [peer.ip] for peer in simulator.peers})
+        self.assertEqual(stats.packets_delivered, stats.packets_sent)
+        self.assertGreaterEqual(stats.packets_sent, 50)
+        self.assertEqual(stats.expiry_runs, 2)
+
+        # The handler's own announces go out through the simulated socket
+        self.assertEqual(simulator.socket.packets_sent, 2)
+
+    def test_churn(self):
+        """
+        Ensures that peers which leave are expired, and renamed peers are
+        known by their new names.
+        """
+        simulator = sim.NetworkSimulator(50, churn=0.1, renames=0.1)
+        expired = simulator.handler.peers_expired.value
+        stats = simulator.run(net_proto.ANNOUNCE_TTL +
+            3 * net_proto.ANNOUNCE_ALARM - 1)
+
+        self.assertGreater(stats.peers_left, 0)
+        self.assertGreater(stats.peers_renamed, 0)
+        self.assertGreater(simulator.handler.peers_expired.value, expired)
+
+        # Every address the handler knows belongs to a current peer, or one
+        # which left recently enough that it hasn't expired yet
+        table = simulator.handler.peers.ip_to_host
+        current = {peer.ip for peer in simulator.peers}
+        self.assertLessEqual(len(set(table) - current), 5 * 4)
+        self.assertTrue(any(host.startswith('renamed-')
+            for host in table.values()))
+
+    def test_loss_and_duplicates(self):
+        """
+        Ensures that lost announces never arrive, and duplicated ones arrive
+        twice.
+        """
+        stats = sim.NetworkSimulator(20, loss=1).run(net_proto.ANNOUNCE_ALARM)
+        self.assertEqual(stats.packets_lost, stats.packets_sent)
+        self.assertEqual(stats.packets_delivered, 0)
+
+        stats = sim.NetworkSimulator(20, duplicates=1).run(
+            net_proto.ANNOUNCE_ALARM)
+        self.assertEqual(stats.packets_delivered, 2 * stats.packets_sent)
+
+    def test_repeatable(self):
+        """
+        Ensures that simulations with the same seed do the same things.
+        """
+        def run():
+            simulator = sim.NetworkSimulator(30, churn=0.1, renames=0.1,
+                loss=0.1, duplicates=0.1, seed=7)
+            stats = simulator.run(3 * net_proto.ANNOUNCE_ALARM)
+            return (simulator.handler.get_host_ip_map(), stats.packets_sent,
+                stats.packets_lost, stats.packets_duplicated)
+
+        self.assertEqual(run(), run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Ensures that packet traces hold the datagrams that were recorded, and that
+replaying them leaves a handler with the mapping the recording handler had.
+"""
+import os
+import tempfile
+import unittest
+
+from lns import net_proto, reactor, sim, trace
+
+def announce(hostname):
+    "Builds the datagram of an announce from the given host."
+    return net_proto.Announce(hostname).serialize()
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.trace_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.trace_dir.name, 'lnsd.pcap')
+        self.reactor = reactor.Reactor()
+        self.clock = sim.VirtualClock()
+
+    def tearDown(self):
+        self.reactor.close()
+        self.trace_dir.cleanup()
+
+    def record(self, datagrams, max_size=trace.TRACE_MAX_SIZE):
+        """
+        Records each of the (time, data, host) datagrams given, returning the
+        writer.
+        """
+        writer = trace.TraceWriter(self.reactor, self.path, max_size=max_size,
+            clock=self.clock)
+        writer.open()
+        for when, data, host in datagrams:
+            self.clock.advance_to(when)
+            writer.record(data, host, net_proto.NET_PORT)
+        writer.close()
+        return writer
+
+    def test_roundtrip(self):
+        """
+        Ensures that datagrams are read back as they were recorded, padding
+        and all, with their times and sources.
+        """
+        datagrams = [(1000.25, announce('foo'), '10.0.0.1'),
+            (1001.5, announce('bar'), '10.0.0.2'),
+            (1002.125, b'\x07garbage\x00\x00', '10.0.0.3')]
+        self.record(datagrams)
+
+        records = list(trace.read_trace(self.path))
+        self.assertEqual([(record.timestamp, record.data, record.host)
+            for record in records], datagrams)
+        self.assertTrue(all(record.port == net_proto.NET_PORT
+            for record in records))
+
+        # Only the start of each announce is written out
+        self.assertLess(os.path.getsize(self.path), 3 * net_proto.PACKET_SIZE)
+
+    def test_pcap_headers(self):
+        """
+        Ensures that each record is a well-formed IPv4 and UDP packet, as
+        pcap readers expect.
+        """
+        self.record([(1000, announce('foo'), '10.0.0.1')])
+        with open(self.path, 'rb') as trace_file:
+            self.assertTrue(trace.is_trace_header(
+                trace_file.read(trace.PCAP_HEADER.size)))
+            _, _, captured, original = trace.RECORD_HEADER.unpack(
+                trace_file.read(trace.RECORD_HEADER.size))
+            frame = trace_file.read(captured)
+
+        self.assertEqual(original, 20 + 8 + net_proto.PACKET_SIZE)
+        self.assertEqual(trace.ipv4_checksum(frame[:20]), 0)
+
+        _, total_length, _, _, _, protocol, _, _, _ = (
+            trace.IPV4_HEADER.unpack(frame[:20])[1:])
+        self.assertEqual(total_length, original)
+        self.assertEqual(protocol, 17)
+
+        _, port, length, _ = trace.UDP_HEADER.unpack(frame[20:28])
+        self.assertEqual(port, net_proto.NET_PORT)
+        self.assertEqual(length, 8 + net_proto.PACKET_SIZE)
+        self.assertEqual(frame[28:], b'\x01foo')
+
+    def test_size_limit(self):
+        """
+        Ensures that recording stops once the trace would grow past its
+        limit, and that reopening a trace appends to it.
+        """
+        writer = self.record([(1000 + i, announce('host-{}'.format(i)),
+            '10.0.0.1') for i in range(100)], max_size=1000)
+        self.assertLessEqual(os.path.getsize(self.path), 1000)
+        self.assertTrue(writer.full)
+
+        recorded = len(list(trace.read_trace(self.path)))
+        self.assertGreater(recorded, 0)
+        self.assertLess(recorded, 100)
+
+        self.record([(2000, announce('late'), '10.0.0.2')])
+        records = list(trace.read_trace(self.path))
+        self.assertEqual(len(records), recorded + 1)
+        self.assertEqual(records[-1].host, '10.0.0.2')
+
+    def test_not_a_trace(self):
+        """
+        Ensures that files which aren't traces are neither read nor appended
+        to.
+        """
+        with open(self.path, 'wb') as not_trace:
+            not_trace.write(b'This is not a trace, but it is long enough')
+
+        with self.assertRaises(ValueError):
+            list(trace.read_trace(self.path))
+        with self.assertRaises(ValueError):
+            trace.TraceWriter(self.reactor, self.path).open()
+
+    def test_replay(self):
+        """
+        Ensures that replaying what a handler received leaves another handler
+        with the same mapping, however fast it is replayed.
+        """
+        writer = trace.TraceWriter(self.reactor, self.path, clock=self.clock)
+        traced = writer.packets_traced.value
+        writer.open()
+
+        handler = net_proto.ProtocolHandler(None, 'recorder',
+            clock=self.clock, trace=writer)
+        handler.server_sock = sim.SimSocket()
+        handler.on_announce_timeout()
+
+        # Every host announces itself as often as it should, except for one
+        # which goes away and has to be expired
+        when = sim.START_TIME
+        while when < sim.START_TIME + 3 * net_proto.ANNOUNCE_TTL:
+            when += 1
+            self.clock.advance_to(when)
+            for i in range(5):
+                if i == 0 and when > sim.START_TIME + 10:
+                    continue
+                if int(when) % net_proto.ANNOUNCE_ALARM == i:
+                    handler.server_sock.deliver(announce('host-{}'.format(i)),
+                        sim.make_ip(i))
+                    handler.on_message(None)
+            handler.on_announce_timeout()
+        writer.close()
+
+        expected = handler.get_host_ip_map()
+        self.assertNotIn('host-0', expected)
+        self.assertEqual(len(expected), 4)
+
+        replayer = trace.Replayer(trace.read_trace(self.path))
+        self.assertEqual(replayer.run().get_host_ip_map(), expected)
+        self.assertEqual(replayer.packets,
+            writer.packets_traced.value - traced)
+
+        replayer = trace.Replayer(trace.read_trace(self.path), speed=1000)
+        self.assertEqual(replayer.run().get_host_ip_map(), expected)
+
+if __name__ == '__main__':
+    unittest.main()
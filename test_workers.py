@@ -0,0 +1,147 @@
+"""
+Ensures that workers follow the shared table, and that the owner keeps them
+running.
+"""
+import os
+import signal
+import socket
+import tempfile
+import time
+import unittest
+
+from lns import control_proto, reactor, shared_table, workers
+
+# Change this to some port that is available on your machine, so that the
+# workers can serve it
+TEST_CONTROL_PORT = 4098
+
+class TestTableFollower(unittest.TestCase):
+    def setUp(self):
+        self.table_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.table_dir.name, 'lnsd.table')
+
+        self.writer = shared_table.SharedTableWriter(self.path)
+        self.writer.open()
+        self.writer.publish({'a': ['1.2.3.4'], 'b': ['5.6.7.8']}, 5)
+
+        self.reactor = reactor.Reactor()
+        self.follower = workers.TableFollower(self.reactor, self.path)
+        self.follower.open()
+
+    def tearDown(self):
+        self.follower.close()
+        self.writer.close()
+        self.reactor.close()
+        self.table_dir.cleanup()
+
+    def test_follow(self):
+        """
+        Ensures that changes to the shared table are applied under the
+        owner's generation, and announced as changes.
+        """
+        self.assertEqual(self.follower.generation, 5)
+        self.assertEqual(self.follower.query_host('a'), ['1.2.3.4'])
+
+        changes = []
+        self.follower.add_change_listener(
+            lambda *change: changes.append(change))
+        self.writer.publish({'c': ['1.2.3.4'], 'd': ['9.10.11.12']}, 8)
+        self.follower.on_check()
+
+        self.assertEqual(self.follower.generation, 8)
+        self.assertEqual(self.follower.query_ip('1.2.3.4'), 'c')
+        self.assertEqual(sorted(changes, key=str), sorted([
+            ('1.2.3.4', 'a', 'c'), ('5.6.7.8', 'b', None),
+            ('9.10.11.12', None, 'd')], key=str))
+
+        self.assertEqual(self.follower.get_changes_since(5),
+            ({'9.10.11.12': 'd'}, ['5.6.7.8'], {'1.2.3.4': 'c'}))
+        self.assertEqual(self.follower.get_changes_since(4), None)
+
+class TestWorkerSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.table_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.table_dir.name, 'lnsd.table')
+
+        self.writer = shared_table.SharedTableWriter(self.path)
+        self.writer.open()
+        self.writer.publish({'a': ['1.2.3.4']}, 1)
+
+        self.reactor = reactor.Reactor()
+        self.supervisor = workers.WorkerSupervisor(self.reactor, 2,
+            TEST_CONTROL_PORT, self.path)
+        self.supervisor.open()
+
+    def tearDown(self):
+        self.supervisor.close()
+        self.writer.close()
+        self.reactor.close()
+        self.table_dir.cleanup()
+
+    def query(self):
+        "Looks up a host through whichever worker accepts the connection."
+        start = time.monotonic()
+        while True:
+            try:
+                with control_proto.ClientHandler(TEST_CONTROL_PORT) as client:
+                    return client.get_ip('a')
+            except ConnectionRefusedError:
+                if time.monotonic() - start > 5:
+                    raise
+                time.sleep(0.05)
+
+    def test_restart(self):
+        """
+        Ensures that workers answer queries, and that a worker which dies is
+        replaced.
+        """
+        self.assertEqual(self.query(), ['1.2.3.4'])
+
+        dead_worker = self.supervisor.workers[0]
+        os.kill(dead_worker.pid, signal.SIGKILL)
+        dead_worker.join()
+
+        start = time.monotonic()
+        while (self.supervisor.workers[0] is dead_worker and
+                time.monotonic() - start < 5):
+            self.reactor.poll(workers.WORKER_SUPERVISE_INTERVAL)
+
+        self.assertIsNot(self.supervisor.workers[0], dead_worker)
+        self.assertTrue(self.supervisor.workers[0].is_alive())
+        self.assertEqual(self.query(), ['1.2.3.4'])
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'),
+        'Needs /proc to list open descriptors')
+    def test_no_inherited_descriptors(self):
+        """
+        Ensures that workers don't hold on to the owner's sockets, which would
+        keep its clients connected after the owner closed them.
+        """
+        def get_sockets(pid):
+            fd_dir = '/proc/{}/fd'.format(pid)
+            links = set()
+            for fd in os.listdir(fd_dir):
+                try:
+                    links.add(os.readlink(os.path.join(fd_dir, fd)))
+                except FileNotFoundError:
+                    pass
+            return {link for link in links if link.startswith('socket:')}
+
+        with socket.socket() as owner_socket:
+            owner_sockets = get_sockets(os.getpid())
+            worker = self.supervisor.start_worker()
+            try:
+                # The worker only drops what it was forked with once it has
+                # started its own interpreter
+                start = time.monotonic()
+                while (get_sockets(worker.pid) & owner_sockets and
+                        time.monotonic() - start < 5):
+                    time.sleep(0.05)
+                self.assertEqual(get_sockets(worker.pid) & owner_sockets,
+                    set())
+            finally:
+                worker.terminate()
+                worker.join()
+
+if __name__ == '__main__':
+    unittest.main()